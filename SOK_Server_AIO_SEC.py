@@ -2,16 +2,15 @@
 # SOK_Server_All_In_One -v12.0_Secure_API.py (Tích hợp Lớp Bảo mật Giao dịch)
 # -*- coding: utf-8 -*-
 
-import os, sys, time, requests, json, threading, logging, socket, random, uuid, math
+import os, sys, time, requests, json, threading, logging, socket, random, uuid, math, sqlite3, bisect, itertools, subprocess
 from flask import Flask, jsonify, request, render_template
 from flask_cors import CORS
-from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from waitress import serve
 from typing import List, Dict, Optional
 from decimal import Decimal, getcontext
 from colorama import Fore, Style, init as colorama_init
-import plotly.graph_objects as go
-from datetime import datetime
+from collections import OrderedDict, deque
 
 # --- CẤU HÌNH & THIẾT LẬP ---
 getcontext().prec = 50 
@@ -20,6 +19,7 @@ if os.path.join(project_root, 'sok') not in sys.path: sys.path.insert(0, project
 try:
     from sok.wallet import Wallet, get_address_from_public_key_pem, verify_signature
     from sok.transaction import Transaction
+    from sok.utils import hash_data
 except ImportError as e:
     with open("SERVER_CRITICAL_ERROR.log", "w", encoding='utf-8') as f:
         f.write(f"Timestamp: {time.ctime()}\nKhông thể import 'sok': {e}\nSys.path: {sys.path}")
@@ -27,7 +27,7 @@ except ImportError as e:
 
 # Cấu hình chung
 PRIME_WALLET_FILE = "prime_agent_wallet.pem"
-STATE_FILE = "prime_agent_state.json"
+STATE_FILE = "prime_agent_state.json" # Định dạng cũ, chỉ còn dùng để chuyển đổi sang SQLite
 SERVER_PORT = 9000
 BLOCKCHAIN_NODE_URL = "http://192.168.1.19:5000"
 
@@ -35,7 +35,6 @@ BLOCKCHAIN_NODE_URL = "http://192.168.1.19:5000"
 STAKING_POOL_WALLET_FILE = "staking_pool_wallet.pem"
 STAKING_APR = Decimal('15.0')
 INTEREST_RATE_PER_SECOND = STAKING_APR / Decimal(100) / Decimal(365 * 24 * 60 * 60)
-REWARD_CALCULATION_INTERVAL = 3600
 
 # Mô hình kinh tế
 P2P_FEE_PERCENT = Decimal('0.5')
@@ -45,7 +44,7 @@ PRICE_PER_VIEW = PRICE_PER_100_VIEWS / 100
 REWARD_AMOUNT = PRICE_PER_VIEW * (1 - PLATFORM_FEE_PERCENT / 100)
 
 # Cấu hình Mô hình Kinh tế Bảo chứng
-ECON_DATA_FILE = "sok_econ_data_v10.json"
+ECON_DATA_FILE = "sok_econ_data_v10.json" # Định dạng cũ, chỉ còn dùng để chuyển đổi sang chuỗi thời gian SQLite
 ECON_CHART_FILE = os.path.join("static", "sok_valuation_chart.html")
 ECON_ANALYSIS_INTERVAL = 300
 ECON_INITIAL_TREASURY_USD = Decimal('10000.0')
@@ -53,16 +52,86 @@ ECON_INITIAL_TOTAL_SUPPLY = Decimal('10000000.0')
 ECON_W_TX_GROWTH = Decimal('0.5')
 ECON_W_WORKER_GROWTH = Decimal('0.3')
 ECON_W_WEBSITE_GROWTH = Decimal('0.2')
+# [TỐI ƯU HÓA] Chuỗi thời gian chỉ ghi nối: mẫu thô + bản tổng hợp theo khung 5 phút / 1 giờ / 1 ngày
+ECON_RECENT_POINTS = 2016 # Bộ đệm vòng trong RAM (~1 tuần ở chu kỳ 5 phút)
+ECON_RAW_RETENTION_SECONDS = 7 * 24 * 3600
+ECON_ROLLUP_RETENTION = {300: 30 * 24 * 3600, 3600: 365 * 24 * 3600, 86400: None} # độ phân giải (giây) -> thời gian giữ (None = mãi mãi)
+ECON_SERIES_FIELDS = ("market_price_usd", "floor_price_usd", "treasury_value_usd", "activity_multiplier", "total_workers", "total_websites", "total_staked_sok", "total_p2p_escrow_sok", "total_transactions")
+# [TỐI ƯU HÓA] Biểu đồ vẽ từ dữ liệu tổng hợp trong một tiến trình riêng (plotly chỉ được import ở đó)
+ECON_CHART_MAX_POINTS = 500
+ECON_CHART_RENDER_TIMEOUT = 120
+ECON_CHART_RENDERER = os.path.join(project_root, "econ_chart_renderer.py")
+# [TỐI ƯU HÓA] /api/v1/econ_chart_data: truy vấn theo khoảng thời gian, giảm mẫu LTTB phía server, cache phản hồi đã mã hóa
+ECON_QUERY_DEFAULT_POINTS = 200
+ECON_QUERY_MAX_POINTS = 2000
+ECON_QUERY_MAX_SOURCE_POINTS = 20000 # Số khung tối đa đọc từ một độ phân giải cho một truy vấn
+ECON_QUERY_CACHE_SIZE = 64
+ECON_RANGE_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400, "y": 365 * 86400}
+ECON_CHART_COLUMNS = ("timestamps", "market_prices", "floor_prices", "treasury_values")
+ECON_DECIMAL_FIELDS = ("market_price_usd", "floor_price_usd", "treasury_value_usd", "activity_multiplier", "total_staked_sok", "total_p2p_escrow_sok")
 
 # Cấu hình Logic khác
 PAYMENT_COOLDOWN_SECONDS = 180
 WORKER_TIMEOUT_SECONDS = 180
 NODE_HEALTH_CHECK_TIMEOUT = 5
 MINIMUM_FUNDING_AMOUNT = PRICE_PER_100_VIEWS / 2
-SAVE_STATE_INTERVAL = 300
 LIVE_NETWORK_CONFIG_FILE = "live_network_nodes.json"
 BOOTSTRAP_CONFIG_FILE = "bootstrap_config.json"
 
+# [TỐI ƯU HÓA] Chọn node theo độ trễ (EWMA), thăm dò song song, chuyển node ngay khi lỗi
+NODE_PROBE_INTERVAL = 30
+NODE_PROBE_WORKERS = 16
+NODE_EWMA_ALPHA = Decimal('0.3')
+NODE_MAX_ERROR_RATE = 0.5 # Node có tỉ lệ lỗi (EWMA) vượt ngưỡng này bị loại khỏi danh sách chọn
+NODE_SWITCH_LATENCY_RATIO = 2 # Chỉ bỏ node hiện tại nếu có node nhanh hơn nó ít nhất chừng này lần
+
+# [TỐI ƯU HÓA] Sổ cái trả thưởng: cộng dồn theo worker, tất toán theo lô (ký song song, gửi dạng pipeline)
+PAYOUT_INTERVAL_SECONDS = 15
+PAYOUT_BATCH_SIZE = 500
+PAYOUT_SIGN_WORKERS = 8
+PAYOUT_SUBMIT_WORKERS = 16
+# Giao dịch đã ký mà kết quả gửi không chắc chắn (timeout/5xx) được ghi sổ và chỉ gửi lại đúng giao dịch đó
+# khi scanner đã quét tới đỉnh chuỗi mà vẫn không thấy nó sau khoảng này
+TX_CONFIRM_TIMEOUT_SECONDS = 600
+
+# [TỐI ƯU HÓA] Trạng thái lưu trong SQLite, ghi gia tăng theo từng thay đổi (gom lô) thay cho dump JSON toàn bộ
+STATE_DB_FILE = "prime_agent_state.sqlite"
+STATE_FLUSH_INTERVAL = 1
+STATE_DOMAINS = ("active_workers", "last_reward_times", "pending_rewards", "websites_db", "p2p_orders", "public_key_cache", "staking_records", "unconfirmed_txs")
+STATE_LAZY_DOMAINS = ("public_key_cache",) # Chỉ mục địa chỉ -> public key: ghi thẳng xuống DB, bộ nhớ chỉ giữ cache LRU
+STATE_META_KEYS = ("last_scanned_block", "treasury_value_usd", "staking_reward_index", "staking_index_updated_at")
+STATE_DECIMAL_FIELDS = {"websites_db": ('views_funded', 'views_completed'), "p2p_orders": ('sok_amount',), "staking_records": ('principal', 'reward', 'reward_index'), "unconfirmed_txs": ('amount', 'principal')}
+
+# [TỐI ƯU HÓA] Chỉ mục website còn tín dụng (cây Fenwick) cho /websites/get_one
+WEBSITE_SELECTION_WEIGHTED = False # True: xác suất chọn tỉ lệ với số lượt xem còn lại; False: đều như random.choice cũ
+
+# [TỐI ƯU HÓA] Phân trang cho các endpoint danh sách (limit/offset; tổng số trả qua header X-Total-Count)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# [TỐI ƯU HÓA] Lưu trữ lệnh P2P đã đóng ra đĩa; sổ lệnh trong bộ nhớ chỉ giữ lệnh còn sống
+P2P_ARCHIVED_STATUSES = ('COMPLETED',)
+
+# [TỐI ƯU HÓA] Tra public key: cache LRU + chỉ mục SQLite do scanner nạp, cache "không tìm thấy" có hạn, gộp các lần tra trùng
+PUBKEY_CACHE_SIZE = 10000
+PUBKEY_NEGATIVE_TTL_SECONDS = 300
+PUBKEY_LOOKUP_TIMEOUT = 30 # Thời gian tối đa một yêu cầu chờ lần tra đang chạy cho cùng địa chỉ
+PUBKEY_FALLBACK_BLOCKS = 500 # Số khối gần nhất tải lại khi scanner chưa lập chỉ mục tới đỉnh chuỗi
+PUBKEY_BACKFILL_PAGES_PER_TICK = 8 # Số trang khối cũ (quét trước khi có chỉ mục public key) được lập chỉ mục mỗi vòng scanner
+
+# [TỐI ƯU HÓA] Sổ worker: hết hạn theo bánh xe thời gian, đếm theo loại, nhịp tim theo lô cho gateway
+WORKER_WHEEL_TICK_SECONDS = 5
+WORKER_CLEANUP_INTERVAL = 10
+HEARTBEAT_BATCH_MAX = 1000
+
+# [TỐI ƯU HÓA] Số liệu dashboard: bản chụp bất biến làm mới nền, request chỉ đọc bộ nhớ
+DASHBOARD_REFRESH_INTERVAL = 2
+DASHBOARD_MAX_STALENESS = 15 # Bản chụp cũ hơn ngưỡng này (luồng nền bị kẹt) thì request tự dựng lại phần số liệu cục bộ
+
+# [TỐI ƯU HÓA] Quét thanh toán theo con trỏ khối
+SCANNER_INTERVAL_SECONDS = 60
+SCANNER_PAGE_SIZE = 256 # Khớp giới hạn /chain/blocks phía node
+
 def setup_logging():
     log_format = '%(asctime)s [SOK_Server] [%(threadName)-18s] [%(levelname)s] - %(message)s'
     logger = logging.getLogger(); logger.setLevel(logging.INFO)
@@ -85,25 +154,308 @@ class CustomJSONEncoder(json.JSONEncoder):
 
 app.json_encoder = CustomJSONEncoder
 
+class InstrumentedLock:
+    """RLock có đo thời gian chờ: chỉ bấm giờ khi lần thử lấy khóa không chặn thất bại (tức là có tranh chấp)."""
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.RLock()
+        self.acquisitions = 0; self.contended = 0; self.wait_total = 0.0; self.wait_max = 0.0
+
+    def __enter__(self):
+        if not self._lock.acquire(blocking=False):
+            started = time.perf_counter(); self._lock.acquire(); waited = time.perf_counter() - started
+            self.contended += 1; self.wait_total += waited; self.wait_max = max(self.wait_max, waited)
+        self.acquisitions += 1 # Các bộ đếm chỉ được cập nhật khi đang giữ khóa
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+    def stats(self) -> Dict:
+        return {"acquisitions": self.acquisitions, "contended": self.contended,
+                "wait_total_ms": round(self.wait_total * 1000, 3), "wait_max_ms": round(self.wait_max * 1000, 3)}
+
+def lttb_indices(xs: List[float], ys: List[float], threshold: int) -> List[int]:
+    """Largest-Triangle-Three-Buckets: chọn `threshold` điểm giữ hình dạng đường cong (luôn giữ điểm đầu và cuối)."""
+    n = len(xs)
+    if threshold >= n or threshold < 3: return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    selected, a = [0], 0
+    for i in range(threshold - 2):
+        avg_start, avg_end = int((i + 1) * every) + 1, min(int((i + 2) * every) + 1, n)
+        avg_x = sum(xs[avg_start:avg_end]) / (avg_end - avg_start); avg_y = sum(ys[avg_start:avg_end]) / (avg_end - avg_start)
+        best, best_area = int(i * every) + 1, -1.0
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area: best, best_area = j, area
+        selected.append(best); a = best
+    selected.append(n - 1)
+    return selected
+
+class FundedSiteIndex:
+    """Cây Fenwick trên các slot website: đổi trọng số O(log n), chọn ngẫu nhiên theo trọng số O(log n). Không tự khóa."""
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self.tree = [0] * (capacity + 1)
+        self.weights = [0] * capacity
+        self.url_at: List[Optional[str]] = [None] * capacity
+        self.slot_of: Dict[str, int] = {}
+        self.free_slots: List[int] = []
+        self.used_slots = 0
+        self.total = 0
+
+    def __len__(self): return len(self.slot_of)
+
+    def _rebuild(self, capacity: int):
+        self.weights += [0] * (capacity - self.capacity); self.url_at += [None] * (capacity - self.capacity)
+        self.capacity = capacity
+        self.tree = [0] * (capacity + 1)
+        for i in range(1, capacity + 1):
+            self.tree[i] += self.weights[i - 1]
+            parent = i + (i & -i)
+            if parent <= capacity: self.tree[parent] += self.tree[i]
+
+    def _new_slot(self) -> int:
+        if self.free_slots: return self.free_slots.pop()
+        if self.used_slots == self.capacity: self._rebuild(self.capacity * 2)
+        self.used_slots += 1
+        return self.used_slots - 1
+
+    def _add(self, slot: int, delta: int):
+        self.weights[slot] += delta; self.total += delta
+        i = slot + 1
+        while i <= self.capacity:
+            self.tree[i] += delta; i += i & -i
+
+    def set(self, url: str, weight: int):
+        slot = self.slot_of.get(url)
+        if slot is None:
+            if weight <= 0: return
+            slot = self._new_slot(); self.slot_of[url] = slot; self.url_at[slot] = url
+        if weight != self.weights[slot]: self._add(slot, max(weight, 0) - self.weights[slot])
+        if weight <= 0:
+            del self.slot_of[url]; self.url_at[slot] = None; self.free_slots.append(slot)
+
+    def sample(self) -> Optional[str]:
+        if self.total <= 0: return None
+        target, pos, step = random.randrange(self.total), 0, 1 << (self.capacity.bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt <= self.capacity and self.tree[nxt] <= target:
+                pos = nxt; target -= self.tree[nxt]
+            step >>= 1
+        return self.url_at[pos]
+
+class WorkerRegistry:
+    """
+    Sổ worker đang hoạt động. Nhịp tim O(1): chuyển worker sang ô hết hạn mới của bánh xe thời gian.
+    Dọn dẹp O(số worker hết hạn): chỉ duyệt các ô đã tới hạn. Bộ đếm theo loại cập nhật dần. Không tự khóa.
+    """
+    def __init__(self, timeout: float, tick: float):
+        self.timeout, self.tick = timeout, tick
+        self.records: Dict[str, Dict] = {}
+        self.by_type: Dict[str, Dict[str, None]] = {}
+        self.wheel: Dict[int, set] = {}
+        self.slot_of: Dict[str, int] = {}
+        self.swept_tick = int(time.time() // tick)
+
+    def __len__(self): return len(self.records)
+
+    def type_counts(self) -> Dict[str, int]:
+        return {worker_type: len(members) for worker_type, members in self.by_type.items()}
+
+    def touch(self, address: str, record: Dict) -> Optional[Dict]:
+        """Ghi nhận nhịp tim (record là bản ghi mới, không sửa tại chỗ). Trả về bản ghi cũ (None nếu worker mới)."""
+        previous = self.records.get(address)
+        if previous and previous.get("type") != record.get("type"): self._drop_type(address, previous.get("type"))
+        self.records[address] = record
+        self.by_type.setdefault(record.get("type"), {})[address] = None
+        slot = max(-int(-(record.get("last_seen", 0) + self.timeout) // self.tick), self.swept_tick + 1)
+        old_slot = self.slot_of.get(address)
+        if old_slot != slot:
+            if old_slot is not None: self._leave_slot(address, old_slot)
+            self.wheel.setdefault(slot, set()).add(address); self.slot_of[address] = slot
+        return previous
+
+    def remove(self, address: str):
+        record = self.records.pop(address, None)
+        if record is None: return
+        self._drop_type(address, record.get("type"))
+        self._leave_slot(address, self.slot_of.pop(address))
+
+    def expire(self, now: float) -> List[str]:
+        now_tick, expired = int(now // self.tick), []
+        for slot in range(self.swept_tick + 1, now_tick + 1):
+            for address in self.wheel.pop(slot, ()):
+                record = self.records.pop(address)
+                self._drop_type(address, record.get("type")); del self.slot_of[address]
+                expired.append(address)
+        self.swept_tick = max(self.swept_tick, now_tick)
+        return expired
+
+    def _drop_type(self, address: str, worker_type: str):
+        members = self.by_type.get(worker_type)
+        if members is None: return
+        members.pop(address, None)
+        if not members: del self.by_type[worker_type]
+
+    def _leave_slot(self, address: str, slot: int):
+        members = self.wheel.get(slot)
+        if members is None: return
+        members.discard(address)
+        if not members: del self.wheel[slot]
+
+class PrimeStateStore:
+    """Kho trạng thái SQLite: mỗi miền dữ liệu một bảng (key -> JSON), bảng 'meta' cho các giá trị đơn lẻ."""
+    def __init__(self, db_path: str):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL'); self.conn.execute('PRAGMA synchronous=NORMAL')
+            for table in STATE_DOMAINS + ("meta",):
+                self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS p2p_order_archive (id TEXT PRIMARY KEY, seller_address TEXT, buyer_address TEXT,
+                                 status TEXT, created_at REAL, closed_at REAL, data TEXT NOT NULL)''')
+            for column in ("seller_address", "buyer_address", "closed_at"):
+                self.conn.execute(f'CREATE INDEX IF NOT EXISTS idx_archive_{column} ON p2p_order_archive ({column})')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS econ_samples (ts REAL PRIMARY KEY, data TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS econ_rollups (resolution INTEGER, bucket REAL, data TEXT NOT NULL, PRIMARY KEY (resolution, bucket))')
+
+    def load(self, table: str) -> Dict:
+        with self.lock: rows = self.conn.execute(f'SELECT key, value FROM {table}').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def get(self, table: str, key: str):
+        with self.lock: row = self.conn.execute(f'SELECT value FROM {table} WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write_batch(self, rows: List[tuple]):
+        """rows: [(bảng, key, chuỗi JSON hoặc None để xóa)], ghi trong MỘT giao dịch."""
+        with self.lock, self.conn:
+            for table, key, value in rows:
+                if value is None: self.conn.execute(f'DELETE FROM {table} WHERE key = ?', (key,))
+                else: self.conn.execute(f'INSERT OR REPLACE INTO {table} (key, value) VALUES (?, ?)', (key, value))
+
+    def purge_null_rows(self, table: str) -> int:
+        with self.lock, self.conn: return self.conn.execute(f"DELETE FROM {table} WHERE value = 'null'").rowcount
+
+    def archive_orders(self, orders: List[Dict]):
+        """Chuyển lệnh sang bảng lưu trữ và xóa khỏi bảng lệnh sống trong cùng một giao dịch."""
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO p2p_order_archive (id, seller_address, buyer_address, status, created_at, closed_at, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  [(o['id'], o['seller_address'], o.get('buyer_address'), o['status'], o['created_at'], o.get('closed_at', time.time()),
+                                    json.dumps(o, cls=CustomJSONEncoder)) for o in orders])
+            self.conn.executemany('DELETE FROM p2p_orders WHERE key = ?', [(o['id'],) for o in orders])
+
+    def query_archive(self, address: str = None, status: str = None, offset: int = 0, limit: int = 100):
+        clauses, params = [], []
+        if address: clauses.append('(seller_address = ? OR buyer_address = ?)'); params += [address, address]
+        if status: clauses.append('status = ?'); params.append(status)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        with self.lock:
+            total = self.conn.execute(f'SELECT COUNT(*) FROM p2p_order_archive {where}', params).fetchone()[0]
+            rows = self.conn.execute(f'SELECT data FROM p2p_order_archive {where} ORDER BY closed_at DESC LIMIT ? OFFSET ?', params + [limit, offset]).fetchall()
+        return [json.loads(row[0]) for row in rows], total
+
+    def append_econ(self, samples: List[tuple], rollups: List[tuple], cutoffs: Dict[int, float] = None):
+        """samples: [(ts, JSON)], rollups: [(độ phân giải, mốc khung, JSON)] ghi đè khung đang mở; cutoffs: {độ phân giải (0 = mẫu thô): mốc xóa}."""
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO econ_samples (ts, data) VALUES (?, ?)', samples)
+            self.conn.executemany('INSERT OR REPLACE INTO econ_rollups (resolution, bucket, data) VALUES (?, ?, ?)', rollups)
+            for resolution, cutoff in (cutoffs or {}).items():
+                if resolution == 0: self.conn.execute('DELETE FROM econ_samples WHERE ts < ?', (cutoff,))
+                else: self.conn.execute('DELETE FROM econ_rollups WHERE resolution = ? AND bucket < ?', (resolution, cutoff))
+
+    def recent_econ_samples(self, limit: int) -> List[Dict]:
+        with self.lock: rows = self.conn.execute('SELECT data FROM econ_samples ORDER BY ts DESC LIMIT ?', (limit,)).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def econ_rollups(self, resolution: int, start: float = None, end: float = None) -> List[Dict]:
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM econ_rollups WHERE resolution = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket',
+                                     (resolution, start if start is not None else float('-inf'), end if end is not None else float('inf'))).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def last_econ_rollups(self) -> Dict[int, Dict]:
+        with self.lock:
+            rows = self.conn.execute('SELECT r.resolution, r.data FROM econ_rollups r JOIN (SELECT resolution, MAX(bucket) AS bucket FROM econ_rollups GROUP BY resolution) m '
+                                     'ON r.resolution = m.resolution AND r.bucket = m.bucket').fetchall()
+        return {resolution: json.loads(data) for resolution, data in rows}
+
+    def has_econ_samples(self) -> bool:
+        with self.lock: return self.conn.execute('SELECT 1 FROM econ_samples LIMIT 1').fetchone() is not None
+
+    def close(self):
+        with self.lock: self.conn.close()
+
 class PrimeAgentLogic:
     # --- __init__ và các hàm khởi tạo/lưu/tải state giữ nguyên ---
     def __init__(self):
         self.wallet = self._initialize_wallet(PRIME_WALLET_FILE, "Kho bạc & Ký quỹ P2P")
         self.staking_pool_wallet = self._initialize_wallet(STAKING_POOL_WALLET_FILE, "Quỹ Staking")
-        self.reward_queue = Queue()
-        self.active_workers: Dict[str, Dict] = {}
+        self.worker_registry = WorkerRegistry(WORKER_TIMEOUT_SECONDS, WORKER_WHEEL_TICK_SECONDS)
+        self.active_workers: Dict[str, Dict] = self.worker_registry.records # Cùng một dict, giữ dưới workers_lock
         self.last_reward_times: Dict[str, float] = {}
-        self.state_lock = threading.RLock()
+        self.pending_rewards: Dict[str, Decimal] = {} # Sổ cái: địa chỉ worker -> tổng thưởng còn nợ
+        self.payouts_in_flight: Dict[str, Decimal] = {} # Khoản đang gửi lên node, chưa trừ khỏi sổ cái
+        self.claims_in_flight: Dict[str, Decimal] = {} # Khoản rút stake đã tách khỏi staking_records, chờ node xác nhận (giữ dưới staking_lock)
+        # Sổ ghi trước các giao dịch đi ra: khóa băm giao dịch (như node tính) -> {tx, kind, ref, amount, submitted_at}
+        self.unconfirmed_txs: Dict[str, Dict] = {}
+        # Giao dịch node đã nhận (201) nhưng scanner chưa thấy trong khối: khóa -> (người gửi, số tiền, thời điểm gửi).
+        # Số dư /balance của node chỉ tính khối đã đào, nên các khoản này phải được trừ trước khi chi tiếp
+        self.unmined_outgoing: Dict[str, tuple] = {}
+        # [TỐI ƯU HÓA] Mỗi miền dữ liệu một khóa riêng; state_lock chỉ còn giữ các giá trị chung (con trỏ quét, quỹ, dữ liệu kinh tế).
+        # Thứ tự khóa: commit_lock -> khóa miền. Không bao giờ giữ hai khóa miền cùng lúc.
+        self.state_lock = InstrumentedLock("meta")
+        self.workers_lock = InstrumentedLock("workers")
+        self.websites_lock = InstrumentedLock("websites")
+        self.orders_lock = InstrumentedLock("p2p_orders")
+        self.staking_lock = InstrumentedLock("staking")
+        self.rewards_lock = InstrumentedLock("rewards")
+        self.cache_lock = InstrumentedLock("public_keys")
+        self.tx_lock = InstrumentedLock("unconfirmed_txs")
+        self.commit_lock = InstrumentedLock("commit") # Trang quét khối được áp dụng nguyên khối so với lần ghi xuống DB
+        self.domain_locks = {"active_workers": self.workers_lock, "last_reward_times": self.rewards_lock, "pending_rewards": self.rewards_lock,
+                             "websites_db": self.websites_lock, "p2p_orders": self.orders_lock, "public_key_cache": self.cache_lock,
+                             "staking_records": self.staking_lock, "unconfirmed_txs": self.tx_lock, "meta": self.state_lock}
         self.websites_db: Dict[str, Dict] = {}
+        self.funded_index = FundedSiteIndex() # Các website còn views_funded > 0, giữ dưới websites_lock
         self.current_best_node: Optional[str] = None
+        self.node_stats: Dict[str, Dict] = {} # url -> {latency, errors (EWMA), height, down_until}
+        self.node_lock = threading.Lock()
+        self.dashboard_snapshot: Optional[Dict] = None # Luôn được thay nguyên khối, không sửa tại chỗ
         self.is_running = threading.Event(); self.is_running.set()
         self.last_scanned_block = -1
+        # Các khối <= đích này đã được quét trước khi có chỉ mục public key: lập chỉ mục bù từ khối gốc, con trỏ riêng
+        self.pubkey_backfill_block = -1; self.pubkey_backfill_target = -1
         self.total_views_completed_session = 0
         self.p2p_orders: Dict[str, Dict] = {}
-        self.public_key_cache: Dict[str, str] = {}
-        self.staking_records: Dict[str, Dict] = {}
-        self.historical_econ_data = []
+        # Chỉ mục phụ (giữ dưới khóa miền tương ứng). Dict không giá trị được dùng như tập có thứ tự chèn.
+        self.sites_by_owner: Dict[str, Dict[str, None]] = {}
+        self.orders_by_key: Dict[tuple, Dict[str, None]] = {} # (seller, sok_amount, status) -> order_id
+        self.orders_by_address: Dict[str, Dict[str, None]] = {} # seller/buyer -> order_id
+        self.open_order_book: List[tuple] = [] # (created_at, order_id) của các lệnh OPEN, đã sắp xếp
+        self.open_escrow_total = Decimal('0')
+        self.public_key_cache: OrderedDict = OrderedDict() # LRU, giữ dưới cache_lock
+        self.pubkey_misses: Dict[str, float] = {} # địa chỉ -> thời điểm hết hạn của kết quả "không tìm thấy"
+        self.pubkey_inflight: Dict[str, threading.Event] = {}
+        self.staking_records: Dict[str, Dict] = {} # địa chỉ -> {principal, reward (đã chốt), reward_index (chỉ số lúc chốt)}
+        # [TỐI ƯU HÓA] Chỉ số thưởng tích lũy toàn cục: lãi trên 1 SOK gốc kể từ mốc, tính lười khi đọc/nhận thưởng
+        self.staking_reward_index = Decimal('0')
+        self.staking_index_updated_at = time.time()
+        self.historical_econ_data = deque(maxlen=ECON_RECENT_POINTS) # Bộ đệm vòng các mẫu gần nhất; toàn bộ lịch sử nằm trong SQLite
+        self.econ_open_rollups: Dict[int, Dict] = {} # độ phân giải -> khung tổng hợp đang mở
+        self.econ_chart_series: Dict[int, deque] = {} # độ phân giải -> các khung gần nhất (tối đa ECON_CHART_MAX_POINTS), cập nhật dần
+        self.chart_pending: Optional[Dict] = None # Dữ liệu biểu đồ mới nhất chờ vẽ; bản mới ghi đè bản chưa kịp vẽ
+        self.chart_ready = threading.Event()
+        # Cột số thực tính sẵn song song với bộ đệm vòng (timestamps, market_prices, ...) cho truy vấn biểu đồ
+        self.econ_columns: Dict[str, deque] = {column: deque(maxlen=ECON_RECENT_POINTS) for column in ECON_CHART_COLUMNS}
+        self.econ_query_cache: OrderedDict = OrderedDict() # (độ phân giải, đầu, cuối, số điểm) -> JSON đã mã hóa; xóa khi có mẫu mới
+        self.econ_query_lock = threading.Lock()
         self.treasury_value_usd = ECON_INITIAL_TREASURY_USD
+        self.state_store: Optional[PrimeStateStore] = None
+        self._dirty_state = set() # (miền, key) đã thay đổi, chờ ghi xuống SQLite
+        self._dirty_lock = threading.Lock()
 
     def _initialize_wallet(self, filename: str, wallet_name: str) -> Wallet:
         logging.info(f"Đang khởi tạo ví cho {wallet_name}...")
@@ -118,38 +470,183 @@ class PrimeAgentLogic:
         except Exception as e:
             logging.critical(f"Không thể tải/tạo ví {wallet_name}: {e}", exc_info=True); sys.exit(1)
 
-    def _load_state(self):
+    def _decode_state(self, domain: str, value):
+        if domain == "pending_rewards": return Decimal(value)
+        fields = STATE_DECIMAL_FIELDS.get(domain)
+        if not fields: return value
+        return {k: Decimal(v) if k in fields and v is not None else v for k, v in value.items()}
+
+    def _migrate_json_state(self):
+        """Chuyển một lần từ tệp JSON cũ sang SQLite rồi đổi tên tệp cũ để không nạp lại."""
+        rows, state = [("meta", "schema_version", "1")], {}
         if os.path.exists(STATE_FILE):
             try:
-                with self.state_lock, open(STATE_FILE, 'r', encoding='utf-8') as f:
-                    state = json.load(f)
-                    self.active_workers = state.get("active_workers", {})
-                    self.last_reward_times = state.get("last_reward_times", {})
-                    raw_db = state.get("websites_db", {})
-                    self.websites_db = {url: {k: Decimal(v) if k in ['views_funded', 'views_completed'] else v for k, v in data.items()} for url, data in raw_db.items()}
-                    self.last_scanned_block = state.get("last_scanned_block", -1)
-                    raw_p2p = state.get("p2p_orders", {})
-                    self.p2p_orders = {oid: {k: Decimal(v) if k == 'sok_amount' else v for k, v in data.items()} for oid, data in raw_p2p.items()}
-                    self.public_key_cache = state.get("public_key_cache", {})
-                    raw_stake = state.get("staking_records", {})
-                    self.staking_records = {addr: {k: Decimal(v) if k in ['principal', 'reward'] else v for k, v in data.items()} for addr, data in raw_stake.items()}
-                    self.treasury_value_usd = Decimal(state.get('treasury_value_usd', str(ECON_INITIAL_TREASURY_USD)))
-                    logging.info(f"Đã khôi phục trạng thái: {len(self.active_workers)} worker, {len(self.websites_db)} website, Quỹ=${float(self.treasury_value_usd):.2f}")
-            except Exception as e: logging.error(f"Không thể tải tệp trạng thái: {e}")
+                with open(STATE_FILE, 'r', encoding='utf-8') as f: state = json.load(f)
+            except Exception as e: logging.error(f"Không thể đọc tệp trạng thái cũ để chuyển đổi: {e}")
+        for domain in STATE_DOMAINS:
+            rows.extend((domain, key, json.dumps(value, cls=CustomJSONEncoder)) for key, value in state.get(domain, {}).items() if value is not None)
+        rows.extend(("meta", key, json.dumps(state[key], cls=CustomJSONEncoder)) for key in STATE_META_KEYS if key in state)
+        self.state_store.write_batch(rows)
+        if state:
+            os.replace(STATE_FILE, STATE_FILE + ".migrated")
+            logging.info(f"Đã chuyển trạng thái từ '{STATE_FILE}' sang '{STATE_DB_FILE}'.")
 
-    def _save_state(self):
-        with self.state_lock:
-            state = {
-                "active_workers": self.active_workers, "last_reward_times": self.last_reward_times,
-                "websites_db": self.websites_db, "last_scanned_block": self.last_scanned_block,
-                "p2p_orders": self.p2p_orders, "public_key_cache": self.public_key_cache,
-                "staking_records": self.staking_records, "treasury_value_usd": str(self.treasury_value_usd)
-            }
+    def _load_state(self):
         try:
-            with open(STATE_FILE + ".tmp", 'w', encoding='utf-8') as f: json.dump(state, f, indent=2, cls=CustomJSONEncoder)
-            os.replace(STATE_FILE + ".tmp", STATE_FILE)
-            logging.info("Đã lưu trạng thái vào file.")
-        except Exception as e: logging.error(f"Lỗi khi lưu trạng thái: {e}")
+            self.state_store = PrimeStateStore(STATE_DB_FILE)
+            if self.state_store.get("meta", "schema_version") is None: self._migrate_json_state()
+            meta = self.state_store.load("meta")
+            with self.commit_lock:
+                for domain in STATE_DOMAINS:
+                    if domain in STATE_LAZY_DOMAINS: continue
+                    setattr(self, domain, {key: self._decode_state(domain, value) for key, value in self.state_store.load(domain).items()})
+                with self.rewards_lock:
+                    # Khoản trả thưởng còn chờ xác nhận trên chuỗi không được đưa vào lô mới (tránh ký giao dịch thứ hai)
+                    self.payouts_in_flight = {e["ref"]: e["amount"] for e in self.unconfirmed_txs.values() if e["kind"] == "payout"}
+                with self.staking_lock:
+                    self.claims_in_flight = {e["ref"]: e["amount"] for e in self.unconfirmed_txs.values() if e["kind"] == "stake_claim"}
+                with self.workers_lock:
+                    loaded_workers, self.active_workers = self.active_workers, self.worker_registry.records
+                    for address, record in loaded_workers.items(): self.worker_registry.touch(address, record)
+                with self.websites_lock:
+                    for url, data in self.websites_db.items():
+                        self.sites_by_owner.setdefault(data.get("owner"), {})[url] = None
+                        self._reindex_site(url)
+                with self.orders_lock:
+                    closed = [o for o in self.p2p_orders.values() if o['status'] in P2P_ARCHIVED_STATUSES]
+                    for order in closed: del self.p2p_orders[order['id']]
+                    for order in self.p2p_orders.values(): self._index_order(order)
+                if closed:
+                    self.state_store.archive_orders(closed)
+                    logging.info(f"Đã chuyển {len(closed)} lệnh P2P đã đóng sang kho lưu trữ.")
+                self.last_scanned_block = meta.get("last_scanned_block", -1)
+                if "pubkey_backfill_target" in meta:
+                    self.pubkey_backfill_block, self.pubkey_backfill_target = meta["pubkey_backfill_block"], meta["pubkey_backfill_target"]
+                else:
+                    # Trạng thái cũ: cache public key có thể chứa kết quả "không tìm thấy" (null), và mọi khối đã quét chưa được lập chỉ mục
+                    purged = self.state_store.purge_null_rows("public_key_cache")
+                    if purged: logging.info(f"Đã xóa {purged} bản ghi public key rỗng từ trạng thái cũ.")
+                    self.pubkey_backfill_block, self.pubkey_backfill_target = -1, self.last_scanned_block
+                    self._mark_dirty("meta", "pubkey_backfill_block", "pubkey_backfill_target")
+                self.treasury_value_usd = Decimal(str(meta.get("treasury_value_usd", ECON_INITIAL_TREASURY_USD)))
+                if "staking_reward_index" in meta:
+                    self.staking_reward_index = Decimal(str(meta["staking_reward_index"])); self.staking_index_updated_at = meta["staking_index_updated_at"]
+                else: self._mark_dirty("meta", "staking_reward_index", "staking_index_updated_at")
+                with self.staking_lock:
+                    for address, record in self.staking_records.items():
+                        if 'reward_index' in record: continue
+                        # Bản ghi kiểu cũ (last_update): chỉ số tại thời điểm cập nhật cuối cho ra đúng phần lãi chưa chốt
+                        record['reward_index'] = self._staking_index(record.pop('last_update'))
+                        self._mark_dirty("staking_records", address)
+                logging.info(f"Đã khôi phục trạng thái: {len(self.active_workers)} worker, {len(self.websites_db)} website, Quỹ=${float(self.treasury_value_usd):.2f}")
+        except Exception as e: logging.error(f"Không thể tải trạng thái: {e}")
+
+    def _reindex_site(self, url: str):
+        """Đồng bộ chỉ mục chọn website sau mỗi lần views_funded đổi. Gọi khi đang giữ websites_lock."""
+        data = self.websites_db.get(url)
+        views_left = int(data.get("views_funded", 0)) if data else 0
+        self.funded_index.set(url, views_left if WEBSITE_SELECTION_WEIGHTED else min(views_left, 1))
+
+    def add_site(self, url: str, owner_address: str) -> bool:
+        with self.websites_lock:
+            if url in self.websites_db: return False
+            self.websites_db[url] = {"owner": owner_address, "views_funded": Decimal('0'), "views_completed": Decimal('0')}
+            self.sites_by_owner.setdefault(owner_address, {})[url] = None
+        self._mark_dirty("websites_db", url)
+        return True
+
+    def remove_site(self, url: str):
+        """Gọi khi đang giữ websites_lock."""
+        owner = self.websites_db.pop(url).get("owner")
+        owner_sites = self.sites_by_owner.get(owner, {})
+        owner_sites.pop(url, None)
+        if not owner_sites: self.sites_by_owner.pop(owner, None)
+        self._reindex_site(url); self._mark_dirty("websites_db", url)
+
+    def _index_order(self, order: Dict):
+        """Đưa lệnh vào các chỉ mục phụ theo trạng thái hiện tại. Gọi khi đang giữ orders_lock."""
+        self.orders_by_key.setdefault((order['seller_address'], order['sok_amount'], order['status']), {})[order['id']] = None
+        for address in (order['seller_address'], order.get('buyer_address')):
+            if address: self.orders_by_address.setdefault(address, {})[order['id']] = None
+        if order['status'] == 'OPEN':
+            bisect.insort(self.open_order_book, (order['created_at'], order['id'])); self.open_escrow_total += order['sok_amount']
+
+    def _unindex_order(self, order: Dict):
+        key = (order['seller_address'], order['sok_amount'], order['status'])
+        bucket = self.orders_by_key.get(key, {})
+        bucket.pop(order['id'], None)
+        if not bucket: self.orders_by_key.pop(key, None)
+        if order['status'] == 'OPEN':
+            entry = (order['created_at'], order['id'])
+            pos = bisect.bisect_left(self.open_order_book, entry)
+            if pos < len(self.open_order_book) and self.open_order_book[pos] == entry:
+                del self.open_order_book[pos]; self.open_escrow_total -= order['sok_amount']
+
+    def _set_order_status(self, order: Dict, status: str, **fields):
+        """Đổi trạng thái lệnh và cập nhật chỉ mục. Gọi khi đang giữ orders_lock."""
+        self._unindex_order(order)
+        order.update(fields, status=status)
+        self._index_order(order)
+        self._mark_dirty("p2p_orders", order['id'])
+
+    def _retire_order(self, order: Dict):
+        """Gỡ lệnh đã đóng khỏi sổ lệnh sống và mọi chỉ mục. Gọi khi đang giữ orders_lock; sau đó gọi _archive_orders."""
+        self._unindex_order(order)
+        self.p2p_orders.pop(order['id'], None)
+        for address in (order['seller_address'], order.get('buyer_address')):
+            address_orders = self.orders_by_address.get(address)
+            if address_orders is None: continue
+            address_orders.pop(order['id'], None)
+            if not address_orders: del self.orders_by_address[address]
+
+    def _archive_orders(self, orders: List[Dict]):
+        if not self.state_store: return
+        try: self.state_store.archive_orders(orders)
+        except sqlite3.Error as e:
+            logging.error(f"Không thể lưu trữ {len(orders)} lệnh P2P: {e}")
+            self._mark_dirty("p2p_orders", *(o['id'] for o in orders)) # Lệnh đã rời bộ nhớ: ít nhất xóa khỏi bảng lệnh sống
+
+    def list_open_orders(self, offset: int, limit: int):
+        with self.orders_lock:
+            page = self.open_order_book[offset:offset + limit]
+            return [dict(self.p2p_orders[order_id]) for _, order_id in page], len(self.open_order_book)
+
+    def list_orders_for_address(self, address: str, offset: int, limit: int):
+        with self.orders_lock:
+            orders = [self.p2p_orders[order_id] for order_id in self.orders_by_address.get(address, {})]
+            orders.sort(key=lambda o: o['created_at'], reverse=True)
+            return [dict(o) for o in orders[offset:offset + limit]], len(orders)
+
+    def list_sites_for_owner(self, owner_address: str, offset: int, limit: int):
+        with self.websites_lock:
+            urls = list(self.sites_by_owner.get(owner_address, {}))
+            return [{"url": url, "info": dict(self.websites_db[url])} for url in urls[offset:offset + limit]], len(urls)
+
+    def _mark_dirty(self, domain: str, *keys: str):
+        """Đánh dấu bản ghi vừa đổi; nhiều lần đổi cùng key trong một chu kỳ chỉ ghi một lần. domain='meta' cho thuộc tính đơn."""
+        with self._dirty_lock: self._dirty_state.update((domain, key) for key in keys)
+
+    def _save_state(self):
+        """Ghi các bản ghi đã đổi trong một giao dịch; chi phí tỉ lệ với số thay đổi, không phải tổng trạng thái."""
+        with self._dirty_lock: dirty, self._dirty_state = self._dirty_state, set()
+        if not dirty or not self.state_store: return
+        by_domain = {}
+        for domain, key in dirty: by_domain.setdefault(domain, []).append(key)
+        rows = []
+        with self.commit_lock:
+            for domain, keys in by_domain.items():
+                with self.domain_locks[domain]:
+                    for key in keys:
+                        value = getattr(self, key) if domain == "meta" else getattr(self, domain).get(key)
+                        rows.append((domain, key, None if value is None else json.dumps(value, cls=CustomJSONEncoder)))
+        try: self.state_store.write_batch(rows)
+        except sqlite3.Error as e:
+            logging.error(f"Lỗi khi lưu trạng thái: {e}")
+            with self._dirty_lock: self._dirty_state |= dirty
+
+    def lock_stats(self) -> Dict:
+        locks = {lock.name: lock for lock in list(self.domain_locks.values()) + [self.commit_lock]}
+        return {name: lock.stats() for name, lock in locks.items()}
 
     # --- Các luồng nền giữ nguyên ---
     def start_background_threads(self):
@@ -165,157 +662,479 @@ class PrimeAgentLogic:
             threading.Thread(target=self.payment_loop, name="Worker-Payer", daemon=True),
             threading.Thread(target=self.cleanup_workers_loop, name="Cleaner", daemon=True),
             threading.Thread(target=self.funding_scanner_loop, name="Funding-Scanner", daemon=True),
-            threading.Thread(target=self.periodic_save_loop, name="State-Saver", daemon=True),
-            threading.Thread(target=self._calculate_rewards_loop, name="Staking-Rewarder", daemon=True),
-            threading.Thread(target=self._econ_cycle_loop, name="Economist-Agent", daemon=True)
+            threading.Thread(target=self.periodic_save_loop, name="State-Writer", daemon=True),
+            threading.Thread(target=self._econ_cycle_loop, name="Economist-Agent", daemon=True),
+            threading.Thread(target=self._econ_chart_loop, name="Chart-Renderer", daemon=True),
+            threading.Thread(target=self.dashboard_metrics_loop, name="Metrics", daemon=True)
         ]
         for t in threads: t.start()
 
     def periodic_save_loop(self):
         logging.info("Luồng Lưu trạng thái định kỳ đã bắt đầu.")
         while self.is_running.is_set():
-            time.sleep(SAVE_STATE_INTERVAL)
+            time.sleep(STATE_FLUSH_INTERVAL)
             self._save_state()
 
+    def _load_known_nodes(self) -> List[str]:
+        nodes = set([BLOCKCHAIN_NODE_URL])
+        for config_file in [LIVE_NETWORK_CONFIG_FILE, BOOTSTRAP_CONFIG_FILE]:
+            if os.path.exists(config_file):
+                try:
+                    with open(config_file, 'r', encoding='utf-8') as f: data = json.load(f)
+                    nodes.update(data.get("active_nodes", []))
+                    if "trusted_bootstrap_peers" in data:
+                        nodes.update([p.get("last_known_address") for p in data["trusted_bootstrap_peers"].values()])
+                except Exception: pass
+        return [n if n.startswith(('http://', 'https://')) else f"http://{n}" for n in filter(None, nodes)]
+
+    def _probe_node(self, node_url: str):
+        """Thăm dò nhẹ: /handshake (node mới trả kèm tip), node cũ thì /chain/stats. Trả về (chiều cao, độ trễ) hoặc None."""
+        started = time.monotonic()
+        try:
+            response = requests.get(f'{node_url}/handshake', timeout=NODE_HEALTH_CHECK_TIMEOUT)
+            height = (response.json().get('tip') or {}).get('height') if response.status_code == 200 else None
+            if height is None:
+                response = requests.get(f'{node_url}/chain/stats', timeout=NODE_HEALTH_CHECK_TIMEOUT)
+                if response.status_code != 200: return None
+                height = response.json().get('block_height')
+            return (int(height), time.monotonic() - started) if height is not None else None
+        except (requests.RequestException, ValueError, TypeError, AttributeError): return None
+
+    def _record_node_result(self, node_url: str, ok: bool, latency: float = None, height: int = None):
+        alpha = float(NODE_EWMA_ALPHA)
+        with self.node_lock:
+            stats = self.node_stats.setdefault(node_url, {"latency": latency or NODE_HEALTH_CHECK_TIMEOUT, "errors": 0.0, "height": None, "down_until": 0})
+            stats["errors"] = (1 - alpha) * stats["errors"] + alpha * (0.0 if ok else 1.0)
+            if ok:
+                stats["down_until"] = 0
+                if latency is not None: stats["latency"] = (1 - alpha) * stats["latency"] + alpha * latency
+                if height is not None: stats["height"] = height
+            else:
+                stats["down_until"] = time.time() + NODE_PROBE_INTERVAL
+
+    def _select_best_node(self):
+        """Chọn trong các node khỏe ở chiều cao lớn nhất, ngẫu nhiên có trọng số 1/độ trễ."""
+        now = time.time()
+        with self.node_lock:
+            healthy = {url: s for url, s in self.node_stats.items() if s["height"] is not None and s["errors"] < NODE_MAX_ERROR_RATE and s["down_until"] <= now}
+        current = self.current_best_node
+        if not healthy:
+            if current: logging.error("Mất kết nối với tất cả các node.")
+            self.current_best_node = None; return
+        max_height = max(s["height"] for s in healthy.values())
+        candidates = {url: s for url, s in healthy.items() if s["height"] == max_height}
+        fastest = min(s["latency"] for s in candidates.values())
+        if current in candidates and candidates[current]["latency"] <= fastest * NODE_SWITCH_LATENCY_RATIO: return
+        urls = list(candidates)
+        best = random.choices(urls, weights=[1 / max(candidates[u]["latency"], 0.001) for u in urls])[0]
+        logging.info(f"✅ Node tốt nhất mới: {best} (Block: {max_height}, độ trễ ~{candidates[best]['latency'] * 1000:.0f} ms)")
+        self.current_best_node = best
+
+    def _report_node_failure(self, node_url: str):
+        self._record_node_result(node_url, False)
+        if node_url == self.current_best_node:
+            logging.warning(f"Node {node_url} vừa lỗi. Đang chuyển sang node khác...")
+            self._select_best_node()
+
+    def _node_call(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Gọi node hiện tại; lỗi kết nối/5xx thì ghi nhận và chuyển node. Chỉ GET (idempotent) được thử lại ngay trên node khác:
+        POST giao dịch có thể đã được node đầu nhận, nên chỉ gửi một lần và để _send_signed_tx xác nhận trên chuỗi.
+        """
+        last_error = None
+        for _ in range(2 if method.upper() == 'GET' else 1):
+            node = self.current_best_node or BLOCKCHAIN_NODE_URL
+            try:
+                response = requests.request(method, f"{node}{path}", **kwargs)
+                if response.status_code >= 500: raise requests.HTTPError(f"Node {node} trả về lỗi {response.status_code}", response=response)
+            except requests.RequestException as e:
+                last_error = e; self._report_node_failure(node); continue
+            self._record_node_result(node, True)
+            return response
+        raise last_error
+
     def find_best_node_loop(self):
         logging.info("Luồng Tìm kiếm Node đã bắt đầu.")
+        with ThreadPoolExecutor(max_workers=NODE_PROBE_WORKERS, thread_name_prefix="Node-Probe") as executor:
+            while self.is_running.is_set():
+                known_nodes = self._load_known_nodes()
+                if not known_nodes:
+                    logging.warning("Không có node nào trong cấu hình để quét."); time.sleep(60); continue
+                for node_url, result in zip(known_nodes, executor.map(self._probe_node, known_nodes)):
+                    if result: self._record_node_result(node_url, True, latency=result[1], height=result[0])
+                    else: self._record_node_result(node_url, False)
+                with self.node_lock:
+                    for stale in set(self.node_stats) - set(known_nodes): del self.node_stats[stale]
+                self._select_best_node()
+                time.sleep(NODE_PROBE_INTERVAL)
+
+    def chain_length(self) -> int:
+        """Độ dài chuỗi theo lần thăm dò gần nhất của node hiện tại (không gọi mạng); -1 nếu chưa biết."""
+        with self.node_lock: height = (self.node_stats.get(self.current_best_node) or {}).get("height")
+        return height + 1 if height is not None else -1
+
+    def refresh_dashboard_snapshot(self) -> Dict:
+        with self.workers_lock: workers_by_type = self.worker_registry.type_counts()
+        # len() là nguyên tử, không cần khóa
+        snapshot = {
+            "active_workers": len(self.active_workers), "total_websites": len(self.websites_db),
+            "views_completed_session": self.total_views_completed_session, "blockchain_height": self.chain_length(),
+            "status": "Online" if self.current_best_node else "Connecting...",
+            "open_p2p_orders": len(self.open_order_book), "total_stakers": len(self.staking_records), "workers_by_type": workers_by_type,
+            "generated_at": time.time()
+        }
+        self.dashboard_snapshot = snapshot
+        return snapshot
+
+    def get_dashboard_snapshot(self) -> Dict:
+        snapshot = self.dashboard_snapshot
+        if snapshot is None or time.time() - snapshot["generated_at"] > DASHBOARD_MAX_STALENESS: snapshot = self.refresh_dashboard_snapshot()
+        return snapshot
+
+    def dashboard_metrics_loop(self):
+        logging.info("Luồng Tổng hợp số liệu dashboard đã bắt đầu.")
         while self.is_running.is_set():
-            nodes = set([BLOCKCHAIN_NODE_URL])
-            for config_file in [LIVE_NETWORK_CONFIG_FILE, BOOTSTRAP_CONFIG_FILE]:
-                if os.path.exists(config_file):
-                    try:
-                        with open(config_file, 'r', encoding='utf-8') as f: data = json.load(f)
-                        nodes.update(data.get("active_nodes", []))
-                        if "trusted_bootstrap_peers" in data:
-                            nodes.update([p.get("last_known_address") for p in data["trusted_bootstrap_peers"].values()])
-                    except Exception: pass
-            known_nodes = list(filter(None, nodes))
-            if not known_nodes:
-                logging.warning("Không có node nào trong cấu hình để quét."); time.sleep(60); continue
-            healthy_nodes = []
-            for node_url in known_nodes:
-                try:
-                    response = requests.get(f'{node_url}/chain', timeout=NODE_HEALTH_CHECK_TIMEOUT)
-                    if response.status_code == 200: healthy_nodes.append({"url": node_url, "block_height": response.json().get('length', -1)})
-                except: pass
-            with self.state_lock:
-                if healthy_nodes:
-                    best_node = max(healthy_nodes, key=lambda x: x['block_height'])
-                    if self.current_best_node != best_node['url']:
-                        logging.info(f"✅ Node tốt nhất mới: {best_node['url']} (Block: {best_node['block_height']})")
-                        self.current_best_node = best_node['url']
-                else:
-                    if self.current_best_node: logging.error("Mất kết nối với tất cả các node.")
-                    self.current_best_node = None
-            time.sleep(120)
+            try: self.refresh_dashboard_snapshot()
+            except Exception as e: logging.error(f"Lỗi khi làm mới số liệu dashboard: {e}")
+            time.sleep(DASHBOARD_REFRESH_INTERVAL)
+
+    def credit_reward(self, worker_address: str, amount: Decimal = REWARD_AMOUNT):
+        """Ghi nợ thưởng vào sổ cái; thưởng phát sinh trong thời gian chờ được cộng dồn, không bị bỏ."""
+        with self.rewards_lock:
+            self.pending_rewards[worker_address] = self.pending_rewards.get(worker_address, Decimal('0')) + amount
+            self._mark_dirty("pending_rewards", worker_address)
+
+    def _sign_payout(self, worker_address: str, amount: Decimal) -> dict:
+        tx = Transaction(self.wallet.get_public_key_pem(), worker_address, float(amount), sender_address=self.wallet.get_address())
+        tx.sign(self.wallet.private_key)
+        return tx.to_dict()
+
+    @staticmethod
+    def _tx_key(tx_data: dict) -> str:
+        """Khóa băm giống cách node chống trùng giao dịch (bỏ chữ ký và địa chỉ người gửi)."""
+        return hash_data({k: v for k, v in tx_data.items() if k not in ('signature', 'sender_address')})
+
+    def _post_tx(self, tx_data: dict) -> Optional[bool]:
+        """True: node nhận; False: node từ chối rõ ràng; None: không chắc (timeout/5xx/node báo đã có) — có thể đã vào mempool."""
+        try: response = self._node_call('POST', '/transactions/new', json=tx_data, timeout=10)
+        except requests.RequestException: return None
+        if response.status_code == 201:
+            with self.tx_lock: self.unmined_outgoing[self._tx_key(tx_data)] = (tx_data.get('sender_address'), Decimal(str(tx_data.get('amount', 0))), time.time())
+            return True
+        try: rejected = response.status_code == 400 and 'error' in response.json()
+        except ValueError: rejected = False
+        return False if rejected else None
+
+    def _send_signed_tx(self, tx_data: dict, kind: str, ref: str, amount: Decimal, **extra) -> Optional[bool]:
+        """
+        Ghi sổ giao dịch (ghi thẳng xuống DB) TRƯỚC khi gửi, rồi gửi đúng một lần. Kết quả chắc chắn được xử lý ngay qua _resolve_tx;
+        kết quả không chắc (None) để lại trong sổ, scanner xác nhận khi thấy nó trên chuỗi, quá hạn thì gửi lại đúng giao dịch đó.
+        """
+        key = self._tx_key(tx_data)
+        entry = {"tx": tx_data, "kind": kind, "ref": ref, "amount": amount, "submitted_at": time.time(), **extra}
+        with self.tx_lock: self.unconfirmed_txs[key] = entry
+        try:
+            if self.state_store: self.state_store.write_batch([("unconfirmed_txs", key, json.dumps(entry, cls=CustomJSONEncoder))])
+        except sqlite3.Error:
+            with self.tx_lock: self.unconfirmed_txs.pop(key, None) # Không ghi sổ được thì không gửi
+            raise
+        outcome = self._post_tx(tx_data)
+        if outcome is None: logging.warning(f"Chưa rõ node đã nhận giao dịch {kind} cho {ref[:10]}... hay chưa. Chờ xác nhận trên chuỗi.")
+        else: self._resolve_tx(key, outcome)
+        return outcome
+
+    def _resolve_tx(self, key: str, confirmed: bool):
+        """Hoàn tất (giao dịch đã được nhận/lên chuỗi) hoặc hoàn tác (bị từ chối) thao tác gắn với giao dịch trong sổ."""
+        with self.tx_lock:
+            entry = self.unconfirmed_txs.pop(key, None)
+            if entry is None: return
+            self._mark_dirty("unconfirmed_txs", key)
+        kind, ref, amount = entry["kind"], entry["ref"], entry["amount"]
+        if kind == "payout": self._finish_payout(ref, amount, confirmed)
+        elif kind == "p2p_release":
+            with self.orders_lock:
+                order = self.p2p_orders.get(ref)
+                if not order or order['status'] != 'RELEASING': return
+                if confirmed: self._set_order_status(order, 'COMPLETED', closed_at=time.time()); self._retire_order(order)
+                else: self._set_order_status(order, 'PENDING_PAYMENT')
+            if confirmed: self._archive_orders([order])
+        elif kind == "stake_claim":
+            # Phần rút đã được tách khỏi bản ghi khi đặt chỗ: xác nhận thì chỉ bỏ đặt chỗ, bị từ chối thì cộng trả lại
+            with self.staking_lock:
+                self.claims_in_flight.pop(ref, None)
+                if not confirmed: self._restore_stake_claim(ref, entry["principal"], amount - entry["principal"])
+
+    def _has_unconfirmed_tx(self, kind: str, ref: str) -> bool:
+        with self.tx_lock: return any(e["kind"] == kind and e["ref"] == ref for e in self.unconfirmed_txs.values())
+
+    def _confirmed_tx_keys(self, blocks: List[Dict]) -> List[str]:
+        """Các giao dịch trong sổ chờ đã xuất hiện trong các khối này; đồng thời bỏ các giao dịch đã gửi nay đã được đào."""
+        with self.tx_lock:
+            if not self.unconfirmed_txs and not self.unmined_outgoing: return []
+        keys = []
+        for block in blocks:
+            txs = json.loads(block.get('transactions', '[]')) if isinstance(block.get('transactions'), str) else block.get('transactions', [])
+            keys.extend(map(self._tx_key, txs))
+        with self.tx_lock:
+            for key in keys: self.unmined_outgoing.pop(key, None)
+            return [key for key in keys if key in self.unconfirmed_txs]
+
+    def _outgoing_reserved(self, sender_address: str) -> Decimal:
+        """Tổng các khoản đã gửi (hoặc chưa rõ đã gửi) từ ví này mà chưa nằm trong khối nào."""
+        with self.tx_lock:
+            unmined = sum((amount for sender, amount, _ in self.unmined_outgoing.values() if sender == sender_address), Decimal('0'))
+            in_doubt = sum((Decimal(str(e["tx"].get("amount", 0))) for e in self.unconfirmed_txs.values() if e["tx"].get("sender_address") == sender_address), Decimal('0'))
+        return unmined + in_doubt
+
+    def _recheck_unconfirmed_txs(self):
+        """Giao dịch chờ quá TX_CONFIRM_TIMEOUT_SECONDS mà scanner đã quét tới đỉnh vẫn không thấy: gửi lại CHÍNH giao dịch đó (cùng hash)."""
+        chain_length = self.chain_length()
+        with self.state_lock: scanned = self.last_scanned_block
+        if chain_length < 0 or scanned < chain_length - 1: return
+        cutoff = time.time() - TX_CONFIRM_TIMEOUT_SECONDS
+        with self.tx_lock:
+            stale = [(key, entry) for key, entry in self.unconfirmed_txs.items() if entry["submitted_at"] < cutoff]
+            # Đã nhận nhưng quá hạn vẫn chưa lên chuỗi (bị loại khỏi mempool): thôi giữ chỗ số dư cho chúng
+            dropped = [key for key, (_, _, sent_at) in self.unmined_outgoing.items() if sent_at < cutoff]
+            for key in dropped: del self.unmined_outgoing[key]
+        if dropped: logging.warning(f"{len(dropped)} giao dịch đã được node nhận nhưng không lên chuỗi sau {TX_CONFIRM_TIMEOUT_SECONDS}s.")
+        for key, entry in stale:
+            outcome = self._post_tx(entry["tx"])
+            if outcome is None:
+                with self.tx_lock:
+                    if key in self.unconfirmed_txs: self.unconfirmed_txs[key] = {**entry, "submitted_at": time.time()}; self._mark_dirty("unconfirmed_txs", key)
+            else: self._resolve_tx(key, outcome)
+            logging.info(f"Đã gửi lại giao dịch {entry['kind']} chưa xác nhận cho {entry['ref'][:10]}... (kết quả: {outcome}).")
+
+    def _submit_payout(self, worker_address: str, amount: Decimal, tx_data: dict) -> Optional[bool]:
+        return self._send_signed_tx(tx_data, "payout", worker_address, amount)
+
+    def _finish_payout(self, worker_address: str, amount: Decimal, ok: bool):
+        with self.rewards_lock:
+            self.payouts_in_flight.pop(worker_address, None)
+            if not ok: return
+            remaining = self.pending_rewards.get(worker_address, Decimal('0')) - amount
+            if remaining > 0: self.pending_rewards[worker_address] = remaining
+            else: self.pending_rewards.pop(worker_address, None)
+            self.last_reward_times[worker_address] = time.time()
+            self._mark_dirty("pending_rewards", worker_address); self._mark_dirty("last_reward_times", worker_address)
+
+    def _settle_payout_batch(self, sign_pool: ThreadPoolExecutor, submit_pool: ThreadPoolExecutor):
+        now = time.time()
+        with self.rewards_lock:
+            due = [(addr, amount) for addr, amount in self.pending_rewards.items()
+                   if addr not in self.payouts_in_flight and now - self.last_reward_times.get(addr, 0) >= PAYMENT_COOLDOWN_SECONDS][:PAYOUT_BATCH_SIZE]
+        if not due: return
+        # Không chi vượt số dư kho bạc: phần còn lại nằm chờ trong sổ cái tới lô sau.
+        # /balance chỉ tính khối đã đào, nên trừ các khoản đã gửi từ ví này (trả thưởng, giải ngân P2P) chưa lên chuỗi
+        response = self._node_call('GET', f"/balance/{self.wallet.get_address()}", timeout=5)
+        if response.status_code != 200:
+            logging.warning(f"Không lấy được số dư kho bạc (HTTP {response.status_code}), hoãn lô trả thưởng."); return
+        treasury_balance = Decimal(str(response.json().get("balance", 0))) - self._outgoing_reserved(self.wallet.get_address())
+        batch, total = [], Decimal('0')
+        for addr, amount in due:
+            if total + amount > treasury_balance: break
+            batch.append((addr, amount)); total += amount
+        if not batch:
+            logging.warning(f"Kho bạc không đủ số dư để trả {len(due)} khoản thưởng đang chờ."); return
+        with self.rewards_lock:
+            for addr, amount in batch: self.payouts_in_flight[addr] = amount
+        sign_futures = {sign_pool.submit(self._sign_payout, addr, amount): (addr, amount) for addr, amount in batch}
+        submit_futures = {}
+        for future in as_completed(sign_futures):
+            addr, amount = sign_futures[future]
+            try: submit_futures[submit_pool.submit(self._submit_payout, addr, amount, future.result())] = (addr, amount)
+            except Exception as e:
+                logging.error(f"Không thể ký giao dịch trả thưởng cho {addr[:10]}...: {e}"); self._finish_payout(addr, amount, False)
+        settled = Decimal('0'); failed = in_doubt = 0
+        for future in as_completed(submit_futures):
+            addr, amount = submit_futures[future]
+            try: ok = future.result()
+            except Exception:
+                ok = False; self._finish_payout(addr, amount, False) # Lỗi trước khi gửi (ghi sổ thất bại): chưa có gì lên node
+            if ok: settled += amount
+            elif ok is None: in_doubt += 1 # Vẫn nằm trong payouts_in_flight tới khi xác nhận trên chuỗi
+            else: failed += 1
+        logging.info(f"🚀 Lô trả thưởng: {len(batch) - failed - in_doubt}/{len(batch)} worker, tổng {float(settled):.8f} SOK."
+                     + (f" {failed} khoản sẽ thử lại ở lô sau." if failed else "") + (f" {in_doubt} khoản chờ xác nhận trên chuỗi." if in_doubt else ""))
 
     def payment_loop(self):
         logging.info("Luồng Trả thưởng đã bắt đầu.")
-        while self.is_running.is_set():
-            worker_address = None
-            try:
-                worker_address = self.reward_queue.get(timeout=1)
-                with self.state_lock:
-                    last_paid = self.last_reward_times.get(worker_address, 0)
-                    node = self.current_best_node
-                if time.time() - last_paid < PAYMENT_COOLDOWN_SECONDS: continue
-                if not node:
-                    self.reward_queue.put(worker_address); time.sleep(10); continue
-                tx = Transaction(self.wallet.get_public_key_pem(), worker_address, float(REWARD_AMOUNT), sender_address=self.wallet.get_address())
-                tx.sign(self.wallet.private_key)
-                response = requests.post(f"{node}/transactions/new", json=tx.to_dict(), timeout=10)
-                if response.status_code == 201:
-                    logging.info(f"🚀 Giao dịch trả thưởng {float(REWARD_AMOUNT):.8f} SOK cho {worker_address[:10]}... đã được gửi!")
-                    with self.state_lock: self.last_reward_times[worker_address] = time.time()
-                else: self.reward_queue.put(worker_address); time.sleep(5)
-            except Empty: continue
-            except Exception as e:
-                logging.error(f"Lỗi luồng trả thưởng: {e}", exc_info=True)
-                if worker_address: self.reward_queue.put(worker_address)
-                time.sleep(10)
+        with ThreadPoolExecutor(max_workers=PAYOUT_SIGN_WORKERS, thread_name_prefix="Payout-Signer") as sign_pool, \
+             ThreadPoolExecutor(max_workers=PAYOUT_SUBMIT_WORKERS, thread_name_prefix="Payout-Sender") as submit_pool:
+            while self.is_running.is_set():
+                try:
+                    if self.current_best_node:
+                        self._recheck_unconfirmed_txs()
+                        self._settle_payout_batch(sign_pool, submit_pool)
+                except Exception as e:
+                    logging.error(f"Lỗi luồng trả thưởng: {e}", exc_info=True)
+                time.sleep(PAYOUT_INTERVAL_SECONDS)
 
     def cleanup_workers_loop(self):
         logging.info("Luồng Dọn dẹp Worker đã bắt đầu.")
         while self.is_running.is_set():
-            with self.state_lock:
-                inactive = [addr for addr, data in self.active_workers.items() if time.time() - data.get("last_seen", 0) > WORKER_TIMEOUT_SECONDS]
-                for addr in inactive:
-                    del self.active_workers[addr]
-                    logging.warning(f"Worker {addr[:10]}... đã offline. Đã xóa.")
-            time.sleep(60)
+            with self.workers_lock: inactive = self.worker_registry.expire(time.time())
+            if inactive:
+                self._mark_dirty("active_workers", *inactive)
+                for addr in inactive[:10]: logging.warning(f"Worker {addr[:10]}... đã offline. Đã xóa.")
+                if len(inactive) > 10: logging.warning(f"... và {len(inactive) - 10} worker khác đã offline.")
+            time.sleep(WORKER_CLEANUP_INTERVAL)
+
+    def record_heartbeats(self, beats: List[tuple]):
+        """beats: [(địa chỉ, bản ghi)] — một lần lấy khóa cho cả lô. Chỉ ghi DB khi worker mới hoặc đổi loại/trạng thái."""
+        changed, new_workers = [], []
+        with self.workers_lock:
+            for address, record in beats:
+                previous = self.worker_registry.touch(address, record)
+                if previous is None: new_workers.append((address, record.get("type")))
+                if previous is None or previous.get("type") != record.get("type") or previous.get("status") != record.get("status"):
+                    changed.append(address)
+        if changed: self._mark_dirty("active_workers", *changed)
+        for address, worker_type in new_workers[:10]: logging.info(f"Worker MỚI ({worker_type}): {address[:10]}...")
+        if len(new_workers) > 10: logging.info(f"... và {len(new_workers) - 10} worker mới khác.")
+
+    def _fetch_blocks_after(self, cursor: int) -> List[Dict]:
+        """Lấy tối đa SCANNER_PAGE_SIZE khối có index > cursor. Node đời cũ không có /chain/blocks thì rơi về /chain."""
+        response = self._node_call('GET', '/chain/blocks', params={"start": cursor + 1, "limit": SCANNER_PAGE_SIZE}, timeout=10)
+        if response.status_code == 404:
+            response = self._node_call('GET', '/chain', timeout=10)
+            response.raise_for_status()
+            return [b for b in response.json().get('chain', []) if b['index'] > cursor]
+        response.raise_for_status()
+        return [b for b in response.json().get('blocks', []) if b['index'] > cursor]
+
+    def _parse_deposits(self, blocks: List[Dict]):
+        """Tách các khoản nạp (stake / ký quỹ P2P / nạp lượt xem) và public key từ các khối, KHÔNG giữ khóa."""
+        p2p_escrow_address = self.wallet.get_address()
+        staking_pool_address = self.staking_pool_wallet.get_address()
+        deposits, public_keys = [], {}
+        for block in sorted(blocks, key=lambda b: b['index']):
+            txs = json.loads(block.get('transactions', '[]')) if isinstance(block.get('transactions'), str) else block.get('transactions', [])
+            for tx in txs:
+                sender, recipient = tx.get('sender_address'), tx.get('recipient_address')
+                if not sender or sender == "0": continue
+                pub_key = tx.get('sender_public_key_pem') or tx.get('sender_public_key')
+                if pub_key: public_keys.setdefault(sender, pub_key)
+                if recipient == staking_pool_address: deposits.append(('stake', sender, Decimal(str(tx.get('amount', '0'))), None))
+                elif recipient == p2p_escrow_address: deposits.append(('escrow', sender, Decimal(str(tx.get('amount', '0'))), tx.get('tx_hash')))
+        return deposits, public_keys
 
     def funding_scanner_loop(self):
         logging.info("Luồng Quét Thanh toán đã bắt đầu.")
         while self.is_running.is_set():
-            with self.state_lock:
-                node = self.current_best_node
-                last_block = self.last_scanned_block
+            node = self.current_best_node
+            with self.state_lock: cursor = self.last_scanned_block
             if not node: time.sleep(30); continue
             try:
-                response = requests.get(f"{node}/chain", timeout=10)
-                if response.status_code != 200:
-                    logging.warning(f"Scanner: Node {node} trả về lỗi {response.status_code}"); time.sleep(60); continue
-                chain = response.json().get('chain', [])
-            except requests.RequestException as e:
-                logging.error(f"Scanner: Lỗi kết nối đến node: {e}"); time.sleep(60); continue
-            with self.state_lock:
-                p2p_escrow_address = self.wallet.get_address()
-                staking_pool_address = self.staking_pool_wallet.get_address()
-                latest_block_in_chain = last_block
-                for block in chain:
-                    if block['index'] > last_block:
-                        latest_block_in_chain = max(latest_block_in_chain, block['index'])
-                        txs = json.loads(block.get('transactions', '[]')) if isinstance(block.get('transactions'), str) else block.get('transactions', [])
-                        for tx in txs:
-                            sender, recipient = tx.get('sender_address'), tx.get('recipient_address')
-                            if sender and sender != "0" and sender not in self.public_key_cache:
-                                self.public_key_cache[sender] = tx.get('sender_public_key')
-                            amount = Decimal(str(tx.get('amount', '0')))
-                            if recipient == staking_pool_address and sender != "0": self._process_stake_deposit(sender, amount)
-                            elif recipient == p2p_escrow_address and sender != "0":
-                                if not self._check_and_process_p2p_deposit(sender, amount, tx.get('tx_hash')) and amount >= MINIMUM_FUNDING_AMOUNT:
-                                    self.credit_views_to_owner(sender, amount)
-                self.last_scanned_block = latest_block_in_chain
-            time.sleep(60)
+                # Chỉ tải các khối sau con trỏ, từng trang một; phân tích ngoài khóa, áp dụng trong một đoạn găng ngắn
+                while self.is_running.is_set():
+                    blocks = self._fetch_blocks_after(cursor)
+                    if not blocks: break
+                    deposits, public_keys = self._parse_deposits(blocks)
+                    confirmed_txs = self._confirmed_tx_keys(blocks)
+                    new_cursor = max(b['index'] for b in blocks)
+                    self._remember_public_keys(public_keys)
+                    with self.commit_lock:
+                        for key in confirmed_txs: self._resolve_tx(key, True)
+                        for kind, sender, amount, tx_hash in deposits:
+                            if kind == 'stake': self._process_stake_deposit(sender, amount)
+                            elif not self._check_and_process_p2p_deposit(sender, amount, tx_hash) and amount >= MINIMUM_FUNDING_AMOUNT:
+                                self.credit_views_to_owner(sender, amount)
+                        with self.state_lock: self.last_scanned_block = new_cursor; self._mark_dirty("meta", "last_scanned_block")
+                    if deposits: logging.info(f"Scanner: Đã xử lý {len(deposits)} khoản nạp trong các khối #{cursor + 1}-#{new_cursor}.")
+                    cursor = new_cursor
+                    if len(blocks) < SCANNER_PAGE_SIZE: break
+                self._backfill_public_keys()
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logging.error(f"Scanner: Lỗi khi tải khối từ node: {e}")
+            time.sleep(SCANNER_INTERVAL_SECONDS)
+
+    def _backfill_public_keys(self):
+        """Lập chỉ mục public key cho các khối đã quét trước khi có chỉ mục (từ khối gốc), vài trang mỗi vòng, chỉ chạy một lần."""
+        with self.state_lock: cursor, target = self.pubkey_backfill_block, self.pubkey_backfill_target
+        for _ in range(PUBKEY_BACKFILL_PAGES_PER_TICK):
+            if cursor >= target: return
+            blocks = [b for b in self._fetch_blocks_after(cursor) if b['index'] <= target]
+            _, public_keys = self._parse_deposits(blocks)
+            self._remember_public_keys(public_keys)
+            cursor = max((b['index'] for b in blocks), default=target)
+            with self.state_lock: self.pubkey_backfill_block = cursor; self._mark_dirty("meta", "pubkey_backfill_block")
+        if cursor >= target: logging.info(f"Đã lập chỉ mục bù public key tới khối #{target}.")
             
-    def _calculate_rewards_loop(self):
-        logging.info("Luồng tính lãi Staking đã bắt đầu.")
-        while self.is_running.is_set():
-            time.sleep(REWARD_CALCULATION_INTERVAL)
-            with self.state_lock:
-                if not self.staking_records: continue
-                current_time = time.time()
-                for record in self.staking_records.values():
-                    time_diff = Decimal(current_time - record['last_update'])
-                    new_reward = record['principal'] * INTEREST_RATE_PER_SECOND * time_diff
-                    record['reward'] += new_reward
-                    record['last_update'] = current_time
-            logging.info("Hoàn tất chu kỳ tính lãi staking.")
-
     # --- Các hàm logic nghiệp vụ (P2P, Staking, Econ) giữ nguyên ---
-    def _get_public_key_for_address(self, address: str) -> Optional[str]:
+    def _remember_public_keys(self, public_keys: Dict[str, str], persist: bool = True):
+        """Đưa public key vào cache LRU và (nếu là key mới với cache) ghi xuống chỉ mục SQLite."""
+        with self.cache_lock:
+            new_keys = {addr: pem for addr, pem in public_keys.items() if addr not in self.public_key_cache}
+            for addr, pem in public_keys.items():
+                self.public_key_cache[addr] = pem; self.public_key_cache.move_to_end(addr)
+                self.pubkey_misses.pop(addr, None)
+            while len(self.public_key_cache) > PUBKEY_CACHE_SIZE: self.public_key_cache.popitem(last=False)
+        if persist and new_keys and self.state_store:
+            try: self.state_store.write_batch([("public_key_cache", addr, json.dumps(pem)) for addr, pem in new_keys.items()])
+            except sqlite3.Error as e: logging.error(f"Không thể lưu {len(new_keys)} public key: {e}")
+
+    def _lookup_public_key(self, address: str) -> Optional[str]:
+        """
+        Tra chỉ mục SQLite; nếu trượt thì chỉ tải các khối scanner chưa quét (tối đa PUBKEY_FALLBACK_BLOCKS khối gần nhất).
+        Khi việc lập chỉ mục bù chưa xong, chỉ mục chưa phủ các khối cũ nên quét PUBKEY_FALLBACK_BLOCKS khối gần nhất bất kể con trỏ.
+        """
+        stored_key = self.state_store.get("public_key_cache", address) if self.state_store else None
+        if stored_key:
+            self._remember_public_keys({address: stored_key}, persist=False); return stored_key
+        node = self.current_best_node
+        if not node: raise requests.ConnectionError("Chưa có node blockchain khả dụng.")
         with self.state_lock:
-            if address in self.public_key_cache: return self.public_key_cache[address]
-            node = self.current_best_node
-        if not node: return None
-        logging.warning(f"Không tìm thấy public key trong cache cho {address}. Đang quét blockchain...")
+            cursor = self.last_scanned_block if self.pubkey_backfill_block >= self.pubkey_backfill_target else -1
+        with self.node_lock: height = (self.node_stats.get(node) or {}).get("height")
+        if height is not None: cursor = max(cursor, height - PUBKEY_FALLBACK_BLOCKS)
+        if height is not None and cursor >= height: return None
+        logging.warning(f"Không tìm thấy public key trong chỉ mục cho {address}. Đang quét các khối sau #{cursor}...")
+        fetched = 0
+        while fetched < PUBKEY_FALLBACK_BLOCKS:
+            blocks = self._fetch_blocks_after(cursor)
+            if not blocks: break
+            _, public_keys = self._parse_deposits(blocks)
+            self._remember_public_keys(public_keys)
+            if address in public_keys:
+                logging.info(f"Đã tìm thấy và lưu public key cho {address}.")
+                return public_keys[address]
+            fetched += len(blocks); cursor = max(b['index'] for b in blocks)
+            if len(blocks) < SCANNER_PAGE_SIZE: break
+        return None
+
+    def _get_public_key_for_address(self, address: str) -> Optional[str]:
+        # Single-flight: chỉ một luồng tra mỗi địa chỉ đang thiếu, các luồng khác chờ kết quả của nó
+        while True:
+            with self.cache_lock:
+                pub_key = self.public_key_cache.get(address)
+                if pub_key:
+                    self.public_key_cache.move_to_end(address); return pub_key
+                if self.pubkey_misses.get(address, 0) > time.time(): return None
+                flight = self.pubkey_inflight.get(address)
+                if flight is None:
+                    flight = self.pubkey_inflight[address] = threading.Event(); break
+            if not flight.wait(PUBKEY_LOOKUP_TIMEOUT): return None
+            with self.cache_lock:
+                if address not in self.public_key_cache and address not in self.pubkey_misses: return None # Lần tra trước lỗi mạng
+        pub_key, definitive = None, False
         try:
-            chain_len_resp = requests.get(f"{node}/chain", timeout=5).json()
-            start_block = max(0, chain_len_resp.get('length', 0) - 500)
-            response = requests.get(f"{node}/chain?start={start_block}", timeout=10)
-            for block in reversed(response.json().get('chain', [])):
-                txs = json.loads(block.get('transactions', '[]')) if isinstance(block.get('transactions'), str) else block.get('transactions', [])
-                for tx in txs:
-                    if tx.get('sender_address') == address:
-                        pub_key = tx.get('sender_public_key')
-                        with self.state_lock: self.public_key_cache[address] = pub_key
-                        logging.info(f"Đã tìm thấy và cache public key cho {address}.")
-                        return pub_key
+            pub_key = self._lookup_public_key(address); definitive = True
         except Exception as e: logging.error(f"Lỗi khi quét tìm public key cho {address}: {e}")
-        return None
+        finally:
+            with self.cache_lock:
+                if definitive and not pub_key:
+                    now = time.time()
+                    if len(self.pubkey_misses) >= PUBKEY_CACHE_SIZE:
+                        self.pubkey_misses = {a: t for a, t in self.pubkey_misses.items() if t > now}
+                    self.pubkey_misses[address] = now + PUBKEY_NEGATIVE_TTL_SECONDS
+                del self.pubkey_inflight[address]
+            flight.set()
+        return pub_key
 
     def p2p_confirm_fiat_and_release(self, order_id: str, seller_address: str, signature: str):
-        with self.state_lock:
+        with self.orders_lock:
             order = self.p2p_orders.get(order_id)
             if not order: return {"error": "Không tìm thấy lệnh."}, 404
             if order['seller_address'] != seller_address: return {"error": "Địa chỉ không khớp."}, 403
@@ -324,39 +1143,53 @@ class PrimeAgentLogic:
         if not seller_public_key: return {"error": "Không thể xác định khóa công khai."}, 400
         message_to_verify = f"confirm_p2p_{order_id}"
         if not verify_signature(seller_public_key, signature, message_to_verify): return {"error": "Chữ ký không hợp lệ."}, 401
-        with self.state_lock: node = self.current_best_node
-        if not node: return {"error": "Không thể kết nối blockchain."}, 503
-        amount_to_send = order['sok_amount']
+        if not self.current_best_node: return {"error": "Không thể kết nối blockchain."}, 503
+        # Giành quyền giải ngân dưới khóa (RELEASING) trước khi gửi tiền: hai lần xác nhận đồng thời chỉ một lần được trả
+        with self.orders_lock:
+            order = self.p2p_orders.get(order_id)
+            if not order or order['status'] != 'PENDING_PAYMENT': return {"error": "Lệnh đang được giải ngân hoặc đã hoàn tất."}, 409
+            self._set_order_status(order, 'RELEASING')
+            buyer_address, amount_to_send = order['buyer_address'], order['sok_amount']
         fee = amount_to_send * (P2P_FEE_PERCENT / 100)
         final_amount = float(amount_to_send - fee)
         try:
-            tx = Transaction(self.wallet.get_public_key_pem(), order['buyer_address'], final_amount, sender_address=self.wallet.get_address())
+            tx = Transaction(self.wallet.get_public_key_pem(), buyer_address, final_amount, sender_address=self.wallet.get_address())
             tx.sign(self.wallet.private_key)
-            response = requests.post(f"{node}/transactions/new", json=tx.to_dict(), timeout=10)
-            if response.status_code != 201: return {"error": "Lỗi gửi giao dịch."}, 500
-        except Exception as e: return {"error": "Lỗi hệ thống."}, 500
-        with self.state_lock: self.p2p_orders[order_id]['status'] = 'COMPLETED'
+            # Hoàn tất/hoàn tác trạng thái lệnh do _resolve_tx đảm nhận, kể cả khi kết quả chỉ biết được sau khi quét chuỗi
+            outcome = self._send_signed_tx(tx.to_dict(), "p2p_release", order_id, amount_to_send)
+        except Exception as e:
+            with self.orders_lock:
+                order = self.p2p_orders.get(order_id)
+                if order and order['status'] == 'RELEASING': self._set_order_status(order, 'PENDING_PAYMENT')
+            return {"error": "Lỗi hệ thống."}, 500
+        if outcome is False: return {"error": "Lỗi gửi giao dịch."}, 500
+        if outcome is None: return {"message": "Giao dịch giải ngân đã được gửi, đang chờ xác nhận trên chuỗi."}, 202
         logging.info(f"✅ Giao dịch P2P hoàn tất! Đã giải ngân {final_amount:.8f} SOK.")
         return {"message": f"Xác nhận thành công! {final_amount:.8f} SOK đã được chuyển."}, 200
 
     def credit_views_to_owner(self, owner_address: str, amount: Decimal):
         views_to_add = int(amount / PRICE_PER_VIEW)
-        with self.state_lock:
-            target_url = next((url for url, data in self.websites_db.items() if data.get("owner") == owner_address and data.get("views_funded", Decimal('0')) == 0), None)
+        with self.websites_lock:
+            target_url = next((url for url in self.sites_by_owner.get(owner_address, {}) if self.websites_db[url].get("views_funded", Decimal('0')) == 0), None)
             if target_url:
                 self.websites_db[target_url]["views_funded"] += Decimal(views_to_add)
+                self._reindex_site(target_url)
+                self._mark_dirty("websites_db", target_url)
                 logging.info(f"✅ Đã cộng {views_to_add} lượt xem cho {owner_address[:10]}...")
             else:
                 logging.warning(f"Nhận {amount} SOK từ {owner_address[:10]} nhưng không có web chờ thanh toán.")
 
     def _check_and_process_p2p_deposit(self, sender_address, amount, tx_hash):
-        with self.state_lock:
-            for order in self.p2p_orders.values():
-                if order['status'] == 'AWAITING_DEPOSIT' and order['seller_address'] == sender_address and Decimal(order['sok_amount']) == amount:
-                    order['status'] = 'OPEN'; order['tx_hash_proof'] = tx_hash
-                    logging.info(f"💰 Ký quỹ P2P thành công cho lệnh #{order['id'][:8]}.")
-                    return True
-        return False
+        with self.orders_lock:
+            # Decimal('1.5') và Decimal('1.50') bằng nhau và cùng hash nên tra khóa khớp đúng như phép so sánh cũ
+            # Giao dịch không có memo nên khớp theo (người bán, số SOK); p2p_create_order không cho mở hai lệnh chờ ký quỹ trùng cặp này,
+            # còn dữ liệu cũ lỡ có trùng thì lệnh tạo sớm nhất được ký quỹ trước
+            bucket = self.orders_by_key.get((sender_address, amount, 'AWAITING_DEPOSIT'))
+            if not bucket: return False
+            order = min((self.p2p_orders[order_id] for order_id in bucket), key=lambda o: o['created_at'])
+            self._set_order_status(order, 'OPEN', tx_hash_proof=tx_hash)
+        logging.info(f"💰 Ký quỹ P2P thành công cho lệnh #{order['id'][:8]}.")
+        return True
 
     def p2p_create_order(self, seller_address, sok_amount_str, fiat_details):
         try: sok_amount = Decimal(sok_amount_str)
@@ -364,120 +1197,241 @@ class PrimeAgentLogic:
         if sok_amount <= 0: return {"error": "Số SOK phải lớn hơn 0"}, 400
         order_id = str(uuid.uuid4())
         new_order = {"id": order_id, "seller_address": seller_address, "sok_amount": sok_amount, "fiat_details": fiat_details, "status": "AWAITING_DEPOSIT", "buyer_address": None, "created_at": time.time()}
-        with self.state_lock: self.p2p_orders[order_id] = new_order
+        with self.orders_lock:
+            if self.orders_by_key.get((seller_address, sok_amount, 'AWAITING_DEPOSIT')):
+                return {"error": "Bạn đã có một lệnh cùng số SOK đang chờ ký quỹ. Hãy ký quỹ hoặc dùng số SOK khác."}, 409
+            self.p2p_orders[order_id] = new_order; self._index_order(new_order); self._mark_dirty("p2p_orders", order_id)
         logging.info(f"Lệnh P2P #{order_id[:8]} đã được tạo. Chờ ký quỹ.")
         return {"message": "Tạo lệnh thành công.", "order": new_order, "escrow_address": self.wallet.get_address()}, 201
 
     def p2p_accept_order(self, order_id, buyer_address):
-        with self.state_lock:
+        with self.orders_lock:
             order = self.p2p_orders.get(order_id)
             if not order: return {"error": "Không tìm thấy lệnh."}, 404
             if order['status'] != 'OPEN': return {"error": "Lệnh này không có sẵn."}, 409
             if order['seller_address'] == buyer_address: return {"error": "Bạn không thể tự mua lệnh của mình."}, 403
-            order['status'] = 'PENDING_PAYMENT'; order['buyer_address'] = buyer_address
+            self._set_order_status(order, 'PENDING_PAYMENT', buyer_address=buyer_address)
         logging.info(f"Lệnh P2P #{order_id[:8]} đã được chấp nhận bởi {buyer_address[:10]}.")
         return {"message": "Chấp nhận lệnh thành công."}, 200
 
+    def _staking_index(self, at: float = None) -> Decimal:
+        """Giá trị chỉ số thưởng tại thời điểm 'at' (mặc định: bây giờ). O(1), không phụ thuộc số người stake."""
+        at = time.time() if at is None else at
+        return self.staking_reward_index + INTEREST_RATE_PER_SECOND * Decimal(at - self.staking_index_updated_at)
+
+    def _accrued_reward(self, record: Dict, index: Decimal) -> Decimal:
+        return record['reward'] + record['principal'] * (index - record['reward_index'])
+
     def _process_stake_deposit(self, staker_address: str, amount: Decimal):
-        with self.state_lock:
+        with self.staking_lock:
             logging.info(f"💰 STAKE DEPOSIT: Nhận được {amount} SOK từ {staker_address[:15]}...")
-            if staker_address in self.staking_records:
-                record = self.staking_records[staker_address]
-                time_diff = Decimal(time.time() - record['last_update'])
-                new_reward = record['principal'] * INTEREST_RATE_PER_SECOND * time_diff
-                record['reward'] += new_reward; record['principal'] += amount
-                record['last_update'] = time.time()
+            index = self._staking_index()
+            record = self.staking_records.get(staker_address)
+            if record:
+                # Chốt phần lãi của số gốc cũ trước khi cộng gốc mới
+                record['reward'] = self._accrued_reward(record, index); record['principal'] += amount; record['reward_index'] = index
             else:
-                self.staking_records[staker_address] = {"principal": amount, "reward": Decimal('0'), "last_update": time.time()}
+                self.staking_records[staker_address] = {"principal": amount, "reward": Decimal('0'), "reward_index": index}
+            self._mark_dirty("staking_records", staker_address)
 
     def stake_get_info(self):
-        with self.state_lock: node = self.current_best_node
         balance = "0"
-        if node:
+        if self.current_best_node:
             try:
-                response = requests.get(f"{node}/balance/{self.staking_pool_wallet.get_address()}", timeout=5)
+                response = self._node_call('GET', f"/balance/{self.staking_pool_wallet.get_address()}", timeout=5)
                 if response.status_code == 200: balance = response.json().get("balance", "0")
             except: pass
         return {"apr": str(STAKING_APR), "staking_pool_address": self.staking_pool_wallet.get_address(), "total_staked": str(balance)}
         
     def stake_get_user_record(self, address: str):
-        with self.state_lock:
+        with self.staking_lock:
             record = self.staking_records.get(address)
             if not record: return {"principal": "0", "reward": "0"}
-            time_diff = Decimal(time.time() - record['last_update'])
-            latest_reward = record['reward'] + (record['principal'] * INTEREST_RATE_PER_SECOND * time_diff)
-        return {"principal": record['principal'], "reward": latest_reward}
+            principal, latest_reward = record['principal'], self._accrued_reward(record, self._staking_index())
+        return {"principal": principal, "reward": latest_reward}
+
+    def _restore_stake_claim(self, staker_address: str, principal: Decimal, reward: Decimal):
+        """Cộng trả khoản rút không thành vào bản ghi stake (gọi dưới staking_lock); tiền nạp thêm trong lúc chờ vẫn được giữ."""
+        index = self._staking_index()
+        record = self.staking_records.get(staker_address)
+        if record: record['reward'] = self._accrued_reward(record, index) + reward; record['principal'] += principal; record['reward_index'] = index
+        else: self.staking_records[staker_address] = {"principal": principal, "reward": reward, "reward_index": index}
+        self._mark_dirty("staking_records", staker_address)
 
     def stake_claim_rewards(self, staker_address: str, signature: str):
-        with self.state_lock:
-            record = self.staking_records.get(staker_address)
-            if not record: return {"error": "Không tìm thấy khoản stake nào."}, 404
-            time_diff = Decimal(time.time() - record['last_update'])
-            final_reward = record['reward'] + (record['principal'] * INTEREST_RATE_PER_SECOND * time_diff)
-            total_claim_amount = record['principal'] + final_reward
+        with self.staking_lock:
+            if staker_address in self.claims_in_flight: return {"error": "Yêu cầu rút trước đó đang chờ xác nhận trên chuỗi."}, 409
+            if staker_address not in self.staking_records: return {"error": "Không tìm thấy khoản stake nào."}, 404
         pub_key = self._get_public_key_for_address(staker_address)
         if not pub_key: return {"error": "Không tìm thấy khóa công khai."}, 400
         message_to_verify = f"claim_stake_{staker_address}"
         if not verify_signature(pub_key, signature, message_to_verify): return {"error": "Chữ ký không hợp lệ."}, 401
-        with self.state_lock: node = self.current_best_node
-        if not node: return {"error": "Không thể kết nối blockchain."}, 503
+        if not self.current_best_node: return {"error": "Không thể kết nối blockchain."}, 503
+        # Đặt chỗ nguyên tử: tách toàn bộ gốc + lãi khỏi bản ghi trước khi ký, yêu cầu đồng thời thứ hai thấy 409.
+        # Tiền nạp thêm trong lúc chờ tạo bản ghi mới, không bị xóa khi khoản rút này được xác nhận.
+        with self.staking_lock:
+            if staker_address in self.claims_in_flight: return {"error": "Yêu cầu rút trước đó đang chờ xác nhận trên chuỗi."}, 409
+            record = self.staking_records.pop(staker_address, None)
+            if not record: return {"error": "Không tìm thấy khoản stake nào."}, 404
+            self._mark_dirty("staking_records", staker_address)
+            claimed_principal, final_reward = record['principal'], self._accrued_reward(record, self._staking_index())
+            total_claim_amount = claimed_principal + final_reward
+            self.claims_in_flight[staker_address] = total_claim_amount
         try:
             tx = Transaction(self.staking_pool_wallet.get_public_key_pem(), staker_address, float(total_claim_amount), sender_address=self.staking_pool_wallet.get_address())
             tx.sign(self.staking_pool_wallet.private_key)
-            response = requests.post(f"{node}/transactions/new", json=tx.to_dict(), timeout=10)
-            if response.status_code != 201: return {"error": f"Lỗi từ node: {response.text}"}, 500
-        except Exception as e: return {"error": f"Lỗi hệ thống: {e}"}, 500
-        with self.state_lock: del self.staking_records[staker_address]
+            outcome = self._send_signed_tx(tx.to_dict(), "stake_claim", staker_address, total_claim_amount, principal=claimed_principal)
+        except Exception as e:
+            if not self._has_unconfirmed_tx("stake_claim", staker_address): # Chưa gửi gì lên node: trả lại đặt chỗ
+                with self.staking_lock:
+                    self.claims_in_flight.pop(staker_address, None); self._restore_stake_claim(staker_address, claimed_principal, final_reward)
+            return {"error": f"Lỗi hệ thống: {e}"}, 500
+        if outcome is False: return {"error": "Node từ chối giao dịch rút."}, 500
+        if outcome is None: return {"message": "Giao dịch rút đã được gửi, đang chờ xác nhận trên chuỗi."}, 202
         logging.info(f"✅ Đã giải ngân STAKE {float(total_claim_amount):.8f} SOK.")
         return {"message": f"Yêu cầu rút {float(total_claim_amount):.8f} SOK đã được xử lý!"}, 200
 
+    @staticmethod
+    def _econ_decode_sample(sample: Dict) -> Dict:
+        sample = {**sample, "timestamp": float(sample["timestamp"])}
+        for field in ECON_DECIMAL_FIELDS:
+            if field in sample: sample[field] = Decimal(str(sample[field]))
+        return sample
+
+    def _econ_rollup(self, sample: Dict) -> List[tuple]:
+        """Gộp một mẫu vào khung đang mở của từng độ phân giải (khung mới thay nguyên khối). Trả về các dòng cần ghi đè."""
+        values = {field: float(sample.get(field, 0)) for field in ECON_SERIES_FIELDS}
+        rows = []
+        for resolution in ECON_ROLLUP_RETENTION:
+            bucket = sample["timestamp"] // resolution * resolution
+            rollup = self.econ_open_rollups.get(resolution)
+            if rollup and rollup["bucket"] == bucket:
+                rollup = {**rollup, "count": rollup["count"] + 1, "last_ts": sample["timestamp"], "last": values,
+                          "min": {f: min(rollup["min"][f], v) for f, v in values.items()}, "max": {f: max(rollup["max"][f], v) for f, v in values.items()},
+                          "sum": {f: rollup["sum"][f] + v for f, v in values.items()}}
+            else:
+                rollup = {"bucket": bucket, "count": 1, "last_ts": sample["timestamp"], "last": values, "min": values, "max": values, "sum": values}
+            self.econ_open_rollups[resolution] = rollup
+            series = self.econ_chart_series.get(resolution)
+            if series is not None:
+                if series and series[-1]["bucket"] == bucket: series[-1] = rollup
+                else: series.append(rollup)
+            rows.append((resolution, bucket, json.dumps(rollup)))
+        return rows
+
+    def _econ_retention_cutoffs(self, now: float) -> Dict[int, float]:
+        cutoffs = {0: now - ECON_RAW_RETENTION_SECONDS}
+        cutoffs.update({resolution: now - keep for resolution, keep in ECON_ROLLUP_RETENTION.items() if keep})
+        return cutoffs
+
+    def _econ_migrate_json(self):
+        """Nhập lịch sử từ tệp JSON cũ vào chuỗi thời gian SQLite (một lần), rồi đổi tên tệp cũ."""
+        try:
+            with open(ECON_DATA_FILE, 'r', encoding='utf-8') as f: legacy = json.load(f, parse_float=Decimal)
+        except Exception as e:
+            logging.error(f"Agent Kinh tế: Không thể đọc dữ liệu lịch sử cũ: {e}"); return
+        samples, rollups = [], {}
+        for sample in sorted((self._econ_decode_sample(d) for d in legacy), key=lambda d: d["timestamp"]):
+            samples.append((sample["timestamp"], json.dumps(sample, cls=CustomJSONEncoder)))
+            rollups.update({(resolution, bucket): data for resolution, bucket, data in self._econ_rollup(sample)})
+        self.state_store.append_econ(samples, [(r, b, data) for (r, b), data in rollups.items()], self._econ_retention_cutoffs(time.time()))
+        os.replace(ECON_DATA_FILE, ECON_DATA_FILE + ".migrated")
+        logging.info(f"Agent Kinh tế: Đã chuyển {len(samples)} điểm dữ liệu từ '{ECON_DATA_FILE}' sang SQLite.")
+
     def _econ_load_data(self):
-        if not os.path.exists(ECON_DATA_FILE): return
         try:
-            with open(ECON_DATA_FILE, 'r', encoding='utf-8') as f:
-                self.historical_econ_data = json.load(f, parse_float=Decimal)
-                logging.info(f"Agent Kinh tế: Đã tải {len(self.historical_econ_data)} điểm dữ liệu lịch sử.")
+            if not self.state_store.has_econ_samples() and os.path.exists(ECON_DATA_FILE): self._econ_migrate_json()
+            recent = [self._econ_decode_sample(d) for d in self.state_store.recent_econ_samples(ECON_RECENT_POINTS)]
+            with self.state_lock:
+                self.historical_econ_data.extend(recent)
+                for sample in recent: self._econ_append_columns(sample)
+            self.econ_open_rollups = self.state_store.last_econ_rollups()
+            now = time.time()
+            self.econ_chart_series = {resolution: deque(self.state_store.econ_rollups(resolution, start=now - resolution * ECON_CHART_MAX_POINTS), maxlen=ECON_CHART_MAX_POINTS)
+                                      for resolution in ECON_ROLLUP_RETENTION}
+            logging.info(f"Agent Kinh tế: Đã tải {len(recent)} điểm dữ liệu gần nhất.")
         except Exception as e: logging.error(f"Agent Kinh tế: Không thể tải dữ liệu lịch sử: {e}")
 
-    def _econ_save_data(self):
-        try:
-            with open(ECON_DATA_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.historical_econ_data, f, indent=2, cls=CustomJSONEncoder)
-        except IOError as e: logging.error(f"Agent Kinh tế: Không thể lưu dữ liệu: {e}")
+    def _econ_save_data(self, sample: Dict):
+        """Ghi nối một mẫu + ghi đè khung tổng hợp đang mở: chi phí cố định mỗi chu kỳ, không phụ thuộc độ dài lịch sử."""
+        with self.state_lock: self.historical_econ_data.append(sample); self._econ_append_columns(sample)
+        try: self.state_store.append_econ([(sample["timestamp"], json.dumps(sample, cls=CustomJSONEncoder))], self._econ_rollup(sample), self._econ_retention_cutoffs(sample["timestamp"]))
+        except sqlite3.Error as e: logging.error(f"Agent Kinh tế: Không thể lưu dữ liệu: {e}")
+        with self.econ_query_lock: self.econ_query_cache.clear()
+
+    def _econ_append_columns(self, sample: Dict):
+        for column, value in zip(ECON_CHART_COLUMNS, (sample["timestamp"], sample["market_price_usd"], sample["floor_price_usd"], sample.get("treasury_value_usd", 0))):
+            self.econ_columns[column].append(float(value))
+
+    def _econ_query_columns(self, resolution: int, start: float, end: float) -> Dict[str, List[float]]:
+        """Các cột trong [start, end]: độ phân giải 0 đọc bộ đệm vòng trong RAM, còn lại đọc khung tổng hợp (giá trị cuối khung)."""
+        if resolution == 0:
+            with self.state_lock: columns = {column: list(values) for column, values in self.econ_columns.items()}
+            lo, hi = bisect.bisect_left(columns["timestamps"], start), bisect.bisect_right(columns["timestamps"], end)
+            return {column: values[lo:hi] for column, values in columns.items()}
+        rollups = self.state_store.econ_rollups(resolution, start=start // resolution * resolution, end=end)
+        return {"timestamps": [r["last_ts"] for r in rollups], "market_prices": [r["last"]["market_price_usd"] for r in rollups],
+                "floor_prices": [r["last"]["floor_price_usd"] for r in rollups], "treasury_values": [r["last"]["treasury_value_usd"] for r in rollups]}
+
+    def econ_chart_data(self, start: Optional[float], end: Optional[float], points: int) -> bytes:
+        """Chọn nguồn mịn nhất bao được khoảng yêu cầu, giảm mẫu LTTB theo giá thị trường, trả về JSON đã mã hóa (có cache)."""
+        now = time.time()
+        end = now if end is None else end
+        with self.state_lock: oldest_recent = self.econ_columns["timestamps"][0] if self.econ_columns["timestamps"] else now
+        start = oldest_recent if start is None else start
+        resolution = 0 if start >= oldest_recent else next((r for r in sorted(ECON_ROLLUP_RETENTION) if (end - start) / r <= ECON_QUERY_MAX_SOURCE_POINTS
+                                                             and (ECON_ROLLUP_RETENTION[r] is None or now - ECON_ROLLUP_RETENTION[r] <= start + r)), max(ECON_ROLLUP_RETENTION))
+        quantum = resolution or ECON_ANALYSIS_INTERVAL # Làm tròn khoảng để các truy vấn tương đối ("7d") trong cùng chu kỳ dùng chung cache
+        key = (resolution, start // quantum, -(-end // quantum), points)
+        with self.econ_query_lock:
+            body = self.econ_query_cache.get(key)
+            if body is not None: self.econ_query_cache.move_to_end(key); return body
+        columns = self._econ_query_columns(resolution, key[1] * quantum, key[2] * quantum)
+        selected = lttb_indices(columns["timestamps"], columns["market_prices"], points)
+        body = json.dumps({**{column: [values[i] for i in selected] for column, values in columns.items()}, "resolution": resolution}).encode('utf-8')
+        with self.econ_query_lock:
+            self.econ_query_cache[key] = body
+            while len(self.econ_query_cache) > ECON_QUERY_CACHE_SIZE: self.econ_query_cache.popitem(last=False)
+        return body
 
     def _econ_generate_chart(self):
-        if len(self.historical_econ_data) < 2: return
-        try:
-            data_copy = self.historical_econ_data[:]
-            timestamps = [datetime.fromtimestamp(float(d['timestamp'])) for d in data_copy]
-            market_prices = [float(d['market_price_usd']) for d in data_copy]
-            floor_prices = [float(d['floor_price_usd']) for d in data_copy]
-            treasury_values = [float(d.get('treasury_value_usd', 0)) for d in data_copy]
-            fig = go.Figure()
-            fig.add_trace(go.Scatter(x=timestamps, y=floor_prices, mode='lines', name='Giá Sàn (Bảo chứng)', line=dict(color='green', dash='dot')))
-            fig.add_trace(go.Scatter(x=timestamps, y=market_prices, mode='lines+markers', name='Giá Thị trường (Ước tính)', line=dict(color='blue')))
-            fig.add_trace(go.Bar(x=timestamps, y=treasury_values, name='Tổng Quỹ Bảo chứng (USD)', yaxis='y2', marker_color='lightsalmon', opacity=0.6))
-            fig.update_layout(title_text='<b>Mô hình Định giá Bảo chứng & Sức khỏe Mạng lưới Sokchain</b>', yaxis=dict(title='<b>Giá SOK (USD)</b>', type='log'), yaxis2=dict(title='Giá trị Quỹ (USD)', overlaying='y', side='right', showgrid=False), legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01), template='plotly_dark', hovermode='x unified')
-            fig.write_html(ECON_CHART_FILE)
-            logging.info(f"Agent Kinh tế: ✅ Biểu đồ đã được cập nhật.")
-        except Exception as e:
-            logging.error(f"Agent Kinh tế: Lỗi khi tạo biểu đồ: {e}", exc_info=True)
+        """Chọn độ phân giải mịn nhất còn bao trọn lịch sử trong ECON_CHART_MAX_POINTS khung (không thì lấy cửa sổ gần nhất của khung ngày) và giao cho luồng vẽ."""
+        resolutions = sorted(self.econ_chart_series)
+        if not resolutions: return
+        resolution = next((r for r in resolutions if len(self.econ_chart_series[r]) < ECON_CHART_MAX_POINTS), resolutions[-1])
+        window = list(self.econ_chart_series[resolution])
+        if len(window) < 2: return
+        self.chart_pending = {"output": os.path.abspath(ECON_CHART_FILE), "timestamps": [r["last_ts"] for r in window],
+                              "market_prices": [r["last"]["market_price_usd"] for r in window], "floor_prices": [r["last"]["floor_price_usd"] for r in window],
+                              "treasury_values": [r["last"]["treasury_value_usd"] for r in window]}
+        self.chart_ready.set()
+
+    def _econ_chart_loop(self):
+        """Vẽ trong tiến trình con để không chiếm GIL/bộ nhớ của server; lỗi hay treo ở đó không ảnh hưởng Agent Kinh tế."""
+        while self.is_running.is_set():
+            if not self.chart_ready.wait(timeout=5): continue
+            self.chart_ready.clear()
+            payload, self.chart_pending = self.chart_pending, None
+            if payload is None: continue
+            try:
+                result = subprocess.run([sys.executable, ECON_CHART_RENDERER], input=json.dumps(payload), capture_output=True, text=True, encoding='utf-8', timeout=ECON_CHART_RENDER_TIMEOUT)
+                if result.returncode == 0: logging.info(f"Agent Kinh tế: ✅ Biểu đồ đã được cập nhật ({len(payload['timestamps'])} điểm).")
+                else: logging.error(f"Agent Kinh tế: Lỗi khi tạo biểu đồ: {result.stderr.strip()}")
+            except (subprocess.SubprocessError, OSError) as e:
+                logging.error(f"Agent Kinh tế: Lỗi khi tạo biểu đồ: {e}")
 
     def _econ_get_current_metrics(self):
-        with self.state_lock:
-            node = self.current_best_node
-            staking_pool_addr = self.staking_pool_wallet.get_address()
+        node = self.current_best_node
+        staking_pool_addr = self.staking_pool_wallet.get_address()
         staked_balance, blockchain_height = Decimal('0'), 0
         if node:
             try:
-                res = requests.get(f"{node}/balance/{staking_pool_addr}", timeout=5)
+                res = self._node_call('GET', f"/balance/{staking_pool_addr}", timeout=5)
                 if res.ok: staked_balance = Decimal(res.json().get("balance", "0"))
-                res = requests.get(f"{node}/chain", timeout=5)
-                if res.ok: blockchain_height = res.json().get("length", 0)
             except: pass
-        with self.state_lock:
-            total_p2p_escrow = sum(o['sok_amount'] for o in self.p2p_orders.values() if o['status'] == 'OPEN')
-            return {"total_workers": len(self.active_workers), "total_websites": len(self.websites_db), "total_staked_sok": staked_balance, "total_p2p_escrow_sok": total_p2p_escrow, "total_transactions": blockchain_height}
+            blockchain_height = max(self.chain_length(), 0)
+        with self.orders_lock: total_p2p_escrow = self.open_escrow_total
+        return {"total_workers": len(self.active_workers), "total_websites": len(self.websites_db), "total_staked_sok": staked_balance, "total_p2p_escrow_sok": total_p2p_escrow, "total_transactions": blockchain_height}
 
     def _econ_run_cycle(self):
         logging.info("Agent Kinh tế: Bắt đầu chu kỳ phân tích...")
@@ -491,7 +1445,7 @@ class PrimeAgentLogic:
             revenue_sok = Decimal(str(new_transactions)) * Decimal('1.0') * avg_fee_percent
             revenue_usd = revenue_sok * last_market_price
             with self.state_lock:
-                self.treasury_value_usd += revenue_usd
+                self.treasury_value_usd += revenue_usd; self._mark_dirty("meta", "treasury_value_usd")
                 if revenue_usd > 0: logging.info(f"Agent Kinh tế: Đã tích lũy thêm ${float(revenue_usd):.6f} vào Quỹ Bảo chứng.")
         with self.state_lock: current_treasury_usd = self.treasury_value_usd
         total_supply = ECON_INITIAL_TOTAL_SUPPLY
@@ -509,8 +1463,7 @@ class PrimeAgentLogic:
         current_price_usd = floor_price_usd * (Decimal('1.0') + activity_multiplier)
         analysis_result = {**current_metrics, "floor_price_usd": floor_price_usd, "market_price_usd": current_price_usd, "activity_multiplier": activity_multiplier, "treasury_value_usd": current_treasury_usd}
         logging.info(f"Agent Kinh tế: Quỹ=${float(analysis_result['treasury_value_usd']):.2f} | Giá Sàn=${float(analysis_result['floor_price_usd']):.8f} | Giá Thị trường=${float(analysis_result['market_price_usd']):.8f}")
-        self.historical_econ_data.append(analysis_result)
-        self._econ_save_data()
+        self._econ_save_data(analysis_result)
         self._econ_generate_chart()
 
     def _econ_cycle_loop(self):
@@ -526,7 +1479,9 @@ class PrimeAgentLogic:
     def shutdown(self):
         if self.is_running.is_set():
             print("\n\nĐang dừng Server..."); self.is_running.clear()
-            self._save_state(); logging.info("Server đã dừng.")
+            self._save_state()
+            if self.state_store: self.state_store.close()
+            logging.info("Server đã dừng.")
 
 core_logic = PrimeAgentLogic()
 
@@ -544,6 +1499,12 @@ def stake_page(): return render_template('stake.html')
 
 # --- Các API endpoint khác giữ nguyên, chỉ thêm các endpoint mới ---
 
+def _page_args():
+    """Đọc ?offset=&limit= (mặc định DEFAULT_PAGE_SIZE, tối đa MAX_PAGE_SIZE)."""
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(max(1, request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)), MAX_PAGE_SIZE)
+    return offset, limit
+
 # [BẢO MẬT NÂNG CAO] API Mới để nhận giao dịch đã ký sẵn
 @app.route('/api/v1/transactions/broadcast', methods=['POST'])
 def broadcast_signed_transaction():
@@ -569,31 +1530,29 @@ def broadcast_signed_transaction():
     except Exception as e:
         logging.error(f"Lỗi nghiêm trọng khi xác thực giao dịch đã ký: {e}", exc_info=True)
         return jsonify({"error": "Lỗi nội bộ khi xác thực giao dịch."}), 500
-    with core_logic.state_lock:
-        node_to_use = core_logic.current_best_node or BLOCKCHAIN_NODE_URL
-    if not node_to_use:
-        return jsonify({"error": "Không thể kết nối đến mạng lưới blockchain."}), 503
     try:
-        response = requests.post(f"{node_to_use}/transactions/new", json=signed_tx_data, timeout=10)
+        response = core_logic._node_call('POST', '/transactions/new', json=signed_tx_data, timeout=10)
         response.raise_for_status()
         logging.info(f"Đã gửi thành công giao dịch đã ký từ {signed_tx_data['sender_address'][:10]}...")
         return jsonify(response.json()), response.status_code
     except requests.RequestException as e:
-        logging.error(f"Không thể gửi giao dịch đã ký đến node {node_to_use}: {e}")
+        logging.error(f"Không thể gửi giao dịch đã ký đến node: {e}")
         return jsonify({"error": f"Lỗi khi giao tiếp với node blockchain: {str(e)}"}), 504
 
 # [TỐI ƯU HÓA] API Mới cho Biểu đồ Kinh tế
 @app.route('/api/v1/econ_chart_data', methods=['GET'])
 def get_econ_chart_data():
-    with core_logic.state_lock:
-        data_points = core_logic.historical_econ_data[-200:] # Giới hạn 200 điểm dữ liệu
-    chart_data = {
-        "timestamps": [d['timestamp'] for d in data_points],
-        "market_prices": [d['market_price_usd'] for d in data_points],
-        "floor_prices": [d['floor_price_usd'] for d in data_points],
-        "treasury_values": [d.get('treasury_value_usd', 0) for d in data_points]
-    }
-    return jsonify(chart_data)
+    """?range=24h|7d|30d|1y|all hoặc ?start=&end= (epoch giây), ?points= số điểm tối đa (mặc định ECON_QUERY_DEFAULT_POINTS)."""
+    start, end = request.args.get('start', type=float), request.args.get('end', type=float)
+    span = request.args.get('range')
+    if span == 'all': start = 0.0
+    elif span:
+        unit = ECON_RANGE_UNITS.get(span[-1:])
+        if not unit or not span[:-1].isdigit(): return jsonify({"error": "Tham số 'range' không hợp lệ (ví dụ: 24h, 7d, 30d, 1y, all)."}), 400
+        start = (end or time.time()) - int(span[:-1]) * unit
+    if start is not None and end is not None and start > end: return jsonify({"error": "'start' phải nhỏ hơn 'end'."}), 400
+    points = min(max(3, request.args.get('points', ECON_QUERY_DEFAULT_POINTS, type=int)), ECON_QUERY_MAX_POINTS)
+    return app.response_class(core_logic.econ_chart_data(start, end, points), mimetype='application/json')
 
 
 @app.route('/heartbeat', methods=['POST'])
@@ -603,14 +1562,24 @@ def heartbeat():
         worker_address = data['worker_address']
         worker_type = data.get('worker_type', 'view_worker')
         worker_status = data.get('status', 'AVAILABLE')
-        with core_logic.state_lock:
-            if worker_address not in core_logic.active_workers:
-                logging.info(f"Worker MỚI ({worker_type}): {worker_address[:10]}...")
-            core_logic.active_workers[worker_address] = {
-                "last_seen": time.time(), "ip": request.remote_addr, "type": worker_type, "status": worker_status
-            }
+        # Bản ghi worker luôn được thay mới nguyên khối (không sửa tại chỗ) để các luồng đọc có thể dùng bản chụp mà không cần khóa
+        worker_record = {"last_seen": time.time(), "ip": request.remote_addr, "type": worker_type, "status": worker_status}
+        core_logic.record_heartbeats([(worker_address, worker_record)])
     return jsonify({"status": "ok"})
 
+@app.route('/heartbeat/batch', methods=['POST'])
+def heartbeat_batch():
+    """Cho gateway đứng trước nhiều worker: {"workers": [{"worker_address", "worker_type", "status", "ip"}, ...]}."""
+    data = request.get_json(silent=True) or {}
+    workers = data.get('workers')
+    if not isinstance(workers, list) or len(workers) > HEARTBEAT_BATCH_MAX:
+        return jsonify({"error": f"Cần danh sách 'workers' tối đa {HEARTBEAT_BATCH_MAX} phần tử."}), 400
+    now = time.time()
+    beats = [(w['worker_address'], {"last_seen": now, "ip": w.get('ip', request.remote_addr), "type": w.get('worker_type', 'view_worker'), "status": w.get('status', 'AVAILABLE')})
+             for w in workers if isinstance(w, dict) and w.get('worker_address')]
+    core_logic.record_heartbeats(beats)
+    return jsonify({"status": "ok", "accepted": len(beats)})
+
 @app.route('/explorer')
 def explorer_page():
     # Flask sẽ tự động tìm file 'sokchain_explorer.html' bên trong thư mục 'static'
@@ -619,36 +1588,27 @@ def explorer_page():
 
 @app.route('/api/v1/workers/list_by_type', methods=['GET'])
 def list_workers_by_type():
-    with core_logic.state_lock:
-        backlink_workers, view_workers = [], []
-        for address, data in core_logic.active_workers.items():
-            worker_info = { "address": address, "last_seen": data.get("last_seen", 0), "status": data.get("status", "AVAILABLE") }
-            if data.get('type') == 'backlink_service': backlink_workers.append(worker_info)
-            else: view_workers.append(worker_info)
-    current_time = time.time()
-    sort_key = lambda w: (current_time - w['last_seen']) > WORKER_TIMEOUT_SECONDS
-    backlink_workers.sort(key=sort_key); view_workers.sort(key=sort_key)
-    return jsonify({'backlink_service': backlink_workers, 'view_worker': view_workers})
+    offset, limit = _page_args()
+    registry = core_logic.worker_registry
+    with core_logic.workers_lock:
+        backlink = [(a, registry.records[a]) for a in itertools.islice(registry.by_type.get('backlink_service', {}), offset, offset + limit)]
+        view_addresses = itertools.chain.from_iterable(members for t, members in registry.by_type.items() if t != 'backlink_service')
+        view = [(a, registry.records[a]) for a in itertools.islice(view_addresses, offset, offset + limit)]
+        backlink_total = len(registry.by_type.get('backlink_service', {}))
+        view_total = len(registry) - backlink_total
+    to_info = lambda address, data: { "address": address, "last_seen": data.get("last_seen", 0), "status": data.get("status", "AVAILABLE") }
+    # Cùng offset/limit cho cả hai danh sách: X-Total-Count là độ dài danh sách dài hơn (trang cuối là khi cả hai đã hết), tổng từng loại trả riêng
+    return (jsonify({'backlink_service': [to_info(a, d) for a, d in backlink], 'view_worker': [to_info(a, d) for a, d in view]}), 200,
+            {"X-Total-Count": str(max(backlink_total, view_total)), "X-Total-Count-Backlink": str(backlink_total), "X-Total-Count-View": str(view_total)})
+
+@app.route('/api/v1/lock_stats')
+def get_lock_stats():
+    return jsonify(core_logic.lock_stats())
 
 @app.route('/api/v1/dashboard_stats')
 def get_dashboard_stats():
-    with core_logic.state_lock:
-        active_workers = len(core_logic.active_workers)
-        total_websites = len(core_logic.websites_db)
-        views_completed = core_logic.total_views_completed_session
-        open_p2p_orders = len([o for o in core_logic.p2p_orders.values() if o['status'] == 'OPEN'])
-        total_stakers = len(core_logic.staking_records)
-    chain_height = -1; node_to_use = core_logic.current_best_node or BLOCKCHAIN_NODE_URL
-    try:
-        response = requests.get(f"{node_to_use}/chain", timeout=3)
-        if response.status_code == 200: chain_height = response.json().get('length', 0)
-    except: pass 
-    return jsonify({
-        "active_workers": active_workers, "total_websites": total_websites,
-        "views_completed_session": views_completed, "blockchain_height": chain_height,
-        "status": "Online" if core_logic.current_best_node else "Connecting...",
-        "open_p2p_orders": open_p2p_orders, "total_stakers": total_stakers
-    })
+    snapshot = core_logic.get_dashboard_snapshot()
+    return jsonify({**snapshot, "age_seconds": round(max(0.0, time.time() - snapshot["generated_at"]), 3)})
 
 @app.route('/api/create_wallet', methods=['POST'])
 def create_wallet_api():
@@ -666,9 +1626,8 @@ def get_wallet_from_pk():
 
 @app.route('/api/get_balance/<address>', methods=['GET'])
 def get_balance_api(address):
-    node_to_use = core_logic.current_best_node or BLOCKCHAIN_NODE_URL
     try:
-        response = requests.get(f"{node_to_use}/balance/{address}", timeout=5)
+        response = core_logic._node_call('GET', f"/balance/{address}", timeout=5)
         response.raise_for_status(); return jsonify(response.json())
     except requests.exceptions.RequestException:
         return jsonify({"error": "Không thể kết nối đến node blockchain"}), 503
@@ -683,12 +1642,11 @@ def direct_fund_api():
     if not all([pk_pem, recipient, amount_str]): return jsonify({"error": "Thiếu thông tin."}), 400
     try:
         sender_wallet = Wallet(private_key_pem=pk_pem); sender_address = sender_wallet.get_address(); amount = float(amount_str)
-        node_to_use = core_logic.current_best_node or BLOCKCHAIN_NODE_URL
-        balance_resp = requests.get(f"{node_to_use}/balance/{sender_address}", timeout=5)
+        balance_resp = core_logic._node_call('GET', f"/balance/{sender_address}", timeout=5)
         if balance_resp.json().get('balance', 0) < amount: return jsonify({"error": "Số dư không đủ."}), 402
         tx = Transaction(sender_wallet.get_public_key_pem(), recipient, amount, sender_address=sender_address)
         tx.sign(sender_wallet.private_key)
-        broadcast_resp = requests.post(f"{node_to_use}/transactions/new", json=tx.to_dict(), timeout=10)
+        broadcast_resp = core_logic._node_call('POST', '/transactions/new', json=tx.to_dict(), timeout=10)
         broadcast_resp.raise_for_status()
         return jsonify({"message": f"Đã gửi thành công {amount} SOK!"}), 201
     except Exception: return jsonify({"error": "Lỗi server khi xử lý giao dịch."}), 500
@@ -710,35 +1668,30 @@ def add_website():
     if not (new_url.startswith('http://') or new_url.startswith('https://')): new_url = 'https://' + new_url
     try: owner_address = get_address_from_public_key_pem(owner_pk_pem)
     except Exception: return jsonify({"error": "Public Key không hợp lệ."}), 400
-    with core_logic.state_lock:
-        if any(w_url == new_url for w_url in core_logic.websites_db): return jsonify({"error": "Website đã tồn tại."}), 409
-        core_logic.websites_db[new_url] = {"owner": owner_address, "views_funded": Decimal('0'), "views_completed": Decimal('0')}
+    if not core_logic.add_site(new_url, owner_address): return jsonify({"error": "Website đã tồn tại."}), 409
     return jsonify({"message": f"Thêm website thành công! Vui lòng nạp SOK để kích hoạt."}), 201
 
 @app.route('/api/v1/websites/list', methods=['GET'])
 def list_websites():
     owner_address = request.args.get('owner')
     if not owner_address: return jsonify({"error": "Thiếu địa chỉ chủ sở hữu."}), 400
-    with core_logic.state_lock:
-        owner_sites = [{"url": url, "info": info} for url, info in core_logic.websites_db.items() if info.get("owner") == owner_address]
-    return jsonify(owner_sites)
+    owner_sites, total = core_logic.list_sites_for_owner(owner_address, *_page_args())
+    return jsonify(owner_sites), 200, {"X-Total-Count": str(total)}
 
 @app.route('/api/v1/websites/remove', methods=['POST'])
 def remove_website():
     data = request.get_json(); url_to_remove = data.get('url'); owner_address = data.get('owner_address')
     if not (url_to_remove and owner_address): return jsonify({"error": "Thiếu thông tin."}), 400
-    with core_logic.state_lock:
+    with core_logic.websites_lock:
         if url_to_remove not in core_logic.websites_db: return jsonify({"error": "Website không tồn tại."}), 404
         if core_logic.websites_db[url_to_remove].get("owner") != owner_address: return jsonify({"error": "Bạn không có quyền xóa."}), 403
-        del core_logic.websites_db[url_to_remove]; logging.info(f"🗑️  Website đã được xóa: {url_to_remove}")
+        core_logic.remove_site(url_to_remove); logging.info(f"🗑️  Website đã được xóa: {url_to_remove}")
     return jsonify({"message": f"Đã xóa thành công: {url_to_remove}"}), 200
 
 @app.route('/api/v1/websites/get_one', methods=['GET'])
 def get_website_to_view():
-    with core_logic.state_lock:
-        funded_websites = [url for url, data in core_logic.websites_db.items() if data.get("views_funded", Decimal('0')) > 0]
-        if not funded_websites: return jsonify({"error": "Hiện tại đã hết website để xem."}), 404
-        random_url = random.choice(funded_websites)
+    with core_logic.websites_lock: random_url = core_logic.funded_index.sample()
+    if not random_url: return jsonify({"error": "Hiện tại đã hết website để xem."}), 404
     return jsonify({"url": random_url, "viewId": f"view_{random_url}_{int(time.time() * 1000)}"})
 
 @app.route('/api/v1/views/submit_proof', methods=['POST'])
@@ -747,15 +1700,17 @@ def submit_view_proof():
     if not (view_id and worker_address): return jsonify({"error": "Dữ liệu không hợp lệ."}), 400
     try:
         url_viewed = "_".join(view_id.split('_')[1:-1])
-        with core_logic.state_lock:
+        with core_logic.websites_lock:
             website_data = core_logic.websites_db.get(url_viewed)
-            if website_data and website_data.get("views_funded", Decimal('0')) > 0:
-                website_data["views_funded"] -= 1
-                website_data["views_completed"] = website_data.get("views_completed", Decimal('0')) + 1
-                core_logic.total_views_completed_session += 1
-                core_logic.reward_queue.put(worker_address)
-                return jsonify({"message": "Xác nhận thành công! Phần thưởng đang được xử lý."}), 200
-            return jsonify({"error": "Website đã hết tín dụng hoặc không tồn tại."}), 402
+            if not (website_data and website_data.get("views_funded", Decimal('0')) > 0):
+                return jsonify({"error": "Website đã hết tín dụng hoặc không tồn tại."}), 402
+            website_data["views_funded"] -= 1
+            website_data["views_completed"] = website_data.get("views_completed", Decimal('0')) + 1
+            core_logic._reindex_site(url_viewed)
+            core_logic.total_views_completed_session += 1
+        core_logic._mark_dirty("websites_db", url_viewed)
+        core_logic.credit_reward(worker_address)
+        return jsonify({"message": "Xác nhận thành công! Phần thưởng đang được xử lý."}), 200
     except Exception: return jsonify({"error": "Lỗi nội bộ server."}), 500
 
 @app.route('/api/v1/p2p/orders/create', methods=['POST'])
@@ -766,9 +1721,8 @@ def p2p_create_order_api():
 
 @app.route('/api/v1/p2p/orders/list', methods=['GET'])
 def p2p_list_orders_api():
-    with core_logic.state_lock:
-        open_orders = [o for o in core_logic.p2p_orders.values() if o['status'] == 'OPEN']
-    return jsonify(sorted(open_orders, key=lambda x: x['created_at']))
+    open_orders, total = core_logic.list_open_orders(*_page_args())
+    return jsonify(open_orders), 200, {"X-Total-Count": str(total)}
 
 @app.route('/api/v1/p2p/orders/<order_id>/accept', methods=['POST'])
 def p2p_accept_order_api(order_id):
@@ -787,9 +1741,17 @@ def p2p_confirm_payment_api(order_id):
 def p2p_get_my_orders_api():
     user_address = request.args.get('address')
     if not user_address: return jsonify({"error": "Thiếu địa chỉ ví."}), 400
-    with core_logic.state_lock:
-        my_orders = [o for o in core_logic.p2p_orders.values() if o['seller_address'] == user_address or o['buyer_address'] == user_address]
-    return jsonify(sorted(my_orders, key=lambda x: x['created_at'], reverse=True))
+    my_orders, total = core_logic.list_orders_for_address(user_address, *_page_args())
+    return jsonify(my_orders), 200, {"X-Total-Count": str(total)}
+
+@app.route('/api/v1/p2p/orders/archive', methods=['GET'])
+def p2p_archived_orders_api():
+    """Tra cứu lệnh đã hoàn tất (COMPLETED) trong kho lưu trữ trên đĩa, mới nhất trước."""
+    if not core_logic.state_store: return jsonify({"error": "Kho lưu trữ chưa sẵn sàng."}), 503
+    status = request.args.get('status')
+    if status and status not in P2P_ARCHIVED_STATUSES: return jsonify({"error": "Trạng thái không hợp lệ."}), 400
+    orders, total = core_logic.state_store.query_archive(request.args.get('address'), status, *_page_args())
+    return jsonify(orders), 200, {"X-Total-Count": str(total)}
 
 @app.route('/api/v1/stake/info', methods=['GET'])
 def get_stake_info_api(): return jsonify(core_logic.stake_get_info())
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# econ_chart_renderer.py - Tiến trình vẽ biểu đồ Kinh tế cho SOK_Server
+# -*- coding: utf-8 -*-
+
+"""
+Tiến trình vẽ biểu đồ định giá (chạy tách khỏi server).
+- Nhận dữ liệu đã giảm mẫu qua stdin dạng JSON: {"output": đường dẫn, "timestamps": [...], "market_prices": [...], "floor_prices": [...], "treasury_values": [...]}.
+- Chỉ tiến trình này mới import plotly, nên server khởi động không phải trả chi phí đó.
+- Ghi ra tệp tạm rồi thay thế nguyên tử, trang web không bao giờ đọc phải tệp viết dở.
+"""
+
+import os
+import sys
+import json
+from datetime import datetime
+
+def render(payload: dict):
+    import plotly.graph_objects as go
+    timestamps = [datetime.fromtimestamp(ts) for ts in payload["timestamps"]]
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=timestamps, y=payload["floor_prices"], mode='lines', name='Giá Sàn (Bảo chứng)', line=dict(color='green', dash='dot')))
+    fig.add_trace(go.Scatter(x=timestamps, y=payload["market_prices"], mode='lines+markers', name='Giá Thị trường (Ước tính)', line=dict(color='blue')))
+    fig.add_trace(go.Bar(x=timestamps, y=payload["treasury_values"], name='Tổng Quỹ Bảo chứng (USD)', yaxis='y2', marker_color='lightsalmon', opacity=0.6))
+    fig.update_layout(title_text='<b>Mô hình Định giá Bảo chứng & Sức khỏe Mạng lưới Sokchain</b>', yaxis=dict(title='<b>Giá SOK (USD)</b>', type='log'), yaxis2=dict(title='Giá trị Quỹ (USD)', overlaying='y', side='right', showgrid=False), legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01), template='plotly_dark', hovermode='x unified')
+    output = payload["output"]
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    fig.write_html(output + ".tmp")
+    os.replace(output + ".tmp", output)
+
+if __name__ == '__main__':
+    try:
+        render(json.load(sys.stdin))
+    except Exception as e:
+        print(f"Lỗi khi vẽ biểu đồ: {e}", file=sys.stderr)
+        sys.exit(1)
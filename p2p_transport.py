@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# p2p_transport.py - Kênh truyền TCP bền vững giữa các Node Sokchain
+# -*- coding: utf-8 -*-
+
+"""
+Kênh truyền TCP bền vững (tùy chọn) giữa các node.
+- Khung nhị phân có tiền tố độ dài: [4 byte độ dài][1 byte loại thông điệp][payload JSON].
+- Nhiều loại thông điệp trên cùng một kết nối: HELLO/AUTH, TX, BLOCK, INV, GETDATA, PING/PONG.
+- Bắt tay xác thực bằng chính ví định danh của node (mỗi bên ký thử thách ngẫu nhiên của bên kia).
+API HTTP vẫn được giữ nguyên cho client; kênh này chỉ dùng để chuyển tiếp giữa các node.
+"""
+
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from sok.wallet import Wallet, sign_data, verify_signature, get_address_from_public_key_pem
+from sok.utils import hash_data
+
+# --- CẤU HÌNH ---
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('>IB')      # độ dài payload (uint32) + loại thông điệp (uint8)
+MAX_FRAME_SIZE = 8 * 1024 * 1024
+MAX_WRITE_BUFFER = 16 * 1024 * 1024     # Peer đọc quá chậm sẽ bị ngắt thay vì làm phình bộ nhớ
+HANDSHAKE_TIMEOUT = 10
+PING_INTERVAL = 30
+IDLE_TIMEOUT = 90
+
+# --- CÁC LOẠI THÔNG ĐIỆP ---
+MSG_HELLO = 1
+MSG_AUTH = 2
+MSG_TX = 3
+MSG_BLOCK = 4
+MSG_INV = 5
+MSG_GETDATA = 6
+MSG_PING = 7
+MSG_PONG = 8
+
+TRANSPORT_ERRORS = (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, OSError, ValueError, KeyError, TypeError)
+
+def encode_frame(msg_type: int, payload: Any) -> bytes:
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return FRAME_HEADER.pack(len(body), msg_type) + body
+
+async def read_frame(reader: asyncio.StreamReader):
+    length, msg_type = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Khung quá lớn ({length} byte).")
+    return msg_type, json.loads(await reader.readexactly(length))
+
+def _challenge_hash(nonce: str, node_id: str) -> str:
+    return hash_data(f"sokchain-p2p:{nonce}:{node_id}")
+
+class PeerConnection:
+    """Một kết nối TCP đã (hoặc đang) được xác thực tới một node khác."""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, outbound: bool):
+        self.reader = reader
+        self.writer = writer
+        self.outbound = outbound
+        self.node_id: Optional[str] = None
+        self.listen_url: Optional[str] = None
+        self.tip = None
+        self.last_seen = time.monotonic()
+        self.closed = False
+
+    def send(self, msg_type: int, payload: Any) -> bool:
+        if self.closed or self.writer.is_closing():
+            return False
+        if self.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            self.close()
+            return False
+        self.writer.write(encode_frame(msg_type, payload))
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+class TcpTransport:
+    """
+    Máy chủ + quản lý các phiên TCP bền vững. Chạy trên event loop P2P của node.
+    on_message(conn, msg_type, payload) được gọi tuần tự cho từng kết nối.
+    """
+    def __init__(self, wallet: Wallet, port: int, listen_url: str,
+                 on_message: Callable[[PeerConnection, int, Any], Awaitable[None]],
+                 hello_extras: Callable[[], dict] = None):
+        self.wallet = wallet
+        self.node_id = wallet.get_address()
+        self.port = port
+        self.listen_url = listen_url
+        self.on_message = on_message
+        self.hello_extras = hello_extras
+        self.sessions: Dict[str, PeerConnection] = {}
+        self.logger = logging.getLogger("TcpTransport")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._tasks = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._on_inbound, '0.0.0.0', self.port)
+        self._spawn(self._keepalive_loop())
+        self.logger.info(f"[TCP] Đang lắng nghe kết nối P2P bền vững trên cổng {self.port}.")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+        for conn in list(self.sessions.values()):
+            conn.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def connect(self, host: str, port: int) -> bool:
+        """Mở một kết nối ra ngoài. Trả về True nếu bắt tay thành công."""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), HANDSHAKE_TIMEOUT)
+        conn = PeerConnection(reader, writer, outbound=True)
+        established = asyncio.get_running_loop().create_future()
+        self._spawn(self._run_session(conn, established))
+        return await established
+
+    async def _on_inbound(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await self._run_session(PeerConnection(reader, writer, outbound=False), None)
+
+    async def _run_session(self, conn: PeerConnection, established: Optional[asyncio.Future]):
+        try:
+            await asyncio.wait_for(self._handshake(conn), HANDSHAKE_TIMEOUT)
+            if conn.node_id == self.node_id:
+                return
+            existing = self.sessions.get(conn.node_id)
+            if existing and not existing.closed:
+                if not self._wins_tie(conn, existing):
+                    if established: established.set_result(True) # Đã có phiên (được giữ lại) tới node này
+                    return
+                existing.close()
+            self.sessions[conn.node_id] = conn
+            if established: established.set_result(True)
+            self.logger.info(f"[TCP] Đã thiết lập phiên với {conn.node_id[:15]}... ({'ra' if conn.outbound else 'vào'}).")
+            await self.on_message(conn, MSG_HELLO, {"tip": conn.tip, "listen_url": conn.listen_url})
+            while not conn.closed:
+                msg_type, payload = await asyncio.wait_for(read_frame(conn.reader), IDLE_TIMEOUT)
+                conn.last_seen = time.monotonic()
+                if msg_type == MSG_PING:
+                    conn.send(MSG_PONG, self._tip_payload())
+                    await self.on_message(conn, MSG_PING, payload)
+                else:
+                    await self.on_message(conn, msg_type, payload)
+        except TRANSPORT_ERRORS as e:
+            self.logger.debug(f"[TCP] Phiên với {conn.node_id or 'peer chưa xác thực'} kết thúc: {e!r}")
+        finally:
+            if established and not established.done(): established.set_result(False)
+            if conn.node_id and self.sessions.get(conn.node_id) is conn:
+                del self.sessions[conn.node_id]
+            conn.close()
+
+    def _wins_tie(self, new: PeerConnection, existing: PeerConnection) -> bool:
+        """
+        Hai node kết nối tới nhau cùng lúc sẽ có hai phiên trùng. Cả hai bên giữ cùng một kết nối:
+        kết nối do node có node_id nhỏ hơn khởi tạo. Hai kết nối cùng chiều thì giữ kết nối MỚI: peer vừa khởi động lại
+        kết nối lại trong khi phiên cũ (nửa mở) chưa hết IDLE_TIMEOUT, giữ phiên cũ sẽ chặn mọi lần kết nối lại.
+        """
+        preferred_initiator = min(self.node_id, new.node_id)
+        initiator = lambda c: self.node_id if c.outbound else c.node_id
+        return initiator(new) == initiator(existing) or initiator(new) == preferred_initiator
+
+    def _tip_payload(self) -> dict:
+        return self.hello_extras() if self.hello_extras else {}
+
+    async def _handshake(self, conn: PeerConnection):
+        """Hai bên cùng gửi HELLO (khóa công khai + nonce), rồi ký nonce của bên kia trong AUTH."""
+        my_nonce = os.urandom(16).hex()
+        conn.send(MSG_HELLO, {"version": PROTOCOL_VERSION, "node_id": self.node_id, "public_key_pem": self.wallet.get_public_key_pem(),
+                              "nonce": my_nonce, "listen_url": self.listen_url, **self._tip_payload()})
+        msg_type, hello = await read_frame(conn.reader)
+        if msg_type != MSG_HELLO or hello.get("version") != PROTOCOL_VERSION:
+            raise ValueError("Bắt tay không hợp lệ.")
+        peer_pem, peer_id = hello["public_key_pem"], hello["node_id"]
+        if get_address_from_public_key_pem(peer_pem) != peer_id:
+            raise ValueError("Node ID không khớp với khóa công khai.")
+        # Ký/xác minh RSA tốn CPU: chạy ngoài event loop để các phiên khác không bị chặn
+        signature = await asyncio.to_thread(sign_data, self.wallet.private_key, _challenge_hash(hello["nonce"], self.node_id))
+        conn.send(MSG_AUTH, {"signature": signature})
+        msg_type, auth = await read_frame(conn.reader)
+        if msg_type != MSG_AUTH or not await asyncio.to_thread(verify_signature, peer_pem, _challenge_hash(my_nonce, peer_id), auth.get("signature", "")):
+            raise ValueError("Chữ ký bắt tay không hợp lệ.")
+        conn.node_id, conn.listen_url, conn.tip = peer_id, hello.get("listen_url"), hello.get("tip")
+
+    def send(self, node_id: str, msg_type: int, payload: Any) -> bool:
+        conn = self.sessions.get(node_id)
+        return conn.send(msg_type, payload) if conn else False
+
+    def broadcast(self, msg_type: int, payload: Any) -> set:
+        """Gửi tới mọi phiên đang mở; trả về tập node_id đã nhận để phần còn lại dùng HTTP."""
+        frame_sent = set()
+        for node_id, conn in list(self.sessions.items()):
+            if conn.send(msg_type, payload):
+                frame_sent.add(node_id)
+        return frame_sent
+
+    async def _keepalive_loop(self):
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            now = time.monotonic()
+            for conn in list(self.sessions.values()):
+                if now - conn.last_seen > IDLE_TIMEOUT:
+                    conn.close()
+                else:
+                    conn.send(MSG_PING, self._tip_payload())
@@ -7,13 +7,20 @@ import sys
 import logging
 import time
 import threading
-import requests
+import asyncio
 import random
 import json
 import socket
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlparse
 from colorama import init, Fore, Style # Thêm thư viện màu sắc để log đẹp hơn
+from flask import jsonify, request
 
-# Cài đặt thư viện cần thiết: pip install waitress requests colorama
+# Cài đặt thư viện cần thiết: pip install waitress aiohttp colorama
+import aiohttp
 from waitress import serve
 
 # --- THIẾT LẬP MÔI TRƯỜNG & ĐƯỜNG DẪN ---
@@ -29,9 +36,12 @@ init(autoreset=True) # Khởi tạo colorama
 # --- IMPORT CÁC THÀNH PHẦN CỐT LÕI ---
 try:
     from sok.node_api import create_app
-    from sok.utils import Config
+    from sok.utils import Config, hash_data
     from sok.wallet import Wallet
+    from sok.transaction import Transaction
     from sok.blockchain import Blockchain, Block
+    from p2p_transport import (TcpTransport, PeerConnection, TRANSPORT_ERRORS,
+                               MSG_HELLO, MSG_TX, MSG_BLOCK, MSG_INV, MSG_GETDATA, MSG_PING, MSG_PONG)
 except ImportError as e:
     print(f"\n[LỖI IMPORT] Không thể tải các thành phần cần thiết: {e}")
     sys.exit(1)
@@ -46,147 +56,931 @@ LIVE_NETWORK_CONFIG_FILE = os.path.join(project_root, 'live_network_nodes.json')
 # QUAN TRỌNG: Hãy thay đổi IP này thành địa chỉ IP thực tế của máy đang chạy run_seeder_node.py
 SEEDER_NODE_URL = "http://192.168.1.19:8080" 
 
+# === [NÂNG CẤP] Cấu hình Compact Block Relay ===
+# Độ dài (ký tự hex) của short id đại diện cho mỗi giao dịch trong khối nén (48 bit).
+COMPACT_SHORT_ID_LENGTH = 12
+COMPACT_FETCH_TIMEOUT = 3
+
+def compact_short_id(block_hash: str, tx: dict) -> str:
+    """Short id của giao dịch, được "muối" bằng hash của khối để tránh va chạm có chủ đích."""
+    return hash_data(block_hash + hash_data(tx))[:COMPACT_SHORT_ID_LENGTH]
+
+def build_compact_block(block: Block, origin: str) -> dict:
+    """
+    Tạo thông điệp khối nén: header + short id của từng giao dịch.
+    Giao dịch hệ thống (thưởng khai thác) không bao giờ có trong mempool nên được gửi kèm nguyên văn.
+    """
+    short_ids, prefilled = [], []
+    for i, tx in enumerate(block.transactions):
+        if tx.get('sender_address') == "0":
+            short_ids.append(None)
+            prefilled.append({"index": i, "tx": tx})
+        else:
+            short_ids.append(compact_short_id(block.hash, tx))
+    header = {'index': block.index, 'previous_hash': block.previous_hash, 'timestamp': block.timestamp, 'nonce': block.nonce, 'hash': block.hash}
+    return {"header": header, "short_ids": short_ids, "prefilled": prefilled, "origin": origin}
+
+def mining_reward_at(index: int) -> float:
+    """Phần thưởng khai thác của khối có chỉ số index (cùng công thức Blockchain.get_current_mining_reward)."""
+    return Config.MINING_REWARD / (2 ** (index // Config.HALVING_BLOCK_INTERVAL))
+
+def meets_difficulty(block_hash: Any, difficulty: int) -> bool:
+    return isinstance(block_hash, str) and block_hash.startswith('0' * difficulty)
+
+def is_valid_compact_block(compact: Any) -> bool:
+    """Kiểm tra kiểu dữ liệu của khối nén nhận từ peer trước khi dựng lại (dữ liệu hỏng phải ra 400, không phải ngoại lệ)."""
+    if not isinstance(compact, dict): return False
+    header, short_ids, prefilled = compact.get('header'), compact.get('short_ids', []), compact.get('prefilled', [])
+    is_int = lambda v: isinstance(v, int) and not isinstance(v, bool)
+    if not isinstance(header, dict) or not is_int(header.get('index')) or not is_int(header.get('nonce')): return False
+    if not isinstance(header.get('timestamp'), (int, float)) or isinstance(header.get('timestamp'), bool): return False
+    if not all(isinstance(header.get(k), str) and header.get(k) for k in ('hash', 'previous_hash')): return False
+    if not isinstance(short_ids, list) or not all(sid is None or isinstance(sid, str) for sid in short_ids): return False
+    if not isinstance(prefilled, list) or not all(isinstance(item, dict) and is_int(item.get('index')) and 0 <= item['index'] < len(short_ids)
+                                                  and isinstance(item.get('tx'), dict) for item in prefilled): return False
+    # Vị trí không có short id (giao dịch hệ thống) bắt buộc phải được gửi kèm nguyên văn
+    covered = {item['index'] for item in prefilled}
+    if any(sid is None and i not in covered for i, sid in enumerate(short_ids)): return False
+    return compact.get('origin') is None or isinstance(compact.get('origin'), str)
+
+# === [NÂNG CẤP] Cấu hình Đồng bộ Headers-First ===
+SYNC_HEADERS_PAGE_SIZE = 2000      # Số header tối đa mỗi lần tải
+SYNC_BODY_WINDOW_SIZE = 64         # Số khối trong một "cửa sổ" thân khối
+SYNC_MAX_BLOCKS_PER_REQUEST = 256  # Giới hạn phía server cho /chain/blocks
+SYNC_FORK_LOOKBACK = 16            # Số khối nhìn lại ban đầu khi tìm điểm rẽ nhánh
+SYNC_REQUEST_TIMEOUT = 10
+SYNC_PER_PEER_INFLIGHT = 2         # Số yêu cầu đồng thời tối đa tới một peer
+SYNC_PER_PEER_MIN_INTERVAL = 0.1   # Khoảng cách tối thiểu (giây) giữa hai yêu cầu tới cùng một peer
+SYNC_MAX_PEER_FAILURES = 3
+SYNC_MAX_WINDOW_ATTEMPTS = 5
+
+# === [NÂNG CẤP] Cấu hình Runtime P2P bất đồng bộ (asyncio) ===
+P2P_MAX_CONCURRENT_REQUESTS = 1024  # Số yêu cầu HTTP ra ngoài đồng thời tối đa trên event loop
+P2P_MAX_CONNECTIONS_PER_HOST = 8
+P2P_BROADCAST_TIMEOUT = 2
+P2P_STOP_TIMEOUT = 5
+
+# === [NÂNG CẤP] Thông báo đỉnh chuỗi (tip) qua gossip & handshake ===
+# Mỗi yêu cầu/phản hồi giữa các node mang theo chiều cao + hash đỉnh chuỗi của bên gửi.
+TIP_HEIGHT_HEADER = 'X-Sok-Tip-Height'
+TIP_HASH_HEADER = 'X-Sok-Tip-Hash'
+NODE_URL_HEADER = 'X-Sok-Node-Url'
+SYNC_DEBOUNCE_SECONDS = 0.5   # Gom các thông báo đến gần nhau thành một lần đồng bộ
+SYNC_MIN_INTERVAL = 5         # Khoảng cách tối thiểu giữa hai lần đồng bộ liên tiếp
+SYNC_TIP_TTL = 10 * 60        # Bỏ qua các thông báo tip cũ hơn ngưỡng này
+
+# === [NÂNG CẤP] Kênh TCP bền vững giữa các node (tùy chọn, xem p2p_transport.py) ===
+# API HTTP vẫn phục vụ client; giữa các node đã có phiên TCP thì gossip đi qua khung nhị phân.
+TCP_PORT_OFFSET = 1000           # Cổng TCP mặc định = cổng API + độ lệch. Đặt P2P_TCP_PORT=0 để tắt.
+TCP_MAX_OUTBOUND = 16            # Số phiên TCP chủ động mở ra ngoài tối đa
+TCP_CONNECT_INTERVAL = 30
+TCP_RECONNECT_MAX_DELAY = 10 * 60
+TCP_RELAY_CACHE_SIZE = 20000     # Số giao dịch gần đây giữ lại để trả lời GETDATA
+TCP_MAX_INV_ITEMS = 1000
+
+# === [NÂNG CẤP] Bản đồ mạng có phiên bản, nhận cập nhật dạng delta ===
+MAP_WRITE_COALESCE_SECONDS = 2   # Gom mọi cập nhật bản đồ trong khoảng này thành một lần ghi đĩa
+
+# Các lỗi mạng/định dạng được coi là "peer không phản hồi đúng"
+PEER_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError)
+
+def mempool_key(tx: dict) -> str:
+    """Khóa chống trùng của giao dịch, giống với cách Blockchain tính seen_transaction_hashes."""
+    return hash_data({k: v for k, v in tx.items() if k not in ['signature', 'sender_address']})
+
+class AsyncPeerClient:
+    """
+    Client HTTP/JSON bất đồng bộ dùng chung cho toàn bộ lớp P2P: một session, một giới hạn đồng thời.
+    Mọi yêu cầu gửi đi đều kèm tip cục bộ (tip_headers) và tip của peer trong phản hồi được báo lại qua on_peer_tip.
+    """
+    def __init__(self, tip_headers: Callable[[], dict] = None, on_peer_tip: Callable[[str, int, str], None] = None):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.tip_headers = tip_headers
+        self.on_peer_tip = on_peer_tip
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=P2P_MAX_CONCURRENT_REQUESTS, limit_per_host=P2P_MAX_CONNECTIONS_PER_HOST)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.slots = asyncio.Semaphore(P2P_MAX_CONCURRENT_REQUESTS)
+
+    async def close(self):
+        if self.session: await self.session.close()
+
+    async def request(self, method: str, url: str, timeout: float, params: dict = None, json_body: Any = None):
+        """Trả về (status, dữ liệu JSON hoặc None). Lỗi mạng được ném ra dưới dạng PEER_ERRORS."""
+        headers = self.tip_headers() if self.tip_headers else None
+        async with self.slots:
+            async with self.session.request(method, url, params=params, json=json_body, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if self.on_peer_tip and TIP_HEIGHT_HEADER in response.headers:
+                    try:
+                        parsed = urlparse(url)
+                        self.on_peer_tip(f"{parsed.scheme}://{parsed.netloc}", int(response.headers[TIP_HEIGHT_HEADER]), response.headers.get(TIP_HASH_HEADER))
+                    except ValueError: pass
+                data = await response.json(content_type=None) if response.status < 300 else None
+                return response.status, data
+
+    async def get_json(self, url: str, timeout: float, params: dict = None):
+        status, data = await self.request('GET', url, timeout, params=params)
+        return data if status == 200 else None
+
+    async def post_json(self, url: str, data: Any, timeout: float):
+        return await self.request('POST', url, timeout, json_body=data)
+
+class _SyncPeer:
+    """Trạng thái của một peer trong một phiên đồng bộ: giới hạn tốc độ và đếm lỗi."""
+    def __init__(self, address: str, height: int):
+        self.address = address
+        self.height = height
+        self.failures = 0
+        self.next_request_at = 0.0
+
+    async def wait_turn(self):
+        now = time.monotonic()
+        delay = self.next_request_at - now
+        self.next_request_at = max(now, self.next_request_at) + SYNC_PER_PEER_MIN_INTERVAL
+        if delay > 0: await asyncio.sleep(delay)
+
+class HeadersFirstSync:
+    """
+    Đồng bộ kiểu headers-first: tải và kiểm tra chuỗi header từ peer tốt nhất,
+    sau đó tải song song thân khối theo từng cửa sổ từ tất cả các peer khỏe mạnh.
+    Chạy trên event loop của P2P; các thao tác ghi SQLite được đẩy sang luồng phụ.
+    """
+    def __init__(self, blockchain: Blockchain, client: AsyncPeerClient):
+        self.blockchain = blockchain
+        self.client = client
+        self.logger = logging.getLogger("HeadersFirstSync")
+        self.is_syncing = False
+
+    async def sync(self, candidates: list = None) -> bool:
+        """
+        Trả về True nếu chuỗi cục bộ đã được mở rộng hoặc thay thế.
+        candidates: các _SyncPeer đã biết chiều cao (từ thông báo tip); nếu bỏ trống sẽ hỏi /chain/stats của mọi peer.
+        """
+        if self.is_syncing:
+            return False
+        self.is_syncing = True
+        try:
+            return await self._sync(candidates)
+        finally:
+            self.is_syncing = False
+
+    async def _sync(self, candidates: list = None) -> bool:
+        local_tip = self.blockchain.last_block
+        if candidates is None:
+            candidates = await self._probe_peers()
+        peers = [p for p in candidates if p.height > local_tip.index]
+        if not peers:
+            return False
+        best_peer = max(peers, key=lambda p: p.height)
+
+        try:
+            fork_index = await self._find_fork_point(best_peer.address, local_tip.index)
+            if fork_index is None:
+                self.logger.info(f"[Sync] {best_peer.address} chưa hỗ trợ /chain/headers. Dùng cơ chế tải toàn chuỗi cũ.")
+                return await asyncio.to_thread(self.blockchain.resolve_conflicts)
+            headers = await self._download_header_chain(best_peer.address, fork_index, best_peer.height)
+        except (*PEER_ERRORS, LookupError) as e:
+            self.logger.warning(f"[Sync] Không tải được chuỗi header từ {best_peer.address}: {e!r}")
+            return False
+        if not headers or headers[-1]['index'] <= local_tip.index:
+            return False
+
+        target_height = headers[-1]['index']
+        body_peers = [p for p in peers if p.height >= target_height]
+        self.logger.info(f"[Sync] Chuỗi header hợp lệ tới #{target_height} (rẽ nhánh tại #{fork_index}). Tải thân khối từ {len(body_peers)} peer...")
+
+        if fork_index == local_tip.index:
+            # Trường hợp phổ biến: chỉ nối thêm khối, áp dụng ngay khi từng cửa sổ về đủ theo thứ tự
+            applied = []
+            def apply_window(blocks):
+                for block_data in blocks:
+                    reason = self.validate_peer_block(Block.from_dict(block_data))
+                    if reason:
+                        raise ValueError(f"Khối #{block_data['index']} không hợp lệ: {reason}")
+                    if not self.blockchain.add_block_from_peer(block_data):
+                        raise ValueError(f"Khối #{block_data['index']} không nối tiếp được chuỗi cục bộ.")
+                applied.extend(blocks)
+            try:
+                complete = await self._download_bodies(headers, body_peers, apply_window)
+            except ValueError as e:
+                self.logger.warning(f"[Sync] Dừng áp dụng khối: {e}")
+                complete = False
+            if applied:
+                self.logger.info(f"[Sync] Đã nối thêm {len(applied)} khối, đỉnh mới #{applied[-1]['index']}.")
+            if not complete:
+                self.logger.warning("[Sync] Đồng bộ chưa hoàn tất, sẽ tiếp tục ở chu kỳ sau.")
+            return bool(applied)
+
+        # Rẽ nhánh: chỉ thay thế chuỗi khi đã có đủ toàn bộ thân khối của nhánh mới
+        new_blocks = []
+        if not await self._download_bodies(headers, body_peers, new_blocks.extend):
+            self.logger.warning("[Sync] Không tải đủ thân khối của nhánh mới. Giữ nguyên chuỗi hiện tại.")
+            return False
+        return await asyncio.to_thread(self._apply_reorg, local_tip.hash, fork_index, new_blocks)
+
+    async def _probe_peers(self) -> list:
+        with self.blockchain.peer_lock:
+            addresses = list({peer['address'] for peer in self.blockchain.peers.values()})
+        async def probe(address):
+            try:
+                stats = await self.client.get_json(f"{address}/chain/stats", timeout=3)
+                if stats: return _SyncPeer(address, int(stats.get('block_height', -1)))
+            except PEER_ERRORS: pass
+            return None
+        return [p for p in await asyncio.gather(*(probe(a) for a in addresses)) if p]
+
+    async def _fetch_headers(self, address: str, start: int, limit: int):
+        status, data = await self.client.request('GET', f"{address}/chain/headers", SYNC_REQUEST_TIMEOUT, params={'start': start, 'limit': limit})
+        if status == 404: return None
+        if status != 200: raise ValueError(f"HTTP {status}")
+        return data.get('headers', [])
+
+    def _local_hashes(self, start: int, end: int) -> dict:
+        cursor = self.blockchain.conn.cursor()
+        cursor.execute('SELECT "index", hash FROM blocks WHERE "index" BETWEEN ? AND ?', (start, end))
+        return {row['index']: row['hash'] for row in cursor.fetchall()}
+
+    async def _find_fork_point(self, address: str, local_tip_index: int):
+        """Tìm khối chung cao nhất giữa chuỗi cục bộ và chuỗi của peer (None nếu peer không hỗ trợ)."""
+        lookback = SYNC_FORK_LOOKBACK
+        while True:
+            start = max(0, local_tip_index - lookback)
+            remote = await self._fetch_headers(address, start, local_tip_index - start + 1)
+            if remote is None: return None
+            local = await asyncio.to_thread(self._local_hashes, start, local_tip_index)
+            for header in reversed(remote):
+                if local.get(header.get('index')) == header.get('hash'):
+                    return header['index']
+            if start == 0:
+                raise LookupError("Peer nằm trên chuỗi có khối Sáng thế khác.")
+            lookback *= 4
+
+    async def _download_header_chain(self, address: str, fork_index: int, peer_height: int) -> list:
+        prev_hash = (await asyncio.to_thread(self._local_hashes, fork_index, fork_index))[fork_index]
+        headers, index = [], fork_index + 1
+        while index <= peer_height:
+            page = await self._fetch_headers(address, index, SYNC_HEADERS_PAGE_SIZE)
+            if not page: break
+            for header in page:
+                if header.get('index') != index or header.get('previous_hash') != prev_hash:
+                    raise ValueError(f"Chuỗi header đứt liên kết tại #{index}.")
+                # Chuỗi dài hơn nhưng không có bằng chứng công việc không được thay thế chuỗi cục bộ
+                if not meets_difficulty(header.get('hash'), self.blockchain.difficulty):
+                    raise ValueError(f"Header #{index} không đạt độ khó.")
+                headers.append(header)
+                prev_hash, index = header['hash'], index + 1
+        return headers
+
+    @staticmethod
+    def _verify_window(window: list, bodies: list, difficulty: int) -> list:
+        """Kiểm tra thân khối của một cửa sổ so với các header đã xác thực."""
+        if not isinstance(bodies, list) or len(bodies) != len(window):
+            raise ValueError(f"Peer trả về {len(bodies) if isinstance(bodies, list) else type(bodies).__name__}/{len(window)} khối.")
+        blocks = []
+        for header, body in zip(window, bodies):
+            if not isinstance(body, dict): raise ValueError(f"Thân khối #{header['index']} không phải đối tượng JSON.")
+            if isinstance(body.get('transactions'), str):
+                body['transactions'] = json.loads(body['transactions'])
+            block = Block.from_dict(body)
+            if block.index != header['index'] or block.previous_hash != header['previous_hash'] or block.hash != header['hash']:
+                raise ValueError(f"Thân khối #{header['index']} không khớp header.")
+            if not meets_difficulty(block.hash, difficulty):
+                raise ValueError(f"Khối #{header['index']} không đạt độ khó.")
+            blocks.append(block.to_dict())
+        return blocks
+
+    async def _fetch_window(self, peer: _SyncPeer, window: list) -> list:
+        await peer.wait_turn()
+        status, data = await self.client.request('GET', f"{peer.address}/chain/blocks", SYNC_REQUEST_TIMEOUT, params={'start': window[0]['index'], 'limit': len(window)})
+        if status != 200: raise ValueError(f"HTTP {status}")
+        if not isinstance(data, dict): raise ValueError("Phản hồi /chain/blocks không phải đối tượng JSON.")
+        return await asyncio.to_thread(self._verify_window, window, data.get('blocks', []), self.blockchain.difficulty)
+
+    async def _download_bodies(self, headers: list, peers: list, on_window) -> bool:
+        """
+        Chia dải khối thành các cửa sổ và tải song song từ nhiều peer.
+        Cửa sổ lỗi/quá thời gian được xếp lại hàng đợi cho peer khác. on_window được gọi theo đúng thứ tự.
+        """
+        windows = [headers[i:i + SYNC_BODY_WINDOW_SIZE] for i in range(0, len(headers), SYNC_BODY_WINDOW_SIZE)]
+        pending = asyncio.PriorityQueue()
+        for n in range(len(windows)): pending.put_nowait((n, 0))
+        results, changed = {}, asyncio.Event()
+        state = {'failed': False}
+
+        async def worker(peer: _SyncPeer):
+            # Mọi lỗi từ dữ liệu peer (kể cả kiểu JSON lạ) đều xếp lại cửa sổ; changed luôn được báo để vòng chính không chờ mãi
+            try:
+                while peer.failures < SYNC_MAX_PEER_FAILURES:
+                    n, attempts = await pending.get()
+                    try:
+                        results[n] = await self._fetch_window(peer, windows[n])
+                    except Exception as e:
+                        peer.failures += 1
+                        self.logger.warning(f"[Sync] Cửa sổ #{windows[n][0]['index']} từ {peer.address} lỗi ({e!r}). Yêu cầu lại...")
+                        if attempts + 1 >= SYNC_MAX_WINDOW_ATTEMPTS: state['failed'] = True
+                        else: pending.put_nowait((n, attempts + 1))
+                    changed.set()
+            finally:
+                changed.set()
+
+        workers = [asyncio.create_task(worker(peer)) for peer in peers for _ in range(SYNC_PER_PEER_INFLIGHT)]
+        next_window = 0
+        try:
+            while next_window < len(windows):
+                while next_window not in results:
+                    if state['failed'] or all(t.done() for t in workers): return False
+                    changed.clear()
+                    await changed.wait()
+                await asyncio.to_thread(on_window, results.pop(next_window))
+                next_window += 1
+            return True
+        finally:
+            for t in workers: t.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def _apply_reorg(self, old_tip_hash: str, fork_index: int, new_blocks: list) -> bool:
+        with self.blockchain.mining_lock:
+            if self.blockchain.last_block.hash != old_tip_hash:
+                self.logger.warning("[Sync] Đỉnh chuỗi đã thay đổi trong lúc tải. Hủy thay thế chuỗi.")
+                return False
+            # Hoàn tác nhánh cũ và ghi nhánh mới trong MỘT giao dịch SQLite: lỗi giữa chừng thì chuỗi cũ còn nguyên
+            conn = self.blockchain.conn
+            try:
+                cursor = conn.cursor()
+                orphaned_txs = self._rollback_to(cursor, fork_index)
+                for block_data in new_blocks: self._insert_block(cursor, Block.from_dict(block_data))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                self.logger.error(f"[Sync] Lỗi khi thay thế chuỗi, giữ nguyên chuỗi cũ: {e}")
+                return False
+            # Cập nhật mempool (vẫn giữ mining_lock để không đua với thợ mỏ): bỏ giao dịch đã nằm trong nhánh mới, trả lại giao dịch của nhánh bị bỏ
+            included = {mempool_key(tx) for block_data in new_blocks for tx in block_data['transactions']}
+            self.blockchain.pending_transactions = [tx for tx in self.blockchain.pending_transactions if mempool_key(tx) not in included]
+            self.blockchain.seen_transaction_hashes -= included
+            for tx in orphaned_txs:
+                if tx.get('sender_address') == "0" or mempool_key(tx) in included: continue
+                # add_transaction không kiểm tra gì: giao dịch của nhánh bị bỏ có thể đã mất nguồn tiền trên nhánh mới
+                try:
+                    if Transaction.from_dict(tx).is_valid(self.blockchain)[0]: self.blockchain.add_transaction(tx)
+                except (ValueError, KeyError, TypeError, AttributeError): pass
+        self.logger.info(f"✅ [Sync] Đã chuyển sang nhánh mới: bỏ các khối sau #{fork_index}, đỉnh mới #{new_blocks[-1]['index']}.")
+        return True
+
+    @staticmethod
+    def _rollback_to(cursor, fork_index: int) -> list:
+        """Xóa các khối sau fork_index và hoàn tác số dư của chúng (không commit). Trả về giao dịch của các khối bị xóa."""
+        cursor.execute('SELECT transactions FROM blocks WHERE "index" > ? ORDER BY "index" DESC', (fork_index,))
+        orphaned_txs = []
+        for row in cursor.fetchall():
+            txs = json.loads(row['transactions']) if isinstance(row['transactions'], str) else row['transactions']
+            for tx in txs:
+                amount = float(tx.get('amount', 0))
+                sender_addr, recipient_addr = tx.get('sender_address'), tx.get('recipient_address')
+                if sender_addr and sender_addr != "0":
+                    cursor.execute("UPDATE balances SET balance = balance + ? WHERE address = ?", (amount, sender_addr))
+                if recipient_addr:
+                    cursor.execute("UPDATE balances SET balance = balance - ? WHERE address = ?", (amount, recipient_addr))
+            orphaned_txs.extend(txs)
+        cursor.execute('DELETE FROM blocks WHERE "index" > ?', (fork_index,))
+        return orphaned_txs
+
+    @staticmethod
+    def _insert_block(cursor, block: Block):
+        """Giống Blockchain._add_block_to_db nhưng không commit, để cả lần thay chuỗi nằm trong một giao dịch."""
+        cursor.execute('INSERT INTO blocks ("index", hash, previous_hash, timestamp, nonce, transactions) VALUES (?, ?, ?, ?, ?, ?)',
+                       (block.index, block.hash, block.previous_hash, block.timestamp, block.nonce, json.dumps(list(block.transactions))))
+        recipients = {tx.get('recipient_address') for tx in block.transactions if tx.get('recipient_address')}
+        cursor.executemany("INSERT OR IGNORE INTO balances (address, balance) VALUES (?, ?)", [(recipient, 0.0) for recipient in recipients])
+        for tx in block.transactions:
+            amount = float(tx.get('amount', 0))
+            sender_addr, recipient_addr = tx.get('sender_address'), tx.get('recipient_address')
+            if sender_addr and sender_addr != "0":
+                cursor.execute("UPDATE balances SET balance = balance - ? WHERE address = ?", (amount, sender_addr))
+            if recipient_addr:
+                cursor.execute("UPDATE balances SET balance = balance + ? WHERE address = ?", (amount, recipient_addr))
+
+
+def network_map_hash(nodes) -> str:
+    """Hash nội dung bản đồ mạng. Phải giống hệt hàm cùng tên trong run_ranger_agent.py."""
+    return hashlib.sha256(json.dumps(sorted(set(nodes)), separators=(',', ':')).encode('utf-8')).hexdigest()
+
+class NetworkMapStore:
+    """
+    Bản đồ mạng (live_network_nodes.json) giữ trong bộ nhớ với phiên bản + hash nội dung.
+    Cập nhật không làm đổi nội dung thì không ghi đĩa; các cập nhật liên tiếp được gom lại bởi người gọi flush().
+    Tệp vẫn có thể được Ranger (hoặc người vận hành) ghi trực tiếp: reload_if_changed() đọc lại khi mtime đổi,
+    và flush() không bao giờ ghi đè một tệp có phiên bản cao hơn bản trong bộ nhớ.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.version = 0
+        self.nodes = frozenset()
+        self.hash = network_map_hash(())
+        self._dirty = False
+        self._mtime = None
+        self._load()
+
+    def _read(self):
+        """Đọc tệp: (mtime, phiên bản hoặc None nếu tệp kiểu cũ, tập node); None nếu không có tệp hoặc tệp hỏng."""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            nodes = frozenset(u for u in data.get("active_nodes", []) if isinstance(u, str))
+            return mtime, data.get("version") if isinstance(data.get("version"), int) else None, nodes
+        except FileNotFoundError:
+            return None
+        except (IOError, json.JSONDecodeError, AttributeError) as e:
+            logging.getLogger("NetworkMap").error(f"Không thể đọc tệp bản đồ mạng '{self.path}': {e}")
+            return None
+
+    def _load(self):
+        loaded = self._read()
+        if loaded is None:
+            return
+        self._mtime, version, self.nodes = loaded
+        self.version = version or 0
+        self.hash = network_map_hash(self.nodes)
+
+    def reload_if_changed(self) -> tuple:
+        """
+        Đọc lại tệp nếu mtime đổi kể từ lần đọc/ghi trước. Chỉ nhận bản trong tệp khi phiên bản của nó cao hơn
+        (bằng phiên bản thì chỉ nhận khi không có thay đổi chưa ghi); tệp kiểu cũ không có phiên bản được coi là mới hơn
+        và được gán phiên bản kế tiếp (ghi lại ở lần flush sau). Trả về các node mới được thêm.
+        """
+        try:
+            if os.path.getmtime(self.path) == self._mtime:
+                return ()
+        except OSError:
+            return ()
+        loaded = self._read()
+        if loaded is None:
+            return ()
+        mtime, version, nodes = loaded
+        with self.lock:
+            self._mtime = mtime
+            if version is not None and (version < self.version or (version == self.version and self._dirty)):
+                return ()
+            new_hash = network_map_hash(nodes)
+            added_nodes = tuple(nodes - self.nodes)
+            self._dirty = version is None and new_hash != self.hash
+            self.nodes, self.hash = nodes, new_hash
+            self.version = version if version is not None else self.version + (1 if self._dirty else 0)
+        logging.getLogger("NetworkMap").info(f"Đã nạp lại bản đồ mạng từ tệp (phiên bản {self.version}, {len(nodes)} node).")
+        return added_nodes
+
+    def _state(self) -> dict:
+        return {"version": self.version, "hash": self.hash}
+
+    def apply_update(self, data: Any):
+        """
+        Nhận bản đầy đủ ({version, active_nodes}, hoặc định dạng cũ chỉ có active_nodes)
+        hoặc delta ({base_hash, version, hash, added, removed}).
+        Trả về (phản hồi, mã HTTP, các node mới được thêm). Mã 409 nghĩa là bên gửi cần gửi bản đầy đủ.
+        """
+        if not isinstance(data, dict):
+            return {'error': 'Dữ liệu không hợp lệ.'}, 400, ()
+        version = data.get('version') if isinstance(data.get('version'), int) else None
+        with self.lock:
+            if 'active_nodes' in data:
+                nodes = data['active_nodes']
+                if not isinstance(nodes, list) or not all(isinstance(u, str) for u in nodes):
+                    return {'error': 'Dữ liệu không hợp lệ.'}, 400, ()
+                if version is not None and version < self.version:
+                    return {'message': 'Bản đồ cũ hơn bản hiện có, bỏ qua.', **self._state()}, 200, ()
+                new_nodes = frozenset(nodes)
+            else:
+                if data.get('hash') == self.hash:
+                    return {'message': 'Bản đồ đã là mới nhất.', **self._state()}, 200, ()
+                added, removed = data.get('added'), data.get('removed')
+                if data.get('base_hash') != self.hash or version is None or not isinstance(added, list) or not isinstance(removed, list):
+                    return {'error': 'Không áp dụng được delta, cần bản đồ đầy đủ.', **self._state()}, 409, ()
+                new_nodes = (self.nodes - {u for u in removed if isinstance(u, str)}) | {u for u in added if isinstance(u, str)}
+                if network_map_hash(new_nodes) != data.get('hash'):
+                    return {'error': 'Hash bản đồ sau khi áp dụng delta không khớp.', **self._state()}, 409, ()
+
+            new_version = version if version is not None else self.version + 1
+            new_hash = network_map_hash(new_nodes)
+            if new_hash == self.hash:
+                return {'message': 'Bản đồ không thay đổi.', **self._state()}, 200, ()
+            added_nodes = tuple(new_nodes - self.nodes)
+            self.nodes, self.hash, self.version = new_nodes, new_hash, max(self.version, new_version)
+            self._dirty = True
+            return {'message': 'Đã nhận bản đồ.', **self._state()}, 202, added_nodes
+
+    def snapshot(self) -> list:
+        return sorted(self.nodes)
+
+    def flush(self):
+        """Ghi bản đồ ra đĩa (nguyên tử) nếu có thay đổi chưa ghi."""
+        with self._write_lock:
+            with self.lock:
+                if not self._dirty:
+                    return
+                payload = {"version": self.version, "hash": self.hash, "active_nodes": sorted(self.nodes)}
+                self._dirty = False
+            on_disk = self._read()
+            if on_disk is not None and on_disk[1] is not None and on_disk[1] > payload["version"]:
+                # Tệp đã được ghi bởi nguồn có bản đồ mới hơn: không ghi đè, lần reload_if_changed() sau sẽ nhận nó
+                logging.getLogger("NetworkMap").warning(f"Bỏ qua ghi bản đồ phiên bản {payload['version']}: tệp đang có phiên bản {on_disk[1]}.")
+                return
+            try:
+                temp_file = self.path + ".tmp"
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(payload, f, indent=2)
+                os.replace(temp_file, self.path)
+                with self.lock: self._mtime = os.path.getmtime(self.path)
+                logging.getLogger("NetworkMap").info(f"Đã ghi bản đồ mạng phiên bản {payload['version']} ({len(payload['active_nodes'])} node).")
+            except IOError as e:
+                with self.lock: self._dirty = True
+                logging.getLogger("NetworkMap").error(f"Lỗi khi ghi tệp bản đồ mạng: {e}")
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    """Nhận gói tin khám phá LAN trực tiếp trên event loop (không cần vòng lặp poll với timeout)."""
+    def __init__(self, manager: 'HybridP2PManager'):
+        self.manager = manager
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            message = json.loads(data.decode('utf-8'))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return
+        if isinstance(message, dict) and message.get("protocol") == "sokchain_discovery":
+            new_node_id, new_node_port, new_node_ip = message.get("node_id"), message.get("port"), addr[0]
+            if new_node_id and new_node_id != self.manager.node_wallet.get_address():
+                self.manager.blockchain.register_node(new_node_id, f"http://{new_node_ip}:{new_node_port}")
+
 # --- BỘ NÃO P2P LAI (HYBRID) ĐÃ ĐƯỢC NÂNG CẤP ---
 class HybridP2PManager:
     DISCOVERY_PORT = 5005 
 
-    def __init__(self, blockchain: Blockchain, node_wallet: Wallet, node_port: int, host_ip: str):
+    def __init__(self, blockchain: Blockchain, node_wallet: Wallet, node_port: int, host_ip: str, tcp_port: int = 0):
         self.blockchain = blockchain
         self.node_wallet = node_wallet
         self.node_port = node_port
         self.host_ip = host_ip
+        self.public_url = f"http://{host_ip}:{node_port}"
         self.logger = logging.getLogger("HybridP2PManager")
         self.is_running = True
-        
-        # === [NÂNG CẤP] Thêm luồng mới "Active-Sync" ===
-        self.threads = [
-            threading.Thread(target=self._run_seeder_bootstrap, daemon=True, name="Seeder-Bootstrap"),
-            threading.Thread(target=self._run_lan_discovery, daemon=True, name="LAN-Discovery"),
-            threading.Thread(target=self._run_map_file_sync, daemon=True, name="Map-FileSync"),
-            threading.Thread(target=self._run_peer_exchange, daemon=True, name="Peer-Exchange(PEX)"),
-            # [THÊM MỚI] Luồng này sẽ liên tục kiểm tra và đồng bộ chuỗi
-            threading.Thread(target=self._run_active_chain_sync, daemon=True, name="Active-Sync")
-        ]
+        self.client = AsyncPeerClient(tip_headers=self._tip_headers, on_peer_tip=self.note_peer_tip)
+        self.sync_engine = HeadersFirstSync(blockchain, self.client)
+
+        # === [NÂNG CẤP] Đồng bộ theo sự kiện: chỉ chạy khi có peer thông báo đỉnh chuỗi cao hơn ===
+        self.local_tip = (-1, None)
+        self.peer_tips: Dict[str, tuple] = {}
+        self._sync_task: Optional[asyncio.Task] = None
+        self._sync_requested = False
+        self._last_sync_at = 0.0
+
+        # === [NÂNG CẤP] Kênh TCP bền vững (chỉ truy cập trên event loop P2P) ===
+        self.tcp_port = tcp_port
+        self.transport: Optional[TcpTransport] = None
+        self.peer_tcp_endpoints: Dict[str, tuple] = {}   # node_id -> (host, cổng TCP) học được qua handshake
+        self._tcp_retry_at: Dict[str, tuple] = {}        # node_id -> (thời điểm thử lại, độ trễ hiện tại)
+        self.relay_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+        # === [NÂNG CẤP] Bản đồ mạng trong bộ nhớ, ghi đĩa được gom trên event loop ===
+        self.network_map = NetworkMapStore(LIVE_NETWORK_CONFIG_FILE)
+        self._map_flush_handle: Optional[asyncio.TimerHandle] = None
+
+        # === [NÂNG CẤP] Toàn bộ lớp P2P chạy trên MỘT event loop asyncio trong một luồng duy nhất ===
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread = threading.Thread(target=self._run_event_loop, daemon=True, name="P2P-EventLoop")
+        self._loop_ready = threading.Event()
+        self._stop_event: Optional[asyncio.Event] = None
 
     def start(self):
-        self.logger.info("Đang khởi động dịch vụ P2P với mô hình lai (Seeder + LAN + Map + PEX + ActiveSync)...")
-        for thread in self.threads:
-            thread.start()
+        self.logger.info("Đang khởi động dịch vụ P2P với mô hình lai (Seeder + LAN + Map + PEX + ActiveSync) trên asyncio...")
+        self.refresh_local_tip()
+        self._loop_thread.start()
+        self._loop_ready.wait(timeout=P2P_STOP_TIMEOUT)
     
     def stop(self):
         self.logger.info("Đang dừng dịch vụ P2P...")
         self.is_running = False
+        if self.loop and self._stop_event and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop_event.set)
+        if self._loop_thread.is_alive() and threading.current_thread() is not self._loop_thread:
+            self._loop_thread.join(timeout=P2P_STOP_TIMEOUT)
+
+    def _run_event_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+
+    async def _main(self):
+        self._stop_event = asyncio.Event()
+        await self.client.open()
+        if self.tcp_port:
+            await self._start_transport()
+        tasks = [
+            asyncio.create_task(self._run_seeder_bootstrap(), name="Seeder-Bootstrap"),
+            asyncio.create_task(self._run_lan_discovery(), name="LAN-Discovery"),
+            asyncio.create_task(self._run_map_file_sync(), name="Map-FileSync"),
+            asyncio.create_task(self._run_peer_exchange(), name="Peer-Exchange(PEX)"),
+        ]
+        if self.transport:
+            tasks.append(asyncio.create_task(self._run_tcp_connector(), name="TCP-Connector"))
+        self.logger.info("[Lớp 4 - Active Sync] Đồng bộ theo thông báo đỉnh chuỗi từ peer đã sẵn sàng.")
+        self._loop_ready.set()
+        try:
+            await self._stop_event.wait()
+        finally:
+            if self.transport:
+                await self.transport.stop()
+            # Hủy mọi tác vụ còn lại (kể cả các broadcast đang bay) rồi mới đóng session
+            pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for t in pending: t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            await self.client.close()
+            await asyncio.to_thread(self.network_map.flush)
+            self.logger.info("Dịch vụ P2P đã dừng.")
+
+    def _submit(self, coro):
+        """Đưa một coroutine lên event loop P2P từ luồng khác (ví dụ: luồng xử lý API của waitress)."""
+        if not self.loop or not self.is_running or self.loop.is_closed():
+            coro.close()
+            return None
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
 
     def broadcast_transaction(self, transaction: dict):
-        self._broadcast_message('/transactions/add_from_peer', transaction)
+        self._submit(self._relay_transaction(transaction))
 
     def broadcast_block(self, block: Block):
-        self._broadcast_message('/blocks/add_from_peer', block.to_dict())
+        if block.index > self.local_tip[0]:
+            self.local_tip = (block.index, block.hash)
+        # [Compact Block] Chỉ gửi header + short id, peer tự dựng lại phần thân từ mempool của họ
+        compact = build_compact_block(block, self.public_url)
+        self._submit(self._relay(MSG_BLOCK, compact, '/blocks/compact', compact))
+
+    def validate_peer_block(self, block: Block) -> Optional[str]:
+        """
+        Kiểm tra khối nhận từ peer trên trạng thái chuỗi hiện tại (khối cha là đỉnh chuỗi). Trả về lý do từ chối, hoặc None nếu hợp lệ.
+        add_block_from_peer chỉ tính lại hash, nên bằng chứng công việc và giao dịch phải được kiểm tra ở đây.
+        """
+        if not meets_difficulty(block.hash, self.blockchain.difficulty):
+            return "Khối không đạt độ khó."
+        if not isinstance(block.transactions, list) or not all(isinstance(tx, dict) for tx in block.transactions):
+            return "Danh sách giao dịch không hợp lệ."
+        system_txs = [tx for tx in block.transactions if tx.get('sender_public_key_pem') == "0" or tx.get('sender_address') == "0"]
+        if len(system_txs) != 1:
+            return "Khối phải có đúng một giao dịch thưởng khai thác."
+        reward = system_txs[0]
+        amount = reward.get('amount')
+        if (reward.get('signature') != "mining_reward" or reward.get('sender_public_key_pem') != "0" or reward.get('sender_address') != "0"
+                or not isinstance(amount, (int, float)) or isinstance(amount, bool) or not 0 < amount <= mining_reward_at(block.index)):
+            return "Giao dịch thưởng khai thác không hợp lệ."
+        spent = {}
+        for tx in block.transactions:
+            if tx is reward: continue
+            try:
+                is_valid, reason = Transaction.from_dict(tx).is_valid(self.blockchain)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                return f"Giao dịch không hợp lệ: {e}"
+            if not is_valid: return reason
+            # is_valid chỉ so từng giao dịch với số dư; nhiều giao dịch cùng người gửi trong một khối phải cộng dồn
+            spent[tx['sender_address']] = spent.get(tx['sender_address'], 0) + tx['amount']
+            if spent[tx['sender_address']] > self.blockchain.get_balance(tx['sender_address']):
+                return f"Số dư không đủ cho các giao dịch của {tx['sender_address'][:10]}... trong khối."
+        return None
+
+    def accept_peer_block(self, block_data: Any):
+        """Nhận một khối đầy đủ do peer gửi qua /blocks/add_from_peer."""
+        try:
+            block = Block.from_dict(block_data)
+        except (KeyError, TypeError, AttributeError):
+            return {'error': 'Dữ liệu không hợp lệ.'}, 400
+        if block_data.get('hash', block.hash) != block.hash:
+            return {'error': 'Hash khối không khớp.'}, 400
+        reason = self.validate_peer_block(block)
+        if reason: return {'error': f"Khối không hợp lệ: {reason}"}, 400
+        if not self.blockchain.add_block_from_peer(block.to_dict()):
+            return {'error': 'Khối bị từ chối.'}, 409
+        self.refresh_local_tip()
+        return {'message': 'Đã chấp nhận khối.'}, 200
+
+    def accept_peer_transaction(self, values: dict):
+        """Kiểm tra và nhận một giao dịch do peer chuyển tiếp (dùng chung cho HTTP và TCP)."""
+        if not isinstance(values, dict): return {'error': 'Dữ liệu không hợp lệ.'}, 400
+        # Transaction.is_valid chấp nhận vô điều kiện giao dịch hệ thống; chúng chỉ được tạo khi khai thác, không bao giờ được chuyển tiếp
+        if values.get('sender_public_key_pem') == "0" or values.get('sender_address') == "0":
+            return {'error': 'Không nhận giao dịch hệ thống từ peer.'}, 400
+        try:
+            is_valid, reason = Transaction.from_dict(values or {}).is_valid(self.blockchain)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return {'error': str(e)}, 400
+        if not is_valid: return {'error': reason}, 400
+        if self.blockchain.add_transaction(values):
+            self.broadcast_transaction(values)
+            return {'message': 'Đã nhận giao dịch.'}, 201
+        return {'message': 'Giao dịch đã tồn tại.'}, 200
+
+    def handle_compact_block(self, compact: dict):
+        """Dựng lại khối từ mempool cục bộ, chỉ xin peer gốc những giao dịch còn thiếu."""
+        if not is_valid_compact_block(compact):
+            return {'error': 'Khối nén không hợp lệ.'}, 400
+        header, short_ids = compact['header'], compact.get('short_ids', [])
+        last_b = self.blockchain.last_block
+        if header['index'] <= last_b.index:
+            return {'message': 'Khối đã tồn tại.'}, 200
+        if header['index'] != last_b.index + 1 or header.get('previous_hash') != last_b.hash:
+            return {'error': 'Khối không nối tiếp chuỗi hiện tại.'}, 409
+        if not meets_difficulty(header['hash'], self.blockchain.difficulty):
+            return {'error': 'Khối không đạt độ khó.'}, 400
+
+        transactions = [None] * len(short_ids)
+        for item in compact.get('prefilled', []):
+            transactions[item['index']] = item['tx']
+        mempool = {compact_short_id(header['hash'], tx): tx for tx in list(self.blockchain.pending_transactions)}
+        missing = []
+        for i, short_id in enumerate(short_ids):
+            if transactions[i] is not None: continue
+            tx = mempool.get(short_id)
+            if tx is None: missing.append(i)
+            else: transactions[i] = tx
+
+        origin = compact.get('origin')
+        if missing and not self._fill_missing_transactions(origin, header['hash'], transactions, missing):
+            return {'error': 'Không lấy được các giao dịch còn thiếu.'}, 502
+        block = self._block_from_header(header, transactions)
+        if block.hash != header['hash']:
+            # Va chạm short id hoặc mempool lệch nội dung: lấy lại toàn bộ thân khối từ peer gốc
+            self.logger.warning(f"[Compact] Dựng lại khối #{header['index']} sai hash. Đang tải toàn bộ giao dịch...")
+            if not self._fill_missing_transactions(origin, header['hash'], transactions, list(range(len(transactions)))):
+                return {'error': 'Không lấy được thân khối.'}, 502
+            block = self._block_from_header(header, transactions)
+            if block.hash != header['hash']:
+                return {'error': 'Hash khối không khớp.'}, 400
+
+        reason = self.validate_peer_block(block)
+        if reason:
+            return {'error': f"Khối không hợp lệ: {reason}"}, 400
+        if not self.blockchain.add_block_from_peer(block.to_dict()):
+            return {'error': 'Khối bị từ chối.'}, 409
+        self.refresh_local_tip()
+        self.logger.info(f"[Compact] Đã nhận khối #{block.index} ({len(transactions)} giao dịch, thiếu {len(missing)}).")
+        self.broadcast_block(block)
+        return {'message': 'Đã chấp nhận khối.'}, 200
+
+    @staticmethod
+    def _block_from_header(header: dict, transactions: list) -> Block:
+        return Block(index=header['index'], previous_hash=header['previous_hash'], timestamp=header['timestamp'], transactions=transactions, nonce=header['nonce'])
+
+    def _fill_missing_transactions(self, origin: str, block_hash: str, transactions: list, indexes: list) -> bool:
+        if not origin: return False
+        future = self._submit(self.client.post_json(f"{origin}/blocks/transactions", {"hash": block_hash, "indexes": indexes}, COMPACT_FETCH_TIMEOUT))
+        if future is None: return False
+        try:
+            status, data = future.result(timeout=COMPACT_FETCH_TIMEOUT + 1)
+            fetched = data.get('transactions', []) if status == 200 else []
+        except (*PEER_ERRORS, AttributeError, FutureTimeoutError):
+            return False
+        if not isinstance(fetched, list) or len(fetched) != len(indexes) or not all(isinstance(tx, dict) for tx in fetched): return False
+        for i, tx in zip(indexes, fetched):
+            transactions[i] = tx
+        return True
+
+    def get_block_transactions(self, block_hash: str, indexes: list):
+        """Trả về các giao dịch theo vị trí trong một khối đã lưu (phục vụ peer đang dựng lại khối nén)."""
+        cursor = self.blockchain.conn.cursor()
+        cursor.execute("SELECT transactions FROM blocks WHERE hash = ?", (block_hash,))
+        row = cursor.fetchone()
+        if not row: return None
+        txs = json.loads(row['transactions']) if isinstance(row['transactions'], str) else row['transactions']
+        if any(not isinstance(i, int) or not 0 <= i < len(txs) for i in indexes): return None
+        return [txs[i] for i in indexes]
 
-    def _broadcast_message(self, endpoint: str, data: dict):
+    async def _relay_transaction(self, transaction: dict):
+        # [TCP] Peer có phiên chỉ nhận INV (khóa giao dịch) và tự xin GETDATA nếu chưa có
+        key = mempool_key(transaction)
+        self.relay_cache[key] = transaction
+        self.relay_cache.move_to_end(key)
+        while len(self.relay_cache) > TCP_RELAY_CACHE_SIZE:
+            self.relay_cache.popitem(last=False)
+        await self._relay(MSG_INV, {"txs": [key]}, '/transactions/add_from_peer', transaction)
+
+    async def _relay(self, msg_type: int, frame_payload: Any, endpoint: str, data: dict):
+        # Không chặn luồng gọi: ưu tiên phiên TCP đang mở, các peer còn lại nhận qua HTTP song song
+        delivered = self.transport.broadcast(msg_type, frame_payload) if self.transport else set()
+        await self._broadcast_async(endpoint, data, skip=delivered)
+
+    async def _broadcast_async(self, endpoint: str, data: dict, skip: set = frozenset()):
         with self.blockchain.peer_lock:
-            peers_to_broadcast = list(self.blockchain.peers.values())
-        
-        for peer in peers_to_broadcast:
+            peers_to_broadcast = [peer for node_id, peer in self.blockchain.peers.items() if node_id not in skip]
+        async def send(address):
             try:
-                requests.post(f"{peer['address']}{endpoint}", json=data, timeout=2)
-            except requests.exceptions.RequestException:
-                continue
+                await self.client.post_json(f"{address}{endpoint}", data, P2P_BROADCAST_TIMEOUT)
+            except PEER_ERRORS:
+                pass
+        await asyncio.gather(*(send(peer['address']) for peer in peers_to_broadcast))
 
-    def _run_seeder_bootstrap(self):
+    async def _run_seeder_bootstrap(self):
         self.logger.info(f"[Lớp 0 - Seeder] Đang cố gắng kết nối đến Seeder Node tại {SEEDER_NODE_URL}...")
         for attempt in range(5):
             try:
-                response = requests.get(f"{SEEDER_NODE_URL}/get_active_peers", timeout=5)
-                if response.status_code == 200:
-                    data = response.json()
-                    seed_peers = data.get("active_nodes", [])
-                    if seed_peers:
-                        self.logger.info(f"✅ [Lớp 0] Nhận được {len(seed_peers)} peer từ Seeder. Bắt đầu handshake...")
-                        for url in seed_peers:
-                            self._handshake_and_register(url)
-                        self.logger.info("✅ [Lớp 0] Hoàn tất bootstrap từ Seeder.")
-                        return 
-            except requests.RequestException as e:
-                self.logger.warning(f"  -> [Lớp 0] Lần {attempt + 1}/5: Không thể kết nối đến Seeder: {e}")
-                if self.is_running:
-                    time.sleep(10)
+                data = await self.client.get_json(f"{SEEDER_NODE_URL}/get_active_peers", timeout=5)
+                seed_peers = (data or {}).get("active_nodes", [])
+                if seed_peers:
+                    self.logger.info(f"✅ [Lớp 0] Nhận được {len(seed_peers)} peer từ Seeder. Bắt đầu handshake...")
+                    await self._handshake_many(seed_peers)
+                    self.logger.info("✅ [Lớp 0] Hoàn tất bootstrap từ Seeder.")
+                    return 
+            except PEER_ERRORS as e:
+                self.logger.warning(f"  -> [Lớp 0] Lần {attempt + 1}/5: Không thể kết nối đến Seeder: {e!r}")
+                await asyncio.sleep(10)
         self.logger.error("!!! [Lớp 0] KHÔNG THỂ KẾT NỐI ĐẾN SEEDER NODE. Node có thể bị cô lập.")
 
-    def _run_lan_discovery(self):
+    async def _run_lan_discovery(self):
         self.logger.info(f"[Lớp 1 - LAN] Đang lắng nghe khám phá trên UDP port {self.DISCOVERY_PORT}.")
         listener_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
             listener_socket.bind(('', self.DISCOVERY_PORT))
         except OSError as e:
+            listener_socket.close()
             self.logger.error(f"LỖI: Không thể bind đến cổng UDP {self.DISCOVERY_PORT}. Lỗi: {e}")
             return
-            
-        broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
+        loop = asyncio.get_running_loop()
+        listener, _ = await loop.create_datagram_endpoint(lambda: _DiscoveryProtocol(self), sock=listener_socket)
+        broadcaster, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, family=socket.AF_INET, allow_broadcast=True)
         broadcast_payload = json.dumps({
             "protocol": "sokchain_discovery", 
             "node_id": self.node_wallet.get_address(), 
             "port": self.node_port
         }).encode('utf-8')
-
-        last_broadcast_time = 0
-        while self.is_running:
-            if time.time() - last_broadcast_time > 60:
+        try:
+            while self.is_running:
                 try:
-                    broadcast_socket.sendto(broadcast_payload, ('<broadcast>', self.DISCOVERY_PORT))
-                    last_broadcast_time = time.time()
-                except Exception: pass
-            
-            listener_socket.settimeout(1.0)
-            try:
-                data, addr = listener_socket.recvfrom(1024)
-                message = json.loads(data.decode('utf-8'))
-                if message.get("protocol") == "sokchain_discovery":
-                    new_node_id, new_node_port, new_node_ip = message.get("node_id"), message.get("port"), addr[0]
-                    if new_node_id and new_node_id != self.node_wallet.get_address():
-                        self.blockchain.register_node(new_node_id, f"http://{new_node_ip}:{new_node_port}")
-            except (socket.timeout, json.JSONDecodeError, KeyError, UnicodeDecodeError):
-                continue
+                    broadcaster.sendto(broadcast_payload, ('<broadcast>', self.DISCOVERY_PORT))
+                except OSError: pass
+                await asyncio.sleep(60)
+        finally:
+            listener.close(); broadcaster.close()
 
-    def _run_map_file_sync(self):
-        self.logger.info(f"[Lớp 2 - Map Sync] Đang theo dõi tệp '{LIVE_NETWORK_CONFIG_FILE}'...")
+    async def _run_map_file_sync(self):
+        self.logger.info(f"[Lớp 2 - Map Sync] Đang theo dõi tệp '{LIVE_NETWORK_CONFIG_FILE}' (phiên bản {self.network_map.version})...")
         while self.is_running:
-            if os.path.exists(LIVE_NETWORK_CONFIG_FILE):
-                try:
-                    with open(LIVE_NETWORK_CONFIG_FILE, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    active_node_urls = data.get("active_nodes", [])
-                    if active_node_urls:
-                        for url in active_node_urls:
-                            self._handshake_and_register(url)
-                except (json.JSONDecodeError, IOError): pass
-            time.sleep(3 * 60)
-
-    def _run_peer_exchange(self):
-        self.logger.info("[Lớp 3 - PEX] Luồng trao đổi peer đã sẵn sàng.")
-        time.sleep(45)
+            # Tệp có thể được Ranger ghi trực tiếp mà không gửi /network/update_map tới node này
+            await asyncio.to_thread(self.network_map.reload_if_changed)
+            await asyncio.to_thread(self.network_map.flush)
+            active_node_urls = self.network_map.snapshot()
+            if active_node_urls:
+                await self._handshake_many(active_node_urls)
+            await asyncio.sleep(3 * 60)
+
+    def handle_map_update(self, data: Any):
+        """Áp dụng cập nhật bản đồ từ Ranger (gọi từ luồng API); việc ghi đĩa được gom và chạy trên event loop."""
+        response, code, added_nodes = self.network_map.apply_update(data)
+        if code == 202:
+            if self.loop and not self.loop.is_closed() and self.is_running:
+                self.loop.call_soon_threadsafe(self._schedule_map_flush)
+                if added_nodes:
+                    self._submit(self._handshake_many(list(added_nodes)))
+            else:
+                self.network_map.flush()
+        return response, code
+
+    def _schedule_map_flush(self):
+        if self._map_flush_handle is None:
+            self._map_flush_handle = self.loop.call_later(MAP_WRITE_COALESCE_SECONDS, self._start_map_flush)
+
+    def _start_map_flush(self):
+        self._map_flush_handle = None
+        asyncio.create_task(asyncio.to_thread(self.network_map.flush), name="Map-Flush")
+
+    async def _run_peer_exchange(self):
+        self.logger.info("[Lớp 3 - PEX] Tác vụ trao đổi peer đã sẵn sàng.")
+        await asyncio.sleep(45)
         while self.is_running:
             with self.blockchain.peer_lock:
                 all_peers = list(self.blockchain.peers.values())
             
             if not all_peers:
-                time.sleep(30); continue
+                await asyncio.sleep(30); continue
 
             random_peer = random.choice(all_peers)
             peer_address = random_peer['address']
             
             try:
-                response = requests.get(f"{peer_address}/nodes/peers", timeout=5)
-                if response.status_code == 200:
-                    peers_from_node = response.json()
+                peers_from_node = await self.client.get_json(f"{peer_address}/nodes/peers", timeout=5)
+                if isinstance(peers_from_node, dict):
                     self.blockchain.merge_peers(peers_from_node, self.node_wallet.get_address())
-            except requests.RequestException: pass 
-            time.sleep(5 * 60)
+            except PEER_ERRORS: pass 
+            await asyncio.sleep(5 * 60)
+
+    async def _handshake_many(self, base_urls: list):
+        await asyncio.gather(*(self._handshake_and_register(url) for url in base_urls))
             
-    def _handshake_and_register(self, base_url: str):
+    async def _handshake_and_register(self, base_url: str):
         if not isinstance(base_url, str) or not base_url:
             return
         try:
@@ -195,35 +989,332 @@ class HybridP2PManager:
             else:
                 full_url = base_url
                 
-            response = requests.get(f'{full_url}/handshake', timeout=3)
-            if response.status_code == 200:
-                node_id = response.json().get('node_id')
-                if node_id and node_id != self.node_wallet.get_address():
-                    self.blockchain.register_node(node_id, full_url)
-        except requests.RequestException: pass
-
-    # === [HÀM MỚI] Luồng Đồng bộ hóa Chủ động ===
-    def _run_active_chain_sync(self):
+            data = await self.client.get_json(f'{full_url}/handshake', timeout=3)
+            node_id = (data or {}).get('node_id')
+            if node_id and node_id != self.node_wallet.get_address():
+                self.blockchain.register_node(node_id, full_url)
+                tcp_port = data.get('tcp_port')
+                if isinstance(tcp_port, int) and 0 < tcp_port < 65536:
+                    self.peer_tcp_endpoints[node_id] = (urlparse(full_url).hostname, tcp_port)
+        except PEER_ERRORS: pass
+
+    # === [NÂNG CẤP] Kênh TCP bền vững giữa các node ===
+    async def _start_transport(self):
+        transport = TcpTransport(self.node_wallet, self.tcp_port, self.public_url, self._on_transport_message,
+                                 hello_extras=lambda: {"tip": list(self.local_tip)})
+        try:
+            await transport.start()
+            self.transport = transport
+        except OSError as e:
+            self.logger.error(f"LỖI: Không thể mở cổng TCP P2P {self.tcp_port}, chỉ dùng HTTP. Lỗi: {e}")
+
+    async def _run_tcp_connector(self):
+        """Duy trì phiên TCP ra ngoài tới các peer đã quảng bá cổng TCP trong handshake (lùi dần khi lỗi)."""
+        while self.is_running:
+            now = time.monotonic()
+            sessions = self.transport.sessions
+            free_slots = TCP_MAX_OUTBOUND - sum(1 for conn in sessions.values() if conn.outbound)
+            candidates = [(node_id, endpoint) for node_id, endpoint in self.peer_tcp_endpoints.items()
+                          if node_id not in sessions and self._tcp_retry_at.get(node_id, (0, 0))[0] <= now]
+            random.shuffle(candidates)
+            await asyncio.gather(*(self._open_tcp_session(node_id, *endpoint) for node_id, endpoint in candidates[:max(0, free_slots)]))
+            await asyncio.sleep(TCP_CONNECT_INTERVAL)
+
+    async def _open_tcp_session(self, node_id: str, host: str, port: int):
+        try:
+            established = await self.transport.connect(host, port)
+        except TRANSPORT_ERRORS:
+            established = False
+        if established:
+            self._tcp_retry_at.pop(node_id, None)
+            return
+        delay = min(self._tcp_retry_at.get(node_id, (0, TCP_CONNECT_INTERVAL))[1] * 2, TCP_RECONNECT_MAX_DELAY)
+        self._tcp_retry_at[node_id] = (time.monotonic() + delay, delay)
+
+    async def _on_transport_message(self, conn: PeerConnection, msg_type: int, payload: Any):
+        if not isinstance(payload, dict):
+            return
+        if msg_type in (MSG_HELLO, MSG_PING, MSG_PONG):
+            if msg_type == MSG_HELLO and conn.listen_url:
+                self.blockchain.register_node(conn.node_id, conn.listen_url)
+            tip = payload.get("tip")
+            if isinstance(tip, list) and len(tip) == 2 and isinstance(tip[0], int) and conn.listen_url:
+                self.note_peer_tip(conn.listen_url, tip[0], tip[1])
+        elif msg_type == MSG_INV:
+            keys = [k for k in (payload.get("txs") or [])[:TCP_MAX_INV_ITEMS] if isinstance(k, str)]
+            unknown = [k for k in keys if k not in self.blockchain.seen_transaction_hashes]
+            if unknown:
+                conn.send(MSG_GETDATA, {"txs": unknown})
+        elif msg_type == MSG_GETDATA:
+            for key in (payload.get("txs") or [])[:TCP_MAX_INV_ITEMS]:
+                tx = self.relay_cache.get(key) if isinstance(key, str) else None
+                if tx is not None:
+                    conn.send(MSG_TX, tx)
+        elif msg_type == MSG_TX:
+            # Kiểm tra chữ ký/số dư và ghi mempool là việc chặn -> đưa sang luồng phụ
+            await asyncio.to_thread(self.accept_peer_transaction, payload)
+        elif msg_type == MSG_BLOCK:
+            await asyncio.to_thread(self.handle_compact_block, payload)
+
+    # === [NÂNG CẤP] Đồng bộ hóa theo thông báo đỉnh chuỗi ===
+    def refresh_local_tip(self):
+        last_b = self.blockchain.last_block
+        self.local_tip = (last_b.index, last_b.hash)
+
+    def _tip_headers(self) -> dict:
+        height, tip_hash = self.local_tip
+        return {TIP_HEIGHT_HEADER: str(height), TIP_HASH_HEADER: tip_hash or '', NODE_URL_HEADER: self.public_url}
+
+    def is_known_peer(self, address: str) -> bool:
+        with self.blockchain.peer_lock:
+            return any(peer.get('address') == address for peer in self.blockchain.peers.values())
+
+    def note_peer_tip(self, address: str, height: int, tip_hash: Optional[str]):
         """
-        Luồng này chạy định kỳ để chủ động giải quyết xung đột và đảm bảo node
-        luôn ở trên chuỗi dài nhất.
+        Ghi nhận đỉnh chuỗi một peer thông báo (có thể gọi từ bất kỳ luồng nào).
+        Chỉ đánh thức event loop khi peer có nhiều khối hơn ta, nên node nhàn rỗi gần như không tốn công đồng bộ.
         """
-        self.logger.info("[Lớp 4 - Active Sync] Luồng đồng bộ hóa chủ động đã sẵn sàng.")
-        time.sleep(60) 
+        if height <= self.local_tip[0] or not address:
+            return
+        if not self.loop or self.loop.is_closed() or not self.is_running:
+            return
+        self.loop.call_soon_threadsafe(self._on_peer_tip, address, height, tip_hash)
 
-        while self.is_running:
-            self.logger.info("[Active Sync] Đang thực hiện kiểm tra và giải quyết xung đột...")
+    def _on_peer_tip(self, address: str, height: int, tip_hash: Optional[str]):
+        self.peer_tips[address] = (height, tip_hash, time.monotonic())
+        self._sync_requested = True
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._run_coalesced_sync(), name="Tip-Sync")
+
+    async def _run_coalesced_sync(self):
+        """Gom mọi thông báo tip đến trong lúc chờ/đang đồng bộ thành một lần chạy kế tiếp."""
+        while self._sync_requested and self.is_running:
+            delay = max(SYNC_DEBOUNCE_SECONDS, self._last_sync_at + SYNC_MIN_INTERVAL - time.monotonic())
+            await asyncio.sleep(delay)
+            self._sync_requested = False
+            self.refresh_local_tip()
+            now = time.monotonic()
+            candidates = [_SyncPeer(address, height) for address, (height, _, seen_at) in self.peer_tips.items()
+                          if height > self.local_tip[0] and now - seen_at < SYNC_TIP_TTL]
+            if not candidates:
+                continue
+            self._last_sync_at = time.monotonic()
+            best = max(candidates, key=lambda p: p.height)
+            self.logger.info(f"[Active Sync] Peer {best.address} thông báo đỉnh #{best.height} (ta đang ở #{self.local_tip[0]}). Đang đồng bộ...")
             try:
-                replaced = self.blockchain.resolve_conflicts()
+                replaced = await self.sync_engine.sync(candidates)
                 if replaced:
                     self.logger.info(Style.BRIGHT + Fore.GREEN + "[Active Sync] Chuỗi đã được cập nhật lên phiên bản mới hơn từ mạng lưới.")
-                else:
-                    self.logger.info("[Active Sync] Chuỗi hiện tại đã là mới nhất.")
             except Exception as e:
-                self.logger.error(f"[Active Sync] Lỗi trong quá trình giải quyết xung đột: {e}")
-            
-            # Lặp lại sau mỗi 60 giây
-            time.sleep(60)
+                self.logger.error(f"[Active Sync] Lỗi trong quá trình đồng bộ: {e}")
+            self.refresh_local_tip()
+            self.peer_tips = {a: t for a, t in self.peer_tips.items() if t[0] > self.local_tip[0]}
+
+# === [NÂNG CẤP] Kiểm soát tiếp nhận (admission control) cho Node API ===
+NODE_API_THREADS = 16
+ADMISSION_MAX_TRACKED_CLIENTS = 10000
+# Mỗi lớp endpoint có token bucket riêng cho từng client và cho toàn lớp, cùng số slot xử lý đồng thời
+# và một hàng đợi giới hạn. Các lớp đọc công khai bị giới hạn slot thấp hơn số luồng waitress,
+# nên luôn còn luồng trống cho gossip giữa các peer và giao dịch mới.
+ADMISSION_POLICIES = {
+    # lớp:        tốc độ/burst mỗi client, tốc độ/burst toàn lớp, slot đồng thời, hàng đợi tối đa, thời gian chờ (giây)
+    'gossip':     {'client_rate': 50,  'client_burst': 100, 'global_rate': 500, 'global_burst': 1000, 'max_concurrent': 8, 'max_queue': 32, 'queue_timeout': 2.0},
+    'intake':     {'client_rate': 10,  'client_burst': 20,  'global_rate': 200, 'global_burst': 400,  'max_concurrent': 8, 'max_queue': 32, 'queue_timeout': 2.0},
+    'sync':       {'client_rate': 20,  'client_burst': 40,  'global_rate': 100, 'global_burst': 200,  'max_concurrent': 3, 'max_queue': 3,  'queue_timeout': 1.0},
+    'map':        {'client_rate': 0.1, 'client_burst': 2,   'global_rate': 1,   'global_burst': 5,    'max_concurrent': 1, 'max_queue': 1,  'queue_timeout': 0.5},
+    'mining':     {'client_rate': 1,   'client_burst': 2,   'global_rate': 2,   'global_burst': 4,    'max_concurrent': 1, 'max_queue': 0,  'queue_timeout': 0.0},
+    'read':       {'client_rate': 5,   'client_burst': 10,  'global_rate': 50,  'global_burst': 100,  'max_concurrent': 4, 'max_queue': 2,  'queue_timeout': 0.5},
+    'heavy_read': {'client_rate': 0.2, 'client_burst': 1,   'global_rate': 2,   'global_burst': 4,    'max_concurrent': 2, 'max_queue': 1,  'queue_timeout': 0.5},
+}
+ENDPOINT_CLASSES = {
+    '/transactions/new': 'intake',
+    '/transactions/add_from_peer': 'gossip', '/blocks/compact': 'gossip', '/blocks/transactions': 'gossip',
+    '/blocks/add_from_peer': 'gossip', '/handshake': 'gossip', '/nodes/peers': 'gossip',
+    '/nodes/update_map': 'map',
+    '/chain/headers': 'sync', '/chain/blocks': 'sync',
+    '/chain': 'heavy_read',
+    '/mine': 'mining',
+}
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """Lấy một token. Trả về 0 nếu thành công, ngược lại là số giây cần chờ."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        """Trả lại token vừa lấy khi yêu cầu bị từ chối ở bước sau (không vượt quá dung lượng)."""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+class AdmissionControl:
+    """
+    WSGI middleware đặt trước Flask app: giới hạn tốc độ theo client và theo lớp endpoint,
+    giới hạn số yêu cầu xử lý đồng thời mỗi lớp, và loại bỏ sớm (429/503) thay vì để
+    các yêu cầu đọc nặng như /chain chiếm hết luồng của waitress.
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.logger = logging.getLogger("AdmissionControl")
+        self.global_buckets = {name: TokenBucket(p['global_rate'], p['global_burst']) for name, p in ADMISSION_POLICIES.items()}
+        self.slots = {name: threading.BoundedSemaphore(p['max_concurrent']) for name, p in ADMISSION_POLICIES.items()}
+        self.waiting = {name: 0 for name in ADMISSION_POLICIES}
+        self.client_buckets: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def classify(path: str) -> str:
+        return ENDPOINT_CLASSES.get(path.rstrip('/') or '/', 'read')
+
+    def _client_bucket(self, client: str, endpoint_class: str) -> TokenBucket:
+        key = (client, endpoint_class)
+        with self.lock:
+            bucket = self.client_buckets.get(key)
+            if bucket is None:
+                policy = ADMISSION_POLICIES[endpoint_class]
+                bucket = self.client_buckets[key] = TokenBucket(policy['client_rate'], policy['client_burst'])
+                if len(self.client_buckets) > ADMISSION_MAX_TRACKED_CLIENTS:
+                    self.client_buckets.popitem(last=False)
+            else:
+                self.client_buckets.move_to_end(key)
+            return bucket
+
+    def _acquire_slot(self, endpoint_class: str) -> bool:
+        slot, policy = self.slots[endpoint_class], ADMISSION_POLICIES[endpoint_class]
+        if slot.acquire(blocking=False):
+            return True
+        with self.lock:
+            if self.waiting[endpoint_class] >= policy['max_queue']:
+                return False
+            self.waiting[endpoint_class] += 1
+        try:
+            return slot.acquire(timeout=policy['queue_timeout'])
+        finally:
+            with self.lock:
+                self.waiting[endpoint_class] -= 1
+
+    @staticmethod
+    def _reject(start_response, status: str, message: str, retry_after: float):
+        body = json.dumps({'error': message}).encode('utf-8')
+        start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body))), ('Retry-After', str(max(1, int(retry_after + 0.999))))])
+        return [body]
+
+    def __call__(self, environ, start_response):
+        endpoint_class = self.classify(environ.get('PATH_INFO', '/'))
+        client = environ.get('REMOTE_ADDR', 'unknown')
+        client_bucket = self._client_bucket(client, endpoint_class)
+        retry_after = client_bucket.try_acquire()
+        if not retry_after:
+            retry_after = self.global_buckets[endpoint_class].try_acquire()
+            # Quá tải toàn cục không phải lỗi của client này: hoàn token để client không bị phạt sau khi hết quá tải
+            if retry_after: client_bucket.refund()
+        if retry_after:
+            self.logger.debug(f"429 {endpoint_class} cho {client}")
+            return self._reject(start_response, '429 Too Many Requests', 'Quá nhiều yêu cầu. Vui lòng thử lại sau.', retry_after)
+        if not self._acquire_slot(endpoint_class):
+            self.logger.debug(f"503 {endpoint_class}: hàng đợi đầy")
+            return self._reject(start_response, '503 Service Unavailable', 'Node đang quá tải. Vui lòng thử lại sau.', 1)
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            self.slots[endpoint_class].release()
+
+# --- CÁC ENDPOINT P2P BỔ SUNG CHO NODE API ---
+def register_peer_routes(app, blockchain: Blockchain, p2p_manager: HybridP2PManager):
+    """Gắn các endpoint giao tiếp giữa các node vào app được tạo bởi sok.node_api."""
+
+    # === Thông báo đỉnh chuỗi: đọc tip của peer từ mọi yêu cầu đến, gắn tip cục bộ vào mọi phản hồi ===
+    @app.before_request
+    def read_peer_tip():
+        height = request.headers.get(TIP_HEIGHT_HEADER, type=int)
+        origin = request.headers.get(NODE_URL_HEADER)
+        if height is not None and origin and height > p2p_manager.local_tip[0] and p2p_manager.is_known_peer(origin):
+            p2p_manager.note_peer_tip(origin, height, request.headers.get(TIP_HASH_HEADER))
+
+    @app.after_request
+    def attach_local_tip(response):
+        height, tip_hash = p2p_manager.local_tip
+        response.headers[TIP_HEIGHT_HEADER] = str(height)
+        response.headers[TIP_HASH_HEADER] = tip_hash or ''
+        return response
+
+    def handshake_with_tip():
+        height, tip_hash = p2p_manager.local_tip
+        tcp_port = p2p_manager.transport.port if p2p_manager.transport else None
+        return jsonify({"node_id": p2p_manager.node_wallet.get_address(), "tip": {"height": height, "hash": tip_hash}, "tcp_port": tcp_port}), 200
+    app.view_functions['handshake'] = handshake_with_tip
+
+    # Thay cho phiên bản gốc (mỗi POST sinh một luồng ghi lại toàn bộ tệp): nhận delta có phiên bản, gom lần ghi
+    def update_network_map():
+        response, code = p2p_manager.handle_map_update(request.get_json(silent=True))
+        return jsonify(response), code
+    app.view_functions['update_network_map'] = update_network_map
+
+    @app.route('/blocks/compact', methods=['POST'])
+    def receive_compact_block():
+        data = request.get_json(silent=True)
+        if not data: return jsonify({'error': 'Dữ liệu không hợp lệ.'}), 400
+        response, code = p2p_manager.handle_compact_block(data)
+        return jsonify(response), code
+
+    @app.route('/blocks/transactions', methods=['POST'])
+    def get_block_transactions():
+        data = request.get_json(silent=True) or {}
+        txs = p2p_manager.get_block_transactions(data.get('hash', ''), data.get('indexes') or [])
+        if txs is None: return jsonify({'error': 'Không tìm thấy khối hoặc chỉ số không hợp lệ.'}), 404
+        return jsonify({'transactions': txs}), 200
+
+    # === Phục vụ đồng bộ Headers-First ===
+    @app.route('/chain/headers', methods=['GET'])
+    def get_chain_headers():
+        start = max(0, request.args.get('start', 0, type=int))
+        limit = max(0, min(request.args.get('limit', SYNC_HEADERS_PAGE_SIZE, type=int), SYNC_HEADERS_PAGE_SIZE))
+        cursor = blockchain.conn.cursor()
+        cursor.execute('SELECT "index", hash, previous_hash, timestamp, nonce FROM blocks WHERE "index" >= ? ORDER BY "index" ASC LIMIT ?', (start, limit))
+        headers = [dict(row) for row in cursor.fetchall()]
+        return jsonify({'headers': headers, 'height': blockchain.last_block.index}), 200
+
+    @app.route('/chain/blocks', methods=['GET'])
+    def get_chain_blocks():
+        start = max(0, request.args.get('start', 0, type=int))
+        limit = max(0, min(request.args.get('limit', SYNC_MAX_BLOCKS_PER_REQUEST, type=int), SYNC_MAX_BLOCKS_PER_REQUEST))
+        cursor = blockchain.conn.cursor()
+        cursor.execute('SELECT * FROM blocks WHERE "index" >= ? ORDER BY "index" ASC LIMIT ?', (start, limit))
+        blocks = []
+        for row in cursor.fetchall():
+            block = dict(row)
+            block['transactions'] = json.loads(block['transactions'])
+            blocks.append(block)
+        return jsonify({'blocks': blocks}), 200
+
+    # Các endpoint mà broadcast_* nhắm tới nhưng sok.node_api chưa cung cấp.
+    # Compact Block cần mempool của peer được lấp đầy qua /transactions/add_from_peer.
+    if 'add_transaction_from_peer' not in app.view_functions:
+        @app.route('/transactions/add_from_peer', methods=['POST'])
+        def add_transaction_from_peer():
+            response, code = p2p_manager.accept_peer_transaction(request.get_json(silent=True))
+            return jsonify(response), code
+
+    if 'add_block_from_peer' not in app.view_functions:
+        @app.route('/blocks/add_from_peer', methods=['POST'])
+        def add_block_from_peer():
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict): return jsonify({'error': 'Dữ liệu không hợp lệ.'}), 400
+            response, code = p2p_manager.accept_peer_block(data)
+            return jsonify(response), code
 
 # --- ĐIỂM VÀO CHÍNH CỦA CHƯƠNG TRÌNH ---
 if __name__ == '__main__':
@@ -254,6 +1345,7 @@ if __name__ == '__main__':
             sys.exit(1)
     
     port = int(os.environ.get('PORT', Config.DEFAULT_NODE_PORT))
+    tcp_port = int(os.environ.get('P2P_TCP_PORT', port + TCP_PORT_OFFSET))
     
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -262,7 +1354,7 @@ if __name__ == '__main__':
     finally: s.close()
         
     blockchain_instance = Blockchain(db_path=DB_FILE_PATH)
-    p2p_manager = HybridP2PManager(blockchain=blockchain_instance, node_wallet=node_wallet, node_port=port, host_ip=host_ip)
+    p2p_manager = HybridP2PManager(blockchain=blockchain_instance, node_wallet=node_wallet, node_port=port, host_ip=host_ip, tcp_port=tcp_port)
     
     app = create_app(
         blockchain=blockchain_instance,
@@ -270,6 +1362,8 @@ if __name__ == '__main__':
         node_wallet=node_wallet,
         genesis_wallet=genesis_wallet
     )
+    register_peer_routes(app, blockchain_instance, p2p_manager)
+    app.wsgi_app = AdmissionControl(app.wsgi_app)
     
     p2p_manager.start()
     
@@ -283,6 +1377,10 @@ if __name__ == '__main__':
         logging.info("Không tìm thấy 'genesis_wallet.pem'. Đang khởi chạy ở chế độ [NODE PHỤ].")
     print(f"      ---   Node ID: {node_wallet.get_address()} ---")
     print(f"      ---   Lắng nghe API tại: http://{host_ip}:{port}        ---")
-    print(Style.BRIGHT + Fore.CYAN + f"      ---   P2P: Seeder + LAN + Map File + PEX + Active Sync ---")
+    print(Style.BRIGHT + Fore.CYAN + f"      ---   P2P: Seeder + LAN + Map File + PEX + Tip Sync ---")
+    print(f"      ---   Kênh TCP P2P: {f'cổng {tcp_port}' if tcp_port else 'TẮT (chỉ HTTP)'} ---")
     print("=" * 60)
-    serve(app, host='0.0.0.0', port=port, threads=16)
+    try:
+        serve(app, host='0.0.0.0', port=port, threads=NODE_API_THREADS)
+    finally:
+        p2p_manager.stop()
@@ -14,9 +14,13 @@ import sys
 import requests
 import json
 import time
+import hashlib
 import logging
 import random # <-- THÊM MỚI
-from typing import Set, Dict, Any
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Set, Dict, Any, List, Optional
+from requests.adapters import HTTPAdapter
 
 # Thêm đường dẫn dự án
 project_root = os.path.abspath(os.path.dirname(__file__))
@@ -30,6 +34,21 @@ DISCOVERY_INTERVAL_SECONDS = 5 * 60
 LOG_FILE = "ranger_agent.log"
 BROADCAST_COUNT = 3 # Số lượng node ngẫu nhiên để gửi bản đồ tới
 
+# === [NÂNG CẤP] Trình quét song song ===
+CRAWL_MAX_WORKERS = 32              # Số node được thăm dò đồng thời tối đa
+CRAWL_CYCLE_DEADLINE_SECONDS = 30   # Hạn chót cho toàn bộ một chu kỳ quét
+CRAWL_PROBE_TIMEOUT = (2, 3)        # (kết nối, đọc) cho mỗi yêu cầu thăm dò
+CRAWL_BACKOFF_BASE_SECONDS = 60     # Node không phản hồi bị tạm bỏ qua; thời gian nhân đôi sau mỗi lần lỗi
+CRAWL_BACKOFF_MAX_SECONDS = 30 * 60
+
+# === [NÂNG CẤP] Trạng thái quét tăng dần, lưu bền giữa các lần chạy ===
+CRAWL_STATE_FILE = "ranger_crawl_state.json"
+CRAWL_HEALTHY_REPROBE_SECONDS = 10 * 60  # Node khỏe chỉ được thăm dò lại sau khoảng này (có dao động ±20%)
+CRAWL_FORGET_AFTER_FAILURES = 12         # Quên node (không phải bootstrap) sau chừng này lần lỗi liên tiếp
+
+# url -> {node_id, last_success, failure_streak, next_probe_at, latency_ms, height, peers}
+_crawl_state: Optional[Dict[str, Dict[str, Any]]] = None
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [RangerAgent] [%(levelname)s] - %(message)s',
@@ -53,95 +72,218 @@ def load_bootstrap_peers() -> dict:
         logging.error(f"Lỗi khi đọc tệp cấu hình bootstrap: {e}.")
     return {}
 
+def network_map_hash(nodes) -> str:
+    """Hash nội dung bản đồ mạng. Phải giống hệt hàm cùng tên trong run_node_Act_Sync.py."""
+    return hashlib.sha256(json.dumps(sorted(set(nodes)), separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def load_network_map() -> Dict[str, Any]:
+    """Đọc bản đồ đã ghi lần trước: {version, hash, active_nodes}. Tệp định dạng cũ được coi là phiên bản 0."""
+    nodes: List[str] = []
+    version = 0
+    if os.path.exists(LIVE_NETWORK_CONFIG_FILE):
+        try:
+            with open(LIVE_NETWORK_CONFIG_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            nodes = [u for u in data.get("active_nodes", []) if isinstance(u, str)]
+            version = data.get("version", 0) if isinstance(data.get("version"), int) else 0
+        except (IOError, json.JSONDecodeError, AttributeError) as e:
+            logging.warning(f"Không thể đọc bản đồ mạng cũ, sẽ ghi lại từ đầu: {e}")
+    return {"version": version, "hash": network_map_hash(nodes), "active_nodes": sorted(set(nodes))}
+
 def normalize_url(address: str) -> str:
     if not isinstance(address, str): return ""
     if address.startswith("http://") or address.startswith("https://"):
         return address
     return f"http://{address}"
 
-def run_deep_discovery_cycle(bootstrap_peers: Dict[str, Any]):
+def load_crawl_state() -> Dict[str, Dict[str, Any]]:
+    if not os.path.exists(CRAWL_STATE_FILE):
+        return {}
+    try:
+        with open(CRAWL_STATE_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data.get("nodes", {}) if isinstance(data, dict) else {}
+    except (IOError, json.JSONDecodeError) as e:
+        logging.error(f"Không thể đọc trạng thái quét '{CRAWL_STATE_FILE}', bắt đầu lại từ đầu: {e}")
+        return {}
+
+def save_crawl_state(state: Dict[str, Dict[str, Any]]):
+    temp_file = CRAWL_STATE_FILE + ".tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump({"nodes": state}, f)
+    os.replace(temp_file, CRAWL_STATE_FILE)
+
+def _record_probe_result(state: Dict[str, Dict[str, Any]], node_url: str, result: Optional[Dict[str, Any]], now: float) -> Dict[str, Any]:
+    entry = state.setdefault(node_url, {"failure_streak": 0})
+    if result is None:
+        entry["failure_streak"] = entry.get("failure_streak", 0) + 1
+        entry["next_probe_at"] = now + min(CRAWL_BACKOFF_BASE_SECONDS * 2 ** min(entry["failure_streak"] - 1, 16), CRAWL_BACKOFF_MAX_SECONDS)
+        return entry
+    entry.update(node_id=result["node_id"], latency_ms=result["latency_ms"], height=result["height"], last_success=now,
+                 failure_streak=0, next_probe_at=now + CRAWL_HEALTHY_REPROBE_SECONDS * random.uniform(0.8, 1.2),
+                 peers={peer_id: normalize_url(peer_data.get('address')) for peer_id, peer_data in result["peers"].items()
+                        if isinstance(peer_data, dict) and peer_data.get('address')})
+    return entry
+
+def probe_node(session: requests.Session, node_url: str) -> Optional[Dict[str, Any]]:
+    """Thăm dò một node: handshake (đo độ trễ, lấy chiều cao chuỗi) rồi lấy danh sách peer của nó."""
+    started = time.monotonic()
+    try:
+        handshake_resp = session.get(f'{node_url}/handshake', timeout=CRAWL_PROBE_TIMEOUT)
+        data = handshake_resp.json() if handshake_resp.status_code == 200 else {}
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+    node_id = data.get('node_id') if isinstance(data, dict) else None
+    if not node_id:
+        return None
+    latency_ms = round((time.monotonic() - started) * 1000, 1)
+    tip = data.get('tip') if isinstance(data.get('tip'), dict) else {}
+
+    peers: Dict[str, Any] = {}
+    try:
+        response = session.get(f"{node_url}/nodes/peers", timeout=CRAWL_PROBE_TIMEOUT)
+        if response.status_code == 200 and isinstance(response.json(), dict):
+            peers = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        pass
+    return {"url": node_url, "node_id": node_id, "latency_ms": latency_ms, "height": tip.get('height'),
+            "last_seen": time.time(), "peers": peers}
+
+def crawl_network(seed_urls: Set[str], state: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Quét đồ thị peer song song (tối đa CRAWL_MAX_WORKERS yêu cầu cùng lúc) trong hạn chót của chu kỳ.
+    Chỉ thăm dò các node đến hạn theo `state`; node khỏe chưa đến hạn được dùng lại kết quả lần trước
+    (kể cả danh sách peer nó quảng bá), node đang lỗi thì chờ hết thời gian lùi.
+    Mỗi URL chỉ xét một lần; node đã trả lời dưới một URL khác không bị thăm dò lại.
+    Trả về {node_id: bản ghi} của các node đang hoạt động.
+    """
+    deadline = time.monotonic() + CRAWL_CYCLE_DEADLINE_SECONDS
+    live: Dict[str, Dict[str, Any]] = {}
+    scheduled: Set[str] = set()
+    frontier = deque([(url, None) for url in seed_urls] + [(url, entry.get("node_id")) for url, entry in state.items()])
+    probed = reused = skipped = 0
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=CRAWL_MAX_WORKERS, pool_maxsize=CRAWL_MAX_WORKERS)
+    session.mount('http://', adapter); session.mount('https://', adapter)
+    executor = ThreadPoolExecutor(max_workers=CRAWL_MAX_WORKERS, thread_name_prefix="Crawler")
+    pending = {}
+
+    def accept(node_url: str, entry: Dict[str, Any]):
+        previous = live.get(entry["node_id"])
+        if previous is None or entry["latency_ms"] < previous["latency_ms"]:
+            # last_seen là thời điểm thăm dò đo được height: Seeder chỉ so chiều cao giữa các node đo cùng khoảng thời gian
+            live[entry["node_id"]] = {"url": node_url, "node_id": entry["node_id"], "latency_ms": entry["latency_ms"],
+                                      "height": entry["height"], "last_seen": entry["last_success"]}
+        frontier.extend((peer_url, peer_id) for peer_id, peer_url in entry["peers"].items())
+
+    try:
+        while frontier or pending:
+            now = time.time()
+            while frontier:
+                node_url, node_id = frontier.popleft()
+                if not node_url or node_url in scheduled or (node_id and node_id in live):
+                    continue
+                scheduled.add(node_url)
+                entry = state.get(node_url)
+                if entry and entry.get("next_probe_at", 0) > now:
+                    if entry.get("failure_streak", 0) == 0 and entry.get("node_id"):
+                        reused += 1
+                        accept(node_url, entry)
+                    else:
+                        skipped += 1
+                    continue
+                probed += 1
+                pending[executor.submit(probe_node, session, node_url)] = node_url
+            if not pending:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning(f"Hết hạn chót chu kỳ quét ({CRAWL_CYCLE_DEADLINE_SECONDS}s). Bỏ qua {len(pending)} node chưa phản hồi.")
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                node_url = pending.pop(future)
+                result = future.result()
+                entry = _record_probe_result(state, node_url, result, time.time())
+                if result is None:
+                    logging.warning(f"  [OFFLINE] Node tại {node_url} không phản hồi (lỗi liên tiếp: {entry['failure_streak']}).")
+                    continue
+                logging.info(f"  [OK] Node {result['node_id'][:15]}... tại {node_url} đang hoạt động ({result['latency_ms']} ms).")
+                accept(node_url, entry)
+    finally:
+        # Không chờ các yêu cầu đang bay sau hạn chót; chúng tự kết thúc theo timeout
+        executor.shutdown(wait=False, cancel_futures=True)
+        if not pending:
+            session.close()
+
+    # Quên các node đã chết hẳn để trạng thái không phình theo thời gian
+    for node_url in [url for url, entry in state.items()
+                     if entry.get("failure_streak", 0) >= CRAWL_FORGET_AFTER_FAILURES and url not in seed_urls]:
+        del state[node_url]
+    logging.info(f"Thăm dò {probed} node, dùng lại kết quả của {reused} node còn mới, bỏ qua {skipped} node đang chờ thử lại.")
+    return live
+
+def run_deep_discovery_cycle(bootstrap_peers: Dict[str, Any]) -> List[Dict[str, Any]]:
     logging.info("Bắt đầu chu kỳ quét sâu mạng lưới...")
-    
+    started = time.monotonic()
+
+    global _crawl_state
+    if _crawl_state is None:
+        _crawl_state = load_crawl_state()
+        logging.info(f"Đã nạp trạng thái quét của {len(_crawl_state)} node từ '{CRAWL_STATE_FILE}'.")
+
     initial_peers = {normalize_url(peer_info.get('last_known_address')) for peer_info in bootstrap_peers.values()}
-    nodes_to_scan = {url for url in initial_peers if url}
-    scanned_nodes = set()
-    all_discovered_peers: Dict[str, Dict[str, Any]] = {}
-
-    while nodes_to_scan:
-        node_url = nodes_to_scan.pop()
-        if node_url in scanned_nodes:
-            continue
-        
-        scanned_nodes.add(node_url)
-        logging.info(f"Đang quét peer tại: {node_url}...")
-        
-        try:
-            response = requests.get(f"{node_url}/nodes/peers", timeout=5)
-            if response.status_code == 200:
-                peers_from_node = response.json()
-                all_discovered_peers.update(peers_from_node)
-                
-                for peer_data in peers_from_node.values():
-                    new_node_url = normalize_url(peer_data.get('address'))
-                    if new_node_url and new_node_url not in scanned_nodes:
-                        nodes_to_scan.add(new_node_url)
-            else:
-                logging.warning(f"Node {node_url} phản hồi với mã lỗi {response.status_code}.")
-        except requests.exceptions.RequestException:
-            logging.warning(f"Không thể kết nối đến node {node_url}.")
-
-    if not all_discovered_peers:
-        # Nếu không tìm thấy peer nào, hãy thử ping trực tiếp các bootstrap peer
-        logging.warning("Không khám phá được peer nào qua PEX. Đang thử ping trực tiếp bootstrap peers...")
-        for url in initial_peers:
-            all_discovered_peers[url] = {"address": url}
-
-    logging.info(f"Đã khám phá được tổng cộng {len(all_discovered_peers)} peer tiềm năng. Bắt đầu kiểm tra sức khỏe...")
-    live_nodes = []
-    for node_id, peer_data in all_discovered_peers.items():
-        node_url = normalize_url(peer_data.get('address'))
-        if not node_url: continue
-        try:
-            handshake_resp = requests.get(f'{node_url}/handshake', timeout=3)
-            # Node ID từ handshake có thể khác với key trong `all_discovered_peers` nếu có xung đột
-            actual_node_id = handshake_resp.json().get('node_id')
-            if handshake_resp.status_code == 200 and actual_node_id:
-                live_nodes.append(node_url)
-                logging.info(f"  [OK] Node {actual_node_id[:15]}... tại {node_url} đang hoạt động.")
-            else:
-                logging.warning(f"  [FAIL] Node tại {node_url} không vượt qua kiểm tra sức khỏe.")
-        except requests.exceptions.RequestException:
-            logging.warning(f"  [OFFLINE] Node tại {node_url} không phản hồi.")
-    
-    # Loại bỏ các URL trùng lặp và sắp xếp
-    live_nodes = sorted(list(set(live_nodes)))
+    live_by_id = crawl_network({url for url in initial_peers if url}, _crawl_state)
+    try:
+        save_crawl_state(_crawl_state)
+    except IOError as e:
+        logging.error(f"Không thể lưu trạng thái quét: {e}")
+    logging.info(f"Quét xong {len(live_by_id)} node đang hoạt động trong {time.monotonic() - started:.1f} giây.")
+
+    # Mỗi node chỉ giữ một URL (URL có độ trễ thấp nhất), sắp xếp để tệp bản đồ ổn định
+    live_records = [{k: v for k, v in record.items() if k != 'peers'} for record in live_by_id.values()]
+    live_nodes = sorted({record['url'] for record in live_records})
 
     if not live_nodes:
         logging.error("KHÁM PHÁ THẤT BẠI! Không tìm thấy node nào đang hoạt động.")
-        return
+        return []
 
     # --- CẬP NHẬT CỤC BỘ VÀ LAN TRUYỀN ---
     try:
         logging.info(f"Tổng hợp được {len(live_nodes)} node đang hoạt động. Đang cập nhật tệp cục bộ...")
-        # 1. Cập nhật tệp cục bộ (giống như trước)
-        temp_file = LIVE_NETWORK_CONFIG_FILE + ".tmp"
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump({"active_nodes": live_nodes}, f, indent=2)
-        os.replace(temp_file, LIVE_NETWORK_CONFIG_FILE)
-        logging.info(f"✅ Đã cập nhật thành công tệp cục bộ '{LIVE_NETWORK_CONFIG_FILE}'.")
-
-        # 2. LAN TRUYỀN bản đồ mạng đến các node khác
+        # 1. Cập nhật tệp cục bộ: chỉ ghi (và tăng phiên bản) khi nội dung thực sự thay đổi
+        previous = load_network_map()
+        live_hash = network_map_hash(live_nodes)
+        if live_hash == previous["hash"] and previous["version"] > 0:
+            current = previous
+            logging.info(f"Bản đồ mạng không thay đổi (phiên bản {current['version']}), bỏ qua ghi tệp.")
+        else:
+            current = {"version": max(previous["version"] + 1, int(time.time())), "hash": live_hash, "active_nodes": live_nodes}
+            temp_file = LIVE_NETWORK_CONFIG_FILE + ".tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(current, f, indent=2)
+            os.replace(temp_file, LIVE_NETWORK_CONFIG_FILE)
+            logging.info(f"✅ Đã cập nhật thành công tệp cục bộ '{LIVE_NETWORK_CONFIG_FILE}' (phiên bản {current['version']}).")
+
+        # 2. LAN TRUYỀN bản đồ mạng đến các node khác: gửi delta so với phiên bản trước,
+        #    node nào không áp dụng được (409, hoặc 400 với node đời cũ) mới nhận bản đầy đủ.
         logging.info("Bắt đầu lan truyền bản đồ mạng đến các node khác...")
         nodes_to_notify = random.sample(live_nodes, min(len(live_nodes), BROADCAST_COUNT))
-        
-        payload = {"active_nodes": live_nodes}
-        
+
+        previous_set, current_set = set(previous["active_nodes"]), set(current["active_nodes"])
+        delta = {"base_hash": previous["hash"], "version": current["version"], "hash": current["hash"],
+                 "added": sorted(current_set - previous_set), "removed": sorted(previous_set - current_set)}
+
         for node_url in nodes_to_notify:
             try:
-                logging.info(f"  -> Đang gửi bản đồ đến {node_url}...")
-                response = requests.post(f"{node_url}/nodes/update_map", json=payload, timeout=5)
-                if response.status_code == 202:
-                    logging.info(f"     [SUCCESS] Node {node_url} đã chấp nhận bản đồ.")
+                logging.info(f"  -> Đang gửi delta bản đồ (+{len(delta['added'])}/-{len(delta['removed'])}) đến {node_url}...")
+                response = requests.post(f"{node_url}/nodes/update_map", json=delta, timeout=5)
+                if response.status_code in (400, 409):
+                    logging.info(f"     Node {node_url} cần bản đồ đầy đủ. Đang gửi lại...")
+                    response = requests.post(f"{node_url}/nodes/update_map", json=current, timeout=5)
+                if response.status_code in (200, 202):
+                    logging.info(f"     [SUCCESS] Node {node_url}: {response.json().get('message')} (phiên bản của node: {response.json().get('version')}).")
                 else:
                     logging.warning(f"     [FAIL] Node {node_url} phản hồi: {response.status_code} - {response.text}")
             except requests.RequestException as e:
@@ -149,6 +291,7 @@ def run_deep_discovery_cycle(bootstrap_peers: Dict[str, Any]):
 
     except Exception as e:
         logging.error(f"Lỗi khi ghi và lan truyền tệp cấu hình: {e}")
+    return live_records
 
 # (Hàm main giữ nguyên)
 def main():
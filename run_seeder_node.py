@@ -11,6 +11,8 @@ cho bất kỳ client nào kết nối tới.
 - Bên trong, nó chạy một phiên bản của Ranger Agent để liên tục làm mới
   danh sách các peer đang hoạt động.
 - Nó cung cấp một API endpoint duy nhất: /get_active_peers
+- Kết quả quét được giữ trong bộ nhớ (ảnh chụp thay thế nguyên khối), mỗi yêu cầu chỉ nhận
+  một tập con ngẫu nhiên có trọng số, ưu tiên node phản hồi nhanh và đã đồng bộ kịp chuỗi.
 """
 
 import os
@@ -18,8 +20,11 @@ import sys
 import json
 import time
 import logging
+import random
+import bisect
 import threading
-from flask import Flask, jsonify
+from typing import Any, Dict, List
+from flask import Flask, jsonify, request
 from waitress import serve
 
 # --- THÊM ĐƯỜNG DẪN DỰ ÁN ---
@@ -42,6 +47,14 @@ LIVE_NETWORK_CONFIG_FILE = "live_network_nodes.json"
 SEEDER_PORT = 8080 # Một cổng riêng biệt cho Seeder
 REFRESH_INTERVAL_SECONDS = 5 * 60 # Quét lại mạng mỗi 5 phút
 
+# === [NÂNG CẤP] Phân phối peer theo thứ hạng ===
+DEFAULT_PEERS_PER_REQUEST = 16     # Số peer trả về mặc định cho mỗi yêu cầu
+MAX_PEERS_PER_REQUEST = 64
+MAX_HEIGHT_LAG = 10                # Node tụt quá số khối này so với đỉnh mạng sẽ không được giới thiệu
+HEIGHT_LAG_WINDOW_SECONDS = 60     # Chỉ so chiều cao giữa các node được thăm dò cách nhau không quá khoảng này
+MAX_PEER_AGE_SECONDS = 3 * REFRESH_INTERVAL_SECONDS  # Không giới thiệu node không thấy lại quá lâu
+DEFAULT_LATENCY_MS = 500.0         # Độ trễ giả định cho node chưa đo (ví dụ: nạp từ tệp lúc khởi động)
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [SeederNode] [%(levelname)s] - %(message)s')
 
 # --- BỘ NÃO CỦA SEEDER ---
@@ -53,6 +66,11 @@ class SeederService:
             logging.critical("Seeder không thể hoạt động nếu không có bootstrap_config.json ban đầu.")
             sys.exit(1)
 
+        # Ảnh chụp (bản ghi peer, trọng số) được thay thế nguyên khối sau mỗi chu kỳ quét,
+        # nên luồng phục vụ API chỉ đọc một tham chiếu, không cần khóa và không đọc đĩa.
+        self._snapshot = ((), ())
+        self._publish_snapshot(self._load_snapshot_from_file())
+
         # Bắt đầu luồng khám phá trong nền
         self.discovery_thread = threading.Thread(target=self.run_discovery_loop, daemon=True)
         self.discovery_thread.start()
@@ -63,24 +81,65 @@ class SeederService:
         while self.is_running:
             try:
                 # Chạy logic quét mạng
-                run_deep_discovery_cycle(self.bootstrap_peers)
+                live_records = run_deep_discovery_cycle(self.bootstrap_peers)
+                if live_records:
+                    self._publish_snapshot(live_records)
                 logging.info(f"Chu kỳ khám phá của Seeder hoàn tất. Sẽ chạy lại sau {REFRESH_INTERVAL_SECONDS} giây.")
                 time.sleep(REFRESH_INTERVAL_SECONDS)
             except Exception as e:
                 logging.error(f"Lỗi trong luồng khám phá của Seeder: {e}", exc_info=True)
                 time.sleep(60)
 
-    def get_active_peers(self) -> list:
-        """Đọc và trả về danh sách các peer từ tệp live_network_nodes.json."""
+    def _load_snapshot_from_file(self) -> List[Dict[str, Any]]:
+        """Nạp kết quả của lần chạy trước (chỉ một lần khi khởi động) để phục vụ ngay trong lúc chờ chu kỳ quét đầu tiên."""
         if os.path.exists(LIVE_NETWORK_CONFIG_FILE):
             try:
                 with open(LIVE_NETWORK_CONFIG_FILE, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    return data.get("active_nodes", [])
+                # Tuổi của bản ghi là lúc tệp được ghi, không phải lúc khởi động: tệp cũ sẽ hết hạn theo MAX_PEER_AGE_SECONDS như bình thường
+                written_at = os.path.getmtime(LIVE_NETWORK_CONFIG_FILE)
+                return [{"url": url, "latency_ms": None, "height": None, "last_seen": written_at} for url in data.get("active_nodes", [])]
             except (IOError, json.JSONDecodeError) as e:
                 logging.error(f"Không thể đọc hoặc phân tích tệp bản đồ mạng: {e}")
         return []
 
+    @staticmethod
+    def _window_best_heights(records: List[Dict[str, Any]]) -> Dict[int, int]:
+        """
+        Chiều cao lớn nhất trong số các node được thăm dò cùng khoảng thời gian với từng node (last_seen là lúc đo height).
+        Node khỏe chỉ được Ranger thăm dò lại sau vài phút, nên so với đỉnh đo ở thời điểm khác sẽ loại nhầm node đang theo kịp chuỗi.
+        """
+        measured = sorted((r["last_seen"], r["height"], id(r)) for r in records if isinstance(r.get("height"), int) and r.get("last_seen"))
+        times = [t for t, _, _ in measured]
+        return {key: max(h for _, h, _ in measured[bisect.bisect_left(times, t - HEIGHT_LAG_WINDOW_SECONDS):bisect.bisect_right(times, t + HEIGHT_LAG_WINDOW_SECONDS)])
+                for t, _, key in measured}
+
+    def _publish_snapshot(self, records: List[Dict[str, Any]]):
+        """Tính sẵn trọng số cho từng peer rồi thay ảnh chụp bằng một phép gán duy nhất."""
+        best_heights = self._window_best_heights(records)
+        ranked, weights = [], []
+        for record in records:
+            height, best_height = record.get("height"), best_heights.get(id(record))
+            if best_height is not None and best_height - height > MAX_HEIGHT_LAG:
+                continue
+            latency = record.get("latency_ms") or DEFAULT_LATENCY_MS
+            ranked.append({k: record.get(k) for k in ("url", "node_id", "latency_ms", "height", "last_seen")})
+            weights.append(1.0 / max(latency, 1.0))
+        self._snapshot = (tuple(ranked), tuple(weights))
+        logging.info(f"Đã cập nhật ảnh chụp peer: {len(ranked)}/{len(records)} node đủ điều kiện giới thiệu.")
+
+    def get_active_peers(self, limit: int = DEFAULT_PEERS_PER_REQUEST) -> list:
+        """
+        Trả về tối đa `limit` peer, chọn ngẫu nhiên có trọng số theo độ trễ (không lặp lại),
+        để các node mới khởi động được rải đều lên những peer khỏe thay vì dồn vào cùng một danh sách.
+        """
+        records, weights = self._snapshot
+        min_seen = time.time() - MAX_PEER_AGE_SECONDS
+        # Lấy mẫu có trọng số không hoàn lại (Efraimidis-Spirakis) trong không gian log: khóa = ln(u)/w, lấy các khóa lớn nhất
+        keyed = [(-random.expovariate(1.0) / w, r) for r, w in zip(records, weights) if r["last_seen"] >= min_seen]
+        keyed.sort(key=lambda item: item[0], reverse=True)
+        return [r for _, r in keyed[:limit]]
+
 # --- TẠO MÁY CHỦ API ---
 seeder_service = SeederService()
 app = Flask(__name__)
@@ -88,10 +147,11 @@ app = Flask(__name__)
 @app.route('/get_active_peers', methods=['GET'])
 def get_active_peers_api():
     """API endpoint để client lấy danh sách peer."""
-    peers = seeder_service.get_active_peers()
+    limit = max(1, min(request.args.get('limit', DEFAULT_PEERS_PER_REQUEST, type=int), MAX_PEERS_PER_REQUEST))
+    peers = seeder_service.get_active_peers(limit)
     if not peers:
         return jsonify({"error": "Không có peer nào đang hoạt động hoặc dịch vụ đang khởi tạo."}), 503
-    return jsonify({"active_nodes": peers}), 200
+    return jsonify({"active_nodes": [p["url"] for p in peers], "peers": peers}), 200
 
 if __name__ == "__main__":
     print("=" * 60)